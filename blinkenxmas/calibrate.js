@@ -53,12 +53,14 @@ function initCalibrateForm(form, angle) {
     let preview = form.querySelector('#preview-image');
     let canvas = document.createElement('canvas');
 
+    let state = {positions: {}, scores: {}};
+
     refreshBtn.remove();
     canvas.id = 'preview-image';
     preview.onload = () => {
         canvas.width = preview.width;
         canvas.height = preview.height;
-        drawState(canvas, preview);
+        drawState(canvas, preview, state);
         preview.replaceWith(canvas);
     };
 
@@ -81,7 +83,26 @@ function initCalibrateForm(form, angle) {
             })
             .catch((e) => showMessage(e));
     }
-    refresh();
+
+    if (!window.EventSource) {
+        refresh();
+        return;
+    }
+    let events = getEvents(`angle=${parseInt(angle, 10)}`);
+    events.addEventListener('scan', (evt) => {
+        let update = JSON.parse(evt.data);
+        if (update.position !== null) {
+            state.positions[update.led] = update.position;
+            state.scores[update.led] = update.score;
+        }
+        progressBar.value = update.progress;
+        if (preview.complete)
+            drawState(canvas, preview, state);
+    });
+    events.addEventListener('scanned', (evt) => {
+        events.close();
+        window.location = '/capture.html';
+    });
 }
 
 function drawMask(form, canvas, image, maskPath) {
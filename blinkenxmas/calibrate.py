@@ -8,7 +8,7 @@ from contextlib import suppress
 from operator import itemgetter
 from statistics import median, mean
 from threading import Thread, Event, Lock
-from itertools import accumulate, combinations
+from itertools import accumulate, combinations, count
 
 import numpy as np
 from colorzero import Color
@@ -71,6 +71,7 @@ class AngleScanner:
         self._mask = []
         self._positions = {}
         self._scores = {}
+        self._updates = []
         self._strips = strips
         self._camera = camera
         self._queue = queue
@@ -152,11 +153,17 @@ class AngleScanner:
                     position, score = self._calibrate_diff(base, image)
                 except PointNotFound as e:
                     self._scores[led] = 0
+                    self._updated(led, None, 0)
                     self.logger.warning('LED #%d: %s', led, str(e))
                     continue
                 else:
                     self._positions[led] = position
                     self._scores[led] = score
+                    self._updated(led, position, score)
+
+    def _updated(self, led, position, score):
+        self._updates.append((led, position, score))
+        self._messages.notify()
 
     def _calibrate_diff(self, unlit, lit):
         # The position is calculated by taking the difference between the
@@ -207,10 +214,27 @@ class AngleScanner:
     def mask(self):
         return self._mask
 
+    @property
+    def scanning(self):
+        """
+        Returns :data:`True` if the scan of the angle is in progress.
+        """
+        thread = self._thread
+        return thread is not None and thread.is_alive()
+
     @property
     def progress(self):
         return len(self._scores) / sum(len(strip) for strip in self._strips)
 
+    def updates(self, since=0):
+        """
+        Returns a list of the (led, position, score) tuples determined by the
+        scan, after the first *since*, in the order they were determined.
+        *position* is :data:`None` for LEDs that could not be found.
+        """
+        # Slicing is atomic, and the list is only ever appended to
+        return self._updates[since:]
+
     @property
     def positions(self):
         return {
@@ -234,17 +258,23 @@ class PositionsCalculator:
     score_min = 40
     logger = logging.getLogger('calculator')
 
+    # Shared by all instances so that versions are never re-used, even if the
+    # calculator is replaced
+    _versions = count(1)
+
     def __init__(self, strips, messages):
         self._messages = messages
         self._strips = strips
         self._angles = {}
         self._scores = {}
         self._positions = {}
+        self._version = next(self._versions)
 
     def clear(self):
         self._angles.clear()
         self._scores.clear()
         self._positions.clear()
+        self._version = next(self._versions)
         self._messages.show('Cleared calculated positions')
 
     def add_angle(self, scanner):
@@ -368,6 +398,7 @@ class PositionsCalculator:
                 for led, positions in new_positions.items()
                 for position, weight in (weighted_median(positions),)
             }
+            self._version = next(self._versions)
             self._messages.show(
                 f'Calculated {len(self._positions)} LED positions from '
                 f'{len(self._angles)} angles')
@@ -380,6 +411,13 @@ class PositionsCalculator:
     def positions(self):
         return self._positions
 
+    @property
+    def version(self):
+        """
+        An :class:`int` which changes whenever :attr:`positions` changes.
+        """
+        return self._version
+
 
 class Calibration:
     def __init__(self, config, messages):
@@ -6,6 +6,72 @@ from threading import Lock, Thread, Event, Condition
 from PIL import Image
 
 
+class FrameMailbox:
+    """
+    A single-slot mailbox holding the latest preview frame for one client of
+    an :class:`AbstractSource`.
+
+    Each new frame replaces any frame the client has not yet retrieved, so a
+    client that cannot keep up (a slow browser on a poor wifi connection, for
+    instance) simply drops frames, without delaying the camera or any other
+    client.
+    """
+    def __init__(self):
+        self._cond = Condition()
+        self._sequence = 0
+        self._frame = b''
+        self._read = 0
+        self._dropped = 0
+        self._closed = False
+
+    @property
+    def dropped(self):
+        "The number of frames replaced before they were retrieved."
+        return self._dropped
+
+    @property
+    def closed(self):
+        "Returns :data:`True` if the mailbox has been closed."
+        return self._closed
+
+    def put(self, sequence, frame):
+        """
+        Place *frame* (with the specified *sequence* number) in the mailbox,
+        replacing any frame that has not yet been retrieved.
+        """
+        with self._cond:
+            if self._sequence > self._read:
+                self._dropped += 1
+            self._sequence = sequence
+            self._frame = frame
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """
+        Wait up to *timeout* seconds (or indefinitely if this is
+        :data:`None`) for a frame newer than the one last retrieved, returning
+        a tuple of its sequence number and data. Returns :data:`None` if the
+        timeout elapsed, or the mailbox was closed.
+        """
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: self._closed or self._sequence > self._read,
+                    timeout):
+                return None
+            if self._closed:
+                return None
+            self._read = self._sequence
+            return self._sequence, self._frame
+
+    def close(self):
+        """
+        Close the mailbox, waking any thread waiting in :meth:`get`.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
 class AbstractSource:
     """
     An abstract camera source.
@@ -18,16 +84,20 @@ class AbstractSource:
         The current preview frame's data. This is a :class:`bytes` string
         containing the JPEG data of the frame.
 
-    .. attribute:: frame_ready
+    .. attribute:: sequence
 
-        A :class:`~threading.Condition` which clients must wait upon to be
-        notified of a new JPEG available in :attr:`frame`.
+        The sequence number of :attr:`frame`, incremented each time a new
+        (distinct) frame is received from the camera.
     """
     def __init__(self, config):
+        # _lock serializes starting and stopping the preview; _frame_lock
+        # (which may be acquired while holding _lock, but not vice versa)
+        # protects the frame and the mailboxes
         self._lock = Lock()
-        self._clients = []
+        self._frame_lock = Lock()
+        self._clients = {}
         self.frame = b''
-        self.frame_ready = Condition()
+        self.sequence = 0
 
     def start_preview(self, angle):
         """
@@ -42,6 +112,22 @@ class AbstractSource:
         """
         raise NotImplementedError
 
+    def close(self):
+        """
+        Terminate any live preview, and release the camera. The instance must
+        not be used after this is called.
+        """
+        self.stop_preview()
+
+    @property
+    def has_clients(self):
+        """
+        Returns :data:`True` if any clients are receiving live preview frames
+        (see :meth:`add_client`).
+        """
+        with self._frame_lock:
+            return bool(self._clients)
+
     def capture(self, angle, led=None):
         """
         Capture a high-quality (highest possible resolution) image of the tree
@@ -51,22 +137,33 @@ class AbstractSource:
         raise NotImplementedError
 
     def _preview_frame(self, frame):
-        with self.frame_ready:
+        with self._frame_lock:
+            # Empty frames, and frames identical to the last, are not worth
+            # sending to anyone
+            if not frame or frame is self.frame or frame == self.frame:
+                return
+            self.sequence += 1
             self.frame = frame
-            if self.frame:
-                self.frame_ready.notify_all()
+            for mailbox in self._clients.values():
+                mailbox.put(self.sequence, frame)
 
     def add_client(self, client):
         """
         Called to add *client* (a :class:`~http.server.BaseHTTPRequestHandler`
         instance) to the list of clients wanting to receive live preview frames
-        from the camera.
+        from the camera. Returns the :class:`FrameMailbox` from which the
+        client should retrieve frames.
         """
         with self._lock:
             if not self._clients:
                 angle = int(client.query.get('angle', '0'))
                 self.start_preview(angle)
-            self._clients.append(client)
+            mailbox = FrameMailbox()
+            with self._frame_lock:
+                if self.frame:
+                    mailbox.put(self.sequence, self.frame)
+                self._clients[client] = mailbox
+        return mailbox
 
     def remove_client(self, client):
         """
@@ -75,10 +172,14 @@ class AbstractSource:
         clients wanting to receive live preview frames from the camera.
         """
         with self._lock:
-            try:
-                self._clients.remove(client)
-            except ValueError:
-                pass # already removed
+            with self._frame_lock:
+                try:
+                    self._clients.pop(client).close()
+                except KeyError:
+                    pass # already removed
+                if not self._clients:
+                    # Don't greet the next client with a stale frame
+                    self.frame = b''
             if not self._clients:
                 self.stop_preview()
 
@@ -132,8 +233,9 @@ class FilesSource(AbstractSource):
         image = Image.open(base_path).resize(self._preview_res)
         preview = io.BytesIO()
         image.save(preview, 'jpeg')
+        preview = preview.getvalue()
         while not FilesSource.stop.wait(timeout=0.1):
-            self._preview_frame(preview.getvalue())
+            self._preview_frame(preview)
 
     def capture(self, angle, led=None):
         if FilesSource.thread is not None:
@@ -204,6 +306,10 @@ class PiCameraSource(AbstractSource):
                 self._camera.stop_recording()
                 PiCameraSource.output = None
 
+    def close(self):
+        super().close()
+        self._camera.close()
+
     def capture(self, angle, led=None):
         self.stop_preview()
         self._camera.resolution = self._capture_res
@@ -16,7 +16,12 @@ def get_cli_parser():
     """
     config = get_config()
     parser = get_parser(config, description=__doc__)
-    parser.set_defaults(func=do_help)
+    parser.set_defaults(func=do_help, needs_broker=True)
+
+    web_section = parser.add_argument_group('web', section='web')
+    web_section.add_argument(
+        '--db', metavar='FILE', key='database',
+        help="the SQLite database to store presets in. Default: %(default)s")
 
     commands = parser.add_subparsers(title='commands')
 
@@ -58,7 +63,7 @@ def get_cli_parser():
     list_cmd = commands.add_parser(
         'list', aliases=['ls'], description=do_list.__doc__,
         help="List all presets")
-    list_cmd.set_defaults(func=do_list)
+    list_cmd.set_defaults(func=do_list, needs_broker=False)
 
     show_cmd = commands.add_parser(
         'show', aliases=['load'], description=do_show.__doc__,
@@ -69,6 +74,24 @@ def get_cli_parser():
         "it will need quoting on the command line")
     show_cmd.set_defaults(func=do_show)
 
+    export_cmd = commands.add_parser(
+        'export', description=do_export.__doc__,
+        help="Export all presets to an archive")
+    export_cmd.add_argument(
+        'filename', nargs='?', default='-',
+        help="The file to write the archive to; if omitted or \"-\", the "
+        "archive is written to stdout")
+    export_cmd.set_defaults(func=do_export, needs_broker=False)
+
+    import_cmd = commands.add_parser(
+        'import', description=do_import.__doc__,
+        help="Import presets from an archive")
+    import_cmd.add_argument(
+        'filename', nargs='?', default='-',
+        help="The file to read the archive from; if omitted or \"-\", the "
+        "archive is read from stdin")
+    import_cmd.set_defaults(func=do_import, needs_broker=False)
+
     parser.set_defaults_from(config)
     return parser
 
@@ -117,15 +140,46 @@ def do_show(config, queue):
     queue.put(store.presets[config.preset])
 
 
+def do_export(config, queue):
+    """
+    Export all presets, and the active LED positions, to a gzip-compressed
+    archive
+    """
+    store = Storage(config.db)
+    if config.filename == '-':
+        count = store.export_archive(sys.stdout.buffer)
+    else:
+        with open(config.filename, 'wb') as f:
+            count = store.export_archive(f)
+    print(f'Exported {count} preset(s)', file=sys.stderr)
+
+
+def do_import(config, queue):
+    """
+    Import presets, and LED positions, from an archive produced by the export
+    command. Presets with the same name as those in the archive are replaced
+    """
+    store = Storage(config.db)
+    if config.filename == '-':
+        count = store.import_archive(sys.stdin.buffer)
+    else:
+        with open(config.filename, 'rb') as f:
+            count = store.import_archive(f)
+    print(f'Imported {count} preset(s)', file=sys.stderr)
+
+
 def main(args=None):
     "Entry point for :program:`bxcli`"
     try:
         config = get_cli_parser().parse_args(args)
+        if not config.needs_broker:
+            config.func(config, None)
+            return 0
         if config.led_count == 0:
             raise RuntimeError(
                 'No LED strips defined; please edit the configuration file')
         queue = Queue()
-        with mqtt.MessageThread(queue, config) as message_task:
+        with mqtt.MessageThread(config, queue) as message_task:
             config.func(config, queue)
             queue.join()
     except KeyboardInterrupt:
@@ -136,52 +136,99 @@ function generateAnim(form) {
             cache: 'no-store',
         });
         let tid = setTimeout(
-            () => showMessage('Please waiting, building animation'),
+            () => showMessage('Please wait, building animation'),
             500);
         return fetch(req)
             .then((resp) => {
-                clearTimeout(tid);
-                if (resp.ok)
-                    return resp.text();
+                if (resp.status == 202)
+                    return waitForJob(resp.headers.get('Location'));
+                else if (resp.status == 503)
+                    throw new Error(
+                        'The server is busy; please try again in ' +
+                        `${resp.headers.get('Retry-After')} seconds`);
                 else
                     throw new Error(resp.statusText);
             })
-            .then((data) => {
-                form.dataset.anim = data;
-                return data;
+            .then((job) => {
+                clearTimeout(tid);
+                // Only the job's id is kept; the generated frames remain on
+                // the server which accepts the id in place of them (for a few
+                // minutes; see sendAnim)
+                form.dataset.anim = job;
+                return job;
+            })
+            .catch((e) => {
+                clearTimeout(tid);
+                throw e;
             });
     }
     return new Promise((resolve, reject) => resolve(form.dataset.anim));
 }
 
-function doPreview(form) {
-    generateAnim(form)
-        .then((data) => {
-            let req = new Request('/preview', {
-                method: 'POST',
+function waitForJob(url) {
+    // Poll the job at url until it finishes, reporting its progress, and
+    // resolve to its id
+    return new Promise((resolve, reject) => setTimeout(resolve, 500))
+        .then(() => getJSON(url))
+        .then((job) => {
+            switch (job.state) {
+                case 'done':
+                    showMessage(
+                        `Built animation: ${job.frames} frames of ` +
+                        `${job.leds} LEDs`);
+                    return job.id;
+                case 'failed':
+                    throw new Error(`Failed to build animation: ${job.error}`);
+                case 'cancelled':
+                    throw new Error('Animation cancelled');
+                default:
+                    if (job.progress !== null && job.eta !== null)
+                        showMessage(
+                            'Building animation: ' +
+                            `${Math.round(job.progress * 100)}% ` +
+                            `(${Math.ceil(job.eta)}s remaining)`);
+                    return waitForJob(url);
+            }
+        });
+}
+
+function sendAnim(form, url, method, info, retry=true) {
+    // Send the generated animation (by the id of the job that built it) to
+    // url, along with the members of info. If the server has since discarded
+    // the job's result, the animation is generated again, once
+    return generateAnim(form)
+        .then((job) => {
+            let req = new Request(url, {
+                method: method,
                 headers: new Headers({'Content-Type': 'application/json'}),
-                body: data,
+                body: JSON.stringify({...info, job: job}),
                 cache: 'no-store',
             });
-            fetch(req)
-                .catch((e) => showMessage(e));
+            return fetch(req);
         })
+        .then((resp) => {
+            if (resp.status == 400 && retry) {
+                delete form.dataset.anim;
+                return sendAnim(form, url, method, info, false);
+            }
+            else if (!resp.ok)
+                throw new Error(resp.statusText);
+            return resp;
+        });
+}
+
+function doPreview(form) {
+    sendAnim(form, '/preview', 'POST', {})
         .catch((e) => showMessage(e));
 }
 
 function doCreate(form) {
-    generateAnim(form)
-        .then((data) => {
-            let name = form.elements['name'].value;
-            let req = new Request(`/preset/${encodeURIComponent(name)}.json`, {
-                method: 'PUT',
-                headers: new Headers({'Content-Type': 'application/json'}),
-                body: data,
-                cache: 'no-store',
-            });
-            fetch(req)
-                .then(() => { window.location = '/'; })
-                .catch((e) => showMessage(e));
-        })
+    let name = form.elements['name'].value;
+    let animation = form.elements['animation'].value;
+    sendAnim(
+        form, `/preset/${encodeURIComponent(name)}.json`, 'PUT',
+        {animation: animation}
+    )
+        .then(() => { window.location = '/'; })
         .catch((e) => showMessage(e));
 }
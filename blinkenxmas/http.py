@@ -1,5 +1,10 @@
 import io
 import os
+import re
+import gzip
+import stat
+import json
+import codecs
 import base64
 import hashlib
 import mimetypes
@@ -9,12 +14,22 @@ import email.policy
 import email.utils as eut
 from pathlib import Path
 from http import HTTPStatus
-from contextlib import suppress, closing
+from threading import Lock
+from contextlib import suppress, closing, ExitStack
+from collections import OrderedDict
 from collections.abc import Mapping, MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 
 from .compat import SpooledTemporaryFile
 
 
+# The maximum number of buffers that may be passed to a vectored write; POSIX
+# only guarantees 16, Linux permits 1024
+IOV_MAX = (
+    max(16, os.sysconf('SC_IOV_MAX'))
+    if 'SC_IOV_MAX' in getattr(os, 'sysconf_names', {}) else 16)
+
+
 class HTTPHeaders(MutableMapping):
     """
     Represents the headers of an HTTP request as a mutable mapping, handling
@@ -109,6 +124,13 @@ def transfer(source, target, *, byterange=None):
     transfer). If *byterange* is not :data:`None`, the *source* must
     additionally implemented ``seek``. No attempt is made to seek the *target*;
     bytes are simply written to it at its current position.
+
+    Where possible, the copy through an intermediate buffer is avoided
+    entirely. If *source* is a regular file, and *target* implements a
+    ``sendfile`` method (like :meth:`socket.socket.sendfile`), the kernel
+    copies the file to *target* directly. If *source* implements
+    ``getbuffer`` (like :class:`MemoryReader`), its buffer is written to
+    *target* directly.
     """
     if byterange is not None:
         if byterange.step != 1:
@@ -117,6 +139,31 @@ def transfer(source, target, *, byterange=None):
         length = len(byterange)
     else:
         length = None
+    try:
+        sendfile = target.sendfile
+    except AttributeError:
+        pass
+    else:
+        if is_regular_file(source):
+            # socket.sendfile leaves the source positioned after the last
+            # byte sent, just as the copy loop below would
+            if length != 0:
+                sendfile(source, source.tell(), length)
+            return
+    try:
+        getbuffer = source.getbuffer
+    except AttributeError:
+        pass
+    else:
+        # In-memory sources (like MemoryReader) can be written without
+        # copying through an intermediate buffer
+        pos = source.tell()
+        with getbuffer() as buf:
+            end = len(buf) if length is None else min(len(buf), pos + length)
+            with buf[pos:end] as view:
+                write_all(target, view)
+        source.seek(end)
+        return
     if length is not None and length < COPY_BUFSIZE:
         # Fast path for trivially short copies
         target.write(source.read(length))
@@ -157,6 +204,483 @@ def transfer(source, target, *, byterange=None):
                     length -= n
 
 
+def is_regular_file(source):
+    """
+    Returns :data:`True` if *source* is a file-like object backed by a regular
+    file (as opposed to an in-memory stream, a pipe, or a device), and thus
+    suitable for :func:`os.sendfile`.
+    """
+    # Only consider real files, or buffered readers over them; the fileno
+    # method of some file-likes has side-effects (for example, it forces a
+    # SpooledTemporaryFile to roll over to disk)
+    if not isinstance(getattr(source, 'raw', source), io.FileIO):
+        return False
+    try:
+        return stat.S_ISREG(os.fstat(source.fileno()).st_mode)
+    except (OSError, ValueError):
+        return False
+
+
+def write_all(target, data):
+    """
+    Write all of *data* (a bytes-like object) to *target*. Unlike
+    :meth:`io.RawIOBase.write`, this copes with short writes, which is
+    important when writing large buffers to unbuffered streams (like the
+    socket writer of :class:`http.server.StreamRequestHandler`).
+    """
+    with memoryview(data) as view:
+        while view:
+            n = target.write(view)
+            if n is None or n >= len(view):
+                break
+            view = view[n:]
+
+
+def write_vectored(target, buffers):
+    """
+    Write all the bytes-like objects in *buffers* to *target*, without
+    concatenating them. If *target* is a socket supporting
+    :meth:`~socket.socket.sendmsg`, this is used to send the buffers in as
+    few system calls as possible. If *target* has a ``writev`` method (like
+    :class:`~blinkenxmas.httpd.AsyncWriter`), the buffers are passed to it.
+    Otherwise, each buffer is written with :func:`write_all`.
+    """
+    if hasattr(target, 'sendmsg'):
+        views = [memoryview(buf).cast('B') for buf in buffers]
+        views = [view for view in views if view]
+        while views:
+            n = target.sendmsg(views[:IOV_MAX])
+            while views and n >= len(views[0]):
+                n -= len(views.pop(0))
+            if n:
+                views[0] = views[0][n:]
+    elif hasattr(target, 'writev'):
+        target.writev(buffers)
+    else:
+        for buf in buffers:
+            write_all(target, buf)
+
+
+class MemoryReader(io.RawIOBase):
+    """
+    A read-only, seekable stream over the bytes-like object *data*, which is
+    never copied. Unlike :class:`io.BytesIO`, :meth:`getbuffer` does not copy
+    an immutable :class:`bytes` object either, so the content may be sent by
+    :func:`transfer` without any copying at all.
+    """
+    def __init__(self, data):
+        super().__init__()
+        self._data = memoryview(data).cast('B')
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def getbuffer(self):
+        "Return a :class:`memoryview` of the entire content."
+        return self._data[:]
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._data) + offset
+        else:
+            raise ValueError(f'invalid whence ({whence})')
+        if pos < 0:
+            raise ValueError(f'negative seek position {pos}')
+        self._pos = pos
+        return pos
+
+    def readinto(self, buf):
+        with memoryview(buf).cast('B') as view:
+            chunk = self._data[self._pos:self._pos + len(view)]
+            n = len(chunk)
+            view[:n] = chunk
+        self._pos += n
+        return n
+
+
+class IterReader(io.RawIOBase):
+    """
+    A read-only stream over the chunks yielded by *iterable* (for example, a
+    generator), which may be :class:`str` (which will be encoded as UTF-8) or
+    bytes-like objects. This permits a response body to be generated
+    incrementally; see :class:`HTTPResponse`.
+    """
+    def __init__(self, iterable):
+        super().__init__()
+        self._iter = iter(iterable)
+        self._chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self._chunk:
+            try:
+                chunk = next(self._iter)
+            except StopIteration:
+                return 0
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            self._chunk = memoryview(chunk).cast('B')
+        with memoryview(buf).cast('B') as view:
+            n = min(len(view), len(self._chunk))
+            view[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            with suppress(AttributeError):
+                self._iter.close()
+        super().close()
+
+
+class ChunkedWriter(io.RawIOBase):
+    """
+    A write-only stream which writes everything written to it to *target*
+    with the HTTP/1.1 "chunked" transfer-coding. Closing the stream writes
+    the final, empty chunk, but does not close *target*.
+    """
+    def __init__(self, target):
+        super().__init__()
+        self._target = target
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        with memoryview(b) as view:
+            n = view.nbytes
+            if n:
+                write_vectored(self._target, [b'%x\r\n' % n, view, b'\r\n'])
+        return n
+
+    def close(self):
+        if not self.closed:
+            write_all(self._target, b'0\r\n\r\n')
+        super().close()
+
+
+def iterencode_array(items, *, chunk_size=COPY_BUFSIZE):
+    """
+    Yields the JSON encoding of a list of *items* (which may be any iterable,
+    including a generator) as a series of :class:`str` chunks of roughly
+    *chunk_size* characters. Unlike :func:`json.dumps`, this never requires
+    the entire list, or its entire encoding, in memory at once.
+    """
+    buf = ['[']
+    size = 1
+    sep = ''
+    for item in items:
+        encoded = sep + json.dumps(item)
+        sep = ','
+        buf.append(encoded)
+        size += len(encoded)
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    buf.append(']')
+    yield ''.join(buf)
+
+
+class JSONReader:
+    """
+    An incremental decoder for the JSON document read from the file-like
+    *source* in chunks of (at least) *chunk_size* bytes. This permits a large
+    array (or object) to be processed one element (or member) at a time with
+    :meth:`items` (or :meth:`members`), without ever holding the entire
+    document, or its decoding, in memory at once. For example::
+
+        reader = JSONReader(source)
+        total = sum(reader.items())
+        reader.end()
+
+    All methods raise :exc:`ValueError` if the document is malformed.
+    """
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, source, *, chunk_size=COPY_BUFSIZE):
+        self._source = source
+        self._chunk_size = chunk_size
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        # Reads more of the source, discarding what has been consumed from
+        # the buffer, and returns False if the source was already exhausted.
+        # At least as much as is unconsumed is read, so that repeated attempts
+        # to decode a large value take linear, not quadratic, time
+        if self._eof:
+            return False
+        data = self._source.read(
+            max(self._chunk_size, len(self._buf) - self._pos))
+        self._eof = not data
+        self._buf = self._buf[self._pos:] + self._utf8.decode(
+            data, final=self._eof)
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """
+        Returns the next character (other than whitespace) of the document,
+        without consuming it, or a blank string at the end of the document.
+        """
+        while True:
+            self._pos = self.whitespace.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError(
+                f'expected one of {chars!r} but found {c or "end"!r}')
+        self._pos += 1
+        return c
+
+    def value(self):
+        """
+        Decodes and returns the next complete value of the document.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+            else:
+                # A value which ends at the end of the buffer may be
+                # incomplete (e.g. a number)
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+                self._fill()
+
+    def items(self):
+        """
+        Yields each element of the array which is next in the document.
+        """
+        self._expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self.value()
+            if self._expect(',]') == ']':
+                return
+
+    def members(self):
+        """
+        Yields the key of each member of the object which is next in the
+        document. Before the next key is requested, the caller *must* consume
+        the value of the member with :meth:`value` or :meth:`items`.
+        """
+        self._expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            if self.peek() != '"':
+                raise ValueError('expected an object key')
+            key = self.value()
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def end(self):
+        """
+        Raises :exc:`ValueError` if anything other than whitespace remains in
+        the document.
+        """
+        if self.peek():
+            raise ValueError('extra data after JSON document')
+
+
+class BoundedReader(io.RawIOBase):
+    """
+    A read-only stream which reads at most *limit* bytes from *source*, then
+    reports end-of-file. This is useful for streaming a request body (of
+    known Content-Length) to a consumer which expects to read until EOF,
+    without reading beyond the body into the next request on the connection.
+    """
+    def __init__(self, source, limit):
+        super().__init__()
+        self._source = source
+        self._remaining = limit
+
+    @property
+    def remaining(self):
+        "The number of bytes that remain to be read from the source."
+        return self._remaining
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        with memoryview(buf) as view:
+            with view[:min(len(view), self._remaining)] as limited:
+                if not limited:
+                    return 0
+                n = self._source.readinto(limited)
+        self._remaining -= n
+        return n
+
+
+class CountingReader(io.RawIOBase):
+    """
+    A read-only stream which passes reads through to *source* (which may be
+    buffered; this adds no buffering of its own), counting the bytes read in
+    :attr:`consumed`. This is used to determine whether a handler has read
+    the entire body of a request, and hence whether the connection may be
+    used for another request.
+    """
+    def __init__(self, source):
+        super().__init__()
+        self._source = source
+        self._consumed = 0
+
+    @property
+    def consumed(self):
+        "The number of bytes read from the source."
+        return self._consumed
+
+    def readable(self):
+        return True
+
+    def readline(self, size=-1):
+        line = self._source.readline(size)
+        self._consumed += len(line)
+        return line
+
+    def readinto(self, buf):
+        n = self._source.readinto(buf)
+        self._consumed += n
+        return n
+
+    def read(self, size=-1):
+        data = self._source.read(size)
+        self._consumed += len(data)
+        return data
+
+
+class LRUCache:
+    """
+    A thread-safe mapping of at most *maxsize* items. When full, storing a
+    new item discards the least recently used item. A *maxsize* of 0 disables
+    the cache entirely; nothing stored in it is retained.
+    """
+    def __init__(self, maxsize=128):
+        if maxsize < 0:
+            raise ValueError(f'invalid maxsize: {maxsize}')
+        self._lock = Lock()
+        self._items = OrderedDict()
+        self.maxsize = maxsize
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def get(self, key, default=None):
+        """
+        Return the item stored under *key*, marking it as the most recently
+        used, or *default* if there is no such item.
+        """
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+
+    def set(self, key, value):
+        """
+        Store *value* under *key*, discarding the least recently used item if
+        the cache is full.
+        """
+        if self.maxsize:
+            with self._lock:
+                self._items[key] = value
+                self._items.move_to_end(key)
+                while len(self._items) > self.maxsize:
+                    self._items.popitem(last=False)
+
+    def clear(self):
+        "Discard all items in the cache."
+        with self._lock:
+            self._items.clear()
+
+
+def parse_accept(s):
+    """
+    Parse the value, *s*, of an HTTP Accept-style header (e.g.
+    "Accept-Encoding: gzip;q=1.0, identity; q=0.5, *;q=0") into a
+    :class:`dict` mapping each (lower-cased) token to its quality value as a
+    :class:`float`.
+    """
+    result = {}
+    for item in s.split(','):
+        try:
+            token, attrs = parse_content_value(item)
+        except ValueError:
+            continue
+        if token:
+            try:
+                quality = float(attrs.get('q', 1))
+            except ValueError:
+                quality = 0.0
+            result[token.lower()] = quality
+    return result
+
+
+def accepts_encoding(s, coding):
+    """
+    Returns :data:`True` if the value, *s*, of an "Accept-Encoding" header
+    permits the content-*coding* (e.g. "gzip").
+    """
+    accepted = parse_accept(s)
+    return accepted.get(coding, accepted.get('*', 0.0)) > 0
+
+
+def match_etag(etag, if_none_match):
+    """
+    Returns :data:`True` if the entity-tag *etag* (quoted, and optionally
+    prefixed with ``W/``) matches any of the entity-tags in *if_none_match*
+    (the value of an "If-None-Match" header). As specified for that header,
+    the weak comparison is used; the ``W/`` prefix of either side is ignored.
+    """
+    def opaque(tag):
+        tag = tag.strip()
+        return tag[2:] if tag.startswith('W/') else tag
+
+    if if_none_match.strip() == '*':
+        return True
+    etag = opaque(etag)
+    return any(opaque(tag) == etag for tag in if_none_match.split(','))
+
+
 def parse_content_value(s):
     """
     Parse the content of an HTTP Content-* header's value, *s*. The result is a
@@ -254,6 +778,27 @@ class FixedBuffer:
         self._valid += read
 
 
+def multipart_boundary(s):
+    """
+    Return the boundary marker (as :class:`bytes`, excluding the leading
+    dashes) of the multipart/* Content-Type, *s*. Raises :exc:`ValueError` if
+    *s* is not a multipart/* type, or if its boundary is missing or invalid.
+    """
+    value, attrs = parse_content_value(s)
+    mime_type, mime_subtype = value.split('/', 1)
+    if mime_type != 'multipart':
+        raise ValueError(
+            f'MIME-type {s!r} is not a multipart/*')
+    try:
+        if not 1 <= len(attrs['boundary']) <= 70:
+            raise ValueError(
+                f'Boundary definition in {s!r} has a silly length')
+        encoding = attrs.get('charset', 'utf-8')
+        return attrs['boundary'].encode(encoding)
+    except KeyError:
+        raise ValueError(f'Missing boundary definition in {s!r}')
+
+
 def split_multipart(request):
     """
     Given *request*, a :class:`~blinkenxmas.httpd.HTTPRequestHandler`, which
@@ -262,23 +807,8 @@ def split_multipart(request):
     a :class:`HTTPHeaders` instance, and the *content* as a file-like object.
     """
 
-    def get_boundary():
-        s = request.headers.get('Content-Type', '')
-        value, attrs = parse_content_value(s)
-        mime_type, mime_subtype = value.split('/', 1)
-        if mime_type != 'multipart':
-            raise ValueError(
-                f'MIME-type {s!r} is not a multipart/*')
-        try:
-            if not 1 <= len(attrs['boundary']) <= 70:
-                raise ValueError(
-                    f'Boundary definition in {s!r} has a silly length')
-            encoding = attrs.get('charset', 'utf-8')
-            return attrs['boundary'].encode(encoding)
-        except KeyError:
-            raise ValueError(f'Missing boundary definition in {s!r}')
-
-    boundary = b'--' + get_boundary()
+    boundary = b'--' + multipart_boundary(
+        request.headers.get('Content-Type', ''))
     buffer = FixedBuffer(
         source=request.rfile,
         read_limit=int(request.headers.get('Content-Length', '0')))
@@ -294,21 +824,28 @@ def split_multipart(request):
             # No multipart boundary found in the buffer. If content is None,
             # we've yet to find a multipart boundary so everything so far is
             # preamble and can be ignored. Otherwise...
-            if content is not None:
-                if buffer.valid < len(boundary):
-                    # This is the degenerate case where we've reached the end
-                    # of the stream but there's no final marker; assume all
-                    # remaining content is part of the final part
-                    content.write(buffer.data)
+            if content is None:
+                # Keep len(boundary)-1 bytes in case we had a boundary prefix
+                # at the end; if nothing more can be read, there's no body
+                keep = min(buffer.valid, len(boundary) - 1)
+                buffer.discard(buffer.valid - keep)
+                buffer.fill()
+                if buffer.valid == keep:
                     break
-                else:
-                    # Otherwise, dump the buffer to the content, and keep
-                    # len(boundary)-1 bytes within the buffer in case we had a
-                    # boundary prefix at the end
-                    keep = len(boundary) - 1
-                    content.write(buffer.data[:-keep])
-                    buffer.discard(buffer.valid - keep)
-                    buffer.fill()
+            elif buffer.valid < len(boundary):
+                # This is the degenerate case where we've reached the end
+                # of the stream but there's no final marker; assume all
+                # remaining content is part of the final part
+                content.write(buffer.data)
+                break
+            else:
+                # Otherwise, dump the buffer to the content, and keep
+                # len(boundary)-1 bytes within the buffer in case we had a
+                # boundary prefix at the end
+                keep = len(boundary) - 1
+                content.write(buffer.data[:-keep])
+                buffer.discard(buffer.valid - keep)
+                buffer.fill()
         else:
             if content is not None:
                 content.write(buffer.data[:index])
@@ -354,6 +891,87 @@ def split_multipart(request):
         yield headers, content
 
 
+# Headers of a part are almost always a couple of short, ASCII lines; anything
+# else (folded lines, non-ASCII names, etc.) is left to the email parser
+_PART_HEADER = re.compile(rb'([!#-\'*+.0-9A-Z^-z|~-]+):[ \t]*(.*?)[ \t]*')
+
+def parse_part_headers(data):
+    """
+    Parse *data*, the :class:`bytes` of the headers of a part of a multipart
+    body (including the terminating blank line), returning a
+    :class:`HTTPHeaders` instance.
+
+    Simple headers are split directly; if *data* contains anything else (e.g.
+    folded lines, or non-ASCII bytes), it is handed to the same
+    :class:`email.parser.BytesHeaderParser` that :func:`split_multipart` uses.
+    """
+    headers = HTTPHeaders()
+    if data.isascii():
+        for line in data.split(b'\r\n'):
+            if line:
+                match = _PART_HEADER.fullmatch(line)
+                if not match:
+                    break
+                name, value = match.groups()
+                headers[name.decode('ascii')] = value.decode('ascii')
+        else:
+            return headers
+    parser = email.parser.BytesHeaderParser(policy=email.policy.HTTP)
+    return HTTPHeaders(parser.parsebytes(data).items())
+
+
+def split_multipart_bytes(body, boundary):
+    """
+    Split *body*, the complete :class:`bytes` of a multipart body whose
+    boundary marker (as returned by :func:`multipart_boundary`) is *boundary*,
+    yielding each part as a separate (headers, content) tuple. The *headers*
+    are returned as a :class:`HTTPHeaders` instance, and the *content* as
+    :class:`bytes`.
+
+    This is equivalent to :func:`split_multipart`, but as the whole body is
+    already in memory, it is split in a single pass without copying it through
+    a buffer or into temporary files. This makes it a good deal faster for the
+    short bodies of typical forms (see :data:`SMALL_MULTIPART_SIZE`).
+    """
+    delimiter = b'--' + boundary
+    pos = body.find(delimiter)
+    if pos == -1:
+        # Nothing but preamble
+        return
+    pos += len(delimiter)
+    # Only the first boundary is permitted to have no CR-LF prefix, as in
+    # split_multipart
+    delimiter = b'\r\n' + delimiter
+    while True:
+        # Optional linear white-space is permitted after the boundary
+        while body[pos:pos + 1] in (b' ', b'\t'):
+            pos += 1
+        if len(body) - pos < 2 or body[pos:pos + 2] == b'--':
+            return
+        if body[pos:pos + 2] != b'\r\n':
+            raise ValueError('Invalid boundary found')
+        index = body.find(b'\r\n\r\n', pos)
+        if index == -1:
+            raise ValueError('Unterminated part headers')
+        elif index > pos:
+            headers = parse_part_headers(body[pos + 2:index + 4])
+        else:
+            headers = HTTPHeaders()
+        start = index + 4
+        pos = body.find(delimiter, start)
+        if pos == -1:
+            # The degenerate case where there's no final marker; assume all
+            # remaining content is part of the final part
+            yield headers, body[start:]
+            return
+        yield headers, body[start:pos]
+        pos += len(delimiter)
+
+
+# Bodies up to this size are read whole and split by split_multipart_bytes;
+# anything larger (or of unknown length) is spooled by split_multipart
+SMALL_MULTIPART_SIZE = SPLIT_MULTIPART_BUFSIZE
+
 def parse_formdata(request):
     """
     Given *request*, a :class:`~blinkenxmas.httpd.HTTPRequestHandler`, which
@@ -365,12 +983,23 @@ def parse_formdata(request):
     values respectively. Anything with a "filename" attribute, or which exceeds
     a relatively large string size (currently 64KB) will be returned as a
     file-like object.
+
+    Bodies no larger than :data:`SMALL_MULTIPART_SIZE` are read whole and split
+    with :func:`split_multipart_bytes`; larger bodies are split with
+    :func:`split_multipart`, which spools large parts to temporary files.
     """
-    value, attrs = parse_content_value(request.headers['Content-Type'])
+    content_type = request.headers['Content-Type']
+    value, attrs = parse_content_value(content_type)
     if value != 'multipart/form-data':
         raise ValueError(f'Invalid Content-Type: {value!r}')
+    length = int(request.headers.get('Content-Length', '0'))
+    if 0 < length <= SMALL_MULTIPART_SIZE:
+        parts = split_multipart_bytes(
+            request.rfile.read(length), multipart_boundary(content_type))
+    else:
+        parts = split_multipart(request)
     query = {}
-    for headers, content in split_multipart(request):
+    for headers, content in parts:
         try:
             disposition = headers['Content-Disposition']
         except KeyError:
@@ -385,6 +1014,18 @@ def parse_formdata(request):
                 continue
             mime_type, attrs = parse_content_value(
                 headers.get('Content-Type', 'text/plain'))
+            if isinstance(content, bytes):
+                if 'filename' not in attrs:
+                    if mime_type.startswith('text/'):
+                        # Decode as the TextIOWrapper below would, including
+                        # its translation of newlines
+                        query[name] = content.decode(
+                            attrs.get('charset', 'utf-8'), errors='ignore'
+                        ).replace('\r\n', '\n').replace('\r', '\n')
+                    else:
+                        query[name] = content
+                    continue
+                content = io.BytesIO(content)
             is_short = content.seek(0, io.SEEK_END) <= SPLIT_MULTIPART_BUFSIZE
             content.seek(0)
             if mime_type.startswith('text/'):
@@ -442,13 +1083,21 @@ class HTTPResponse:
         * A file-like object in which case it will be used directly as the
           value of :attr:`stream`.
 
-        * A :class:`str`. This will be converted to a :class:`io.BytesIO`
+        * A :class:`str`. This will be converted to a :class:`MemoryReader`
           stream with UTF-8 encoding.
 
         * A :class:`bytes` string. This will be used verbatim as the content of
-          a :class:`io.BytesIO` stream.
+          a :class:`MemoryReader` stream (which is never copied).
+
+        * A :class:`pathlib.Path`. This will be opened as a binary file (which
+          will be sent with :func:`os.sendfile` where possible).
 
-        * A :class:`pathlib.Path`. This will be opened as a binary file.
+        * Any other iterable (for example, a generator) of :class:`str` or
+          :class:`bytes` chunks. This will be wrapped in an
+          :class:`IterReader`. As the length of such a body is unknown, it
+          will be sent with the "chunked" transfer-coding to HTTP/1.1
+          clients; otherwise the connection is closed at the end of the body.
+          See also :func:`iterencode_array`.
 
     :param http.HTTPStatus status_code:
         The HTTP status code of the response. Expected to be a
@@ -488,28 +1137,60 @@ class HTTPResponse:
         be determined automatically (if possible) from the last modification
         date of the file containing the body content.
 
+    :param str etag:
+        The strong entity-tag of the response body, without quotes. This
+        should be given when the caller can cheaply identify the exact content
+        of the body (e.g. from a change counter); see also
+        :func:`not_modified`. If not specified, a weak entity-tag will be
+        derived from the content of seekable bodies with a *filename*. If
+        :data:`False`, no entity-tag will be sent.
+
+    :param bool compress:
+        If :data:`True`, and the client accepts it, the body will be gzip
+        compressed as it is sent. As the compressed length is unknown in
+        advance, this implies the same handling as an iterable body, and
+        disables range requests.
+
     :param dict headers:
         Additional headers to include in the response.
+
+    Weak entity-tags derived from bodies are remembered in :attr:`etags`, an
+    :class:`LRUCache` keyed by (filename, length, last-modified). If
+    :attr:`background_hash` is non-zero, regular files of at least that many
+    bytes are not hashed while the request waits; they are hashed in a
+    background thread instead, and responses sent before that finishes simply
+    omit the entity-tag.
     """
-    etags = {}
+    etags = LRUCache(256)
+    background_hash = 0
+    _hash_lock = Lock()
+    _hashing = set()
+    _hash_executor = None
 
     def __init__(self, request, body=None, *, status_code=HTTPStatus.OK,
                  content_length=None, accept_ranges=True, filename=None,
                  mime_type=None, encoding=None, last_modified=None,
-                 etag=None, headers=None):
+                 etag=None, compress=False, headers=None):
         self.request = request
         self.accept_ranges = accept_ranges
+        strong = isinstance(etag, str)
         self.status_code = HTTPStatus(status_code)
         self._headers = HTTPHeaders(headers)
+        self._chunked = False
+        self._gzip = False
 
         if isinstance(body, str):
-            self.stream = io.BytesIO(body.encode('utf-8'))
+            self.stream = MemoryReader(body.encode('utf-8'))
         elif isinstance(body, bytes):
-            self.stream = io.BytesIO(body)
+            self.stream = MemoryReader(body)
         elif isinstance(body, Path):
             self.stream = body.open('rb')
             if filename is None:
                 filename = str(body)
+        elif body is not None and not hasattr(body, 'read'):
+            self.stream = IterReader(body)
+            if content_length is None:
+                self.accept_ranges = False
         else:
             self.stream = body
             if filename is None:
@@ -533,8 +1214,22 @@ class HTTPResponse:
                 if etag is None and filename is not None:
                     etag = self._get_etag(
                         (filename, content_length, last_modified))
-                elif etag is False:
-                    etag = None
+                    if etag is not None:
+                        etag = f'W/"{etag}"'
+                    # Mark the tag as already formatted
+                    strong = False
+
+        if compress and self.stream is not None:
+            self.headers['Vary'] = 'Accept-Encoding'
+            if encoding is None and accepts_encoding(
+                    request.headers.get('Accept-Encoding', ''), 'gzip'):
+                self._gzip = True
+                self.accept_ranges = False
+                encoding = 'gzip'
+                content_length = None
+                # Each representation requires a distinct strong entity-tag
+                if strong:
+                    etag = f'{etag}-gzip'
 
         if content_length is not None:
             self.headers['Content-Length'] = content_length
@@ -545,8 +1240,10 @@ class HTTPResponse:
         if last_modified is not None:
             self.headers['Last-Modified'] = eut.format_datetime(
                 last_modified, usegmt=True)
+        if etag is False:
+            etag = None
         if etag is not None:
-            self.headers['ETag'] = f'W/"{etag}"'
+            self.headers['ETag'] = f'"{etag}"' if strong else etag
 
     def __repr__(self):
         headers = '\n'.join(
@@ -585,33 +1282,69 @@ class HTTPResponse:
     def _check_etag(self):
         try:
             etag = self.headers['ETag']
-            if_none_match = {
-                tag.strip()
-                for tag in self.request.headers.get(
-                    'If-None-Match', '').split(',')
-            }
         except KeyError:
             return False
         else:
-            return etag in if_none_match
+            return match_etag(
+                etag, self.request.headers.get('If-None-Match', ''))
 
     def _get_etag(self, key):
+        result = HTTPResponse.etags.get(key)
+        if result is not None:
+            return result
+        if self.stream is None or not self.stream.seekable():
+            return None
+        filename, content_length, last_modified = key
+        if (
+            self.background_hash and content_length >= self.background_hash
+            and is_regular_file(self.stream)
+        ):
+            self._hash_later(key)
+            return None
+        pos = self.stream.tell()
+        sha = hashlib.sha1()
+        while True:
+            buf = self.stream.read(65536)
+            if not buf:
+                break
+            sha.update(buf)
+        self.stream.seek(pos)
+        result = base64.b64encode(sha.digest()).decode("ascii")
+        HTTPResponse.etags.set(key, result)
+        return result
+
+    def _hash_later(self, key):
+        with HTTPResponse._hash_lock:
+            if key in HTTPResponse._hashing:
+                return
+            if HTTPResponse._hash_executor is None:
+                # Created on first use so that no thread exists before
+                # bxweb forks its workers (see blinkenxmas.prefork)
+                HTTPResponse._hash_executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='etag')
+            HTTPResponse._hashing.add(key)
+            # The duplicate descriptor outlives the response's stream, and as
+            # it's only read with pread, the stream's position is unaffected
+            fd = os.dup(self.stream.fileno())
+            HTTPResponse._hash_executor.submit(
+                HTTPResponse._hash_file, key, fd, self.stream.tell())
+
+    @staticmethod
+    def _hash_file(key, fd, pos):
         try:
-            return HTTPResponse.etags[key]
-        except KeyError:
-            if self.stream is None or not self.stream.seekable():
-                return None
-            pos = self.stream.tell()
             sha = hashlib.sha1()
             while True:
-                buf = self.stream.read(65536)
+                buf = os.pread(fd, COPY_BUFSIZE, pos)
                 if not buf:
                     break
                 sha.update(buf)
-            self.stream.seek(pos)
-            result = base64.b64encode(sha.digest()).decode("ascii")
-            HTTPResponse.etags[key] = result
-            return result
+                pos += len(buf)
+            HTTPResponse.etags.set(
+                key, base64.b64encode(sha.digest()).decode("ascii"))
+        finally:
+            os.close(fd)
+            with HTTPResponse._hash_lock:
+                HTTPResponse._hashing.discard(key)
 
     def check_cached(self):
         """
@@ -627,10 +1360,13 @@ class HTTPResponse:
         cached = (
             self.request.command in ('GET', 'HEAD') and
             self.status_code.value == 200 and
-            # NOTE: Technically, this is wrong. ETag takes strict precedence
-            # over Last-Modified; if both are present, Last-Modified should be
-            # ignored. But currently we don't use ETag so it's irrelevant
-            (self._check_etag() or self._check_last_modified())
+            # If-None-Match takes strict precedence over If-Modified-Since; if
+            # both are present, the latter is ignored
+            (
+                self._check_etag()
+                if 'If-None-Match' in self.request.headers else
+                self._check_last_modified()
+            )
         )
         if cached:
             self.status_code = HTTPStatus.NOT_MODIFIED
@@ -741,8 +1477,10 @@ class HTTPResponse:
                     r = self.headers['Content-Range'][0]
                     value = len(r)
                 elif num_ranges > 1:
-                    # Skip if multipart; unknown in this case
-                    continue
+                    value = sum(
+                        len(self._part_header(r)) + len(r) + 2
+                        for r in self.headers['Content-Range']
+                    ) + len(b'--BOUNDARY--\r\n')
             elif key == 'Content-Type':
                 if num_ranges > 1:
                     # Skip; we'll force this later (in case Content-Type
@@ -752,8 +1490,52 @@ class HTTPResponse:
         if num_ranges > 1:
             self.request.send_header(
                 'Content-Type', 'multipart/byteranges; boundary=BOUNDARY')
+        if (
+            self.stream is None and
+            'Content-Length' not in self.headers and
+            self.status_code.value >= 200 and
+            self.status_code not in (
+                HTTPStatus.NO_CONTENT, HTTPStatus.NOT_MODIFIED)
+        ):
+            # Bodiless responses (typically errors) must still declare their
+            # length, or a persistent connection cannot be re-used
+            self.request.send_header('Content-Length', 0)
+        if (
+            self.stream is not None and
+            'Content-Length' not in self.headers and
+            self.request.command != 'HEAD'
+        ):
+            # The length of the body is unknown
+            if (
+                getattr(self.request, 'request_version', '') >= 'HTTP/1.1' and
+                self.request.protocol_version >= 'HTTP/1.1'
+            ):
+                self._chunked = True
+                self.request.send_header('Transfer-Encoding', 'chunked')
+            else:
+                self.request.close_connection = True
         self.request.end_headers()
 
+    def _part_header(self, r):
+        # The boundary and headers preceding range *r* of a multipart response
+        lines = ['--BOUNDARY']
+        if 'Content-Type' in self.headers:
+            lines.append(f'Content-Type: {self.headers["Content-Type"]}')
+        lines.append(
+            f'Content-Range: bytes {r.start}-{r.stop - 1}/'
+            f'{self.headers["Content-Length"]}')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    def _target(self):
+        # Regular files are written straight to the client's socket, where
+        # there is one, to permit transfer to use sendfile. As the handler's
+        # wfile is (by default) unbuffered this cannot re-order output, but
+        # flush it regardless in case the handler has altered that
+        if self._chunked or self._gzip or not is_regular_file(self.stream):
+            return self.request.wfile
+        self.request.wfile.flush()
+        return getattr(self.request, 'connection', None) or self.request.wfile
+
     def send_body(self):
         """
         Transmit the response body to the client.
@@ -766,20 +1548,57 @@ class HTTPResponse:
                 if self.status_code == HTTPStatus.PARTIAL_CONTENT
                 and isinstance(self.headers['Content-Range'], list) else 0)
             if num_ranges == 0:
-                transfer(self.stream, self.request.wfile)
+                with ExitStack() as stack:
+                    # Transfer- and content-codings are applied in this order
+                    # and so must be closed (to finalize them) in the reverse
+                    target = self._target()
+                    if self._chunked:
+                        target = stack.enter_context(ChunkedWriter(target))
+                    if self._gzip:
+                        target = stack.enter_context(gzip.GzipFile(
+                            fileobj=target, mode='wb', compresslevel=6,
+                            mtime=0))
+                    transfer(self.stream, target)
             elif num_ranges == 1:
-                transfer(self.stream, self.request.wfile,
+                transfer(self.stream, self._target(),
                          byterange=self.headers['Content-Range'][0])
             else:
-                length = self.headers['Content-Length']
+                # NOTE: The length of everything written here is calculated
+                # in send_headers
                 for r in self.headers['Content-Range']:
-                    self.request.wfile.write(b'--BOUNDARY\r\n')
-                    if 'Content-Type' in self.headers:
-                        self.request.send_header(
-                            'Content-Type', self.headers['Content-Type'])
-                    self.request.send_header(
-                        'Content-Range', f'bytes {r.start}-{r.stop - 1}/{length}')
-                    self.request.end_headers()
-                    transfer(self.stream, self.request.wfile, byterange=r)
-                    self.request.wfile.write(b'\r\n')
-                self.request.wfile.write(b'--BOUNDARY--\r\n')
+                    write_all(self.request.wfile, self._part_header(r))
+                    transfer(self.stream, self._target(), byterange=r)
+                    write_all(self.request.wfile, b'\r\n')
+                write_all(self.request.wfile, b'--BOUNDARY--\r\n')
+
+
+def not_modified(request, etag, *, compress=False):
+    """
+    If the strong entity-tag *etag* (unquoted, as accepted by
+    :class:`HTTPResponse`) matches the "If-None-Match" header of *request*,
+    returns a :attr:`~http.HTTPStatus.NOT_MODIFIED` :class:`HTTPResponse`.
+    Otherwise, returns :data:`None`.
+
+    This permits routes which can cheaply calculate the entity-tag of their
+    response to avoid generating the body at all when the client's cached copy
+    is current, for example::
+
+        etag = f'presets-{request.store.presets_version}'
+        return not_modified(request, etag) or HTTPResponse(
+            request, body=..., etag=etag)
+
+    If the response will be constructed with *compress*, this must be given
+    too, as the compressed representation has a distinct entity-tag.
+    """
+    headers = None
+    if compress:
+        headers = {'Vary': 'Accept-Encoding'}
+        if accepts_encoding(
+                request.headers.get('Accept-Encoding', ''), 'gzip'):
+            etag = f'{etag}-gzip'
+    if request.command in ('GET', 'HEAD') and match_etag(
+            f'"{etag}"', request.headers.get('If-None-Match', '')):
+        return HTTPResponse(
+            request, status_code=HTTPStatus.NOT_MODIFIED, etag=etag,
+            headers=headers)
+    return None
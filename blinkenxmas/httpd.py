@@ -1,15 +1,27 @@
+import io
+import os
 import re
+import gzip
 import json
+import base64
 import socket
+import hashlib
 import logging
+import asyncio
 import mimetypes
+import socketserver
 import datetime as dt
+from time import monotonic
 import urllib.parse
+import http.client
 from http import HTTPStatus
 from textwrap import dedent
+from pathlib import Path
 from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from collections import namedtuple, deque
-from threading import Thread, Lock
+from threading import Thread, Lock, Event, Condition
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError
+from functools import partial
 from contextlib import suppress
 from inspect import signature
 
@@ -31,10 +43,39 @@ except ImportError:
 import docutils
 import docutils.core
 from chameleon import PageTemplate
+from chameleon.loader import ModuleLoader
 from colorzero import Color
 
-from . import cameras, store, calibrate
-from .http import HTTPResponse, parse_formdata, parse_content_value
+from . import store, metrics, jobs
+from .http import (
+    HTTPResponse, MemoryReader, BoundedReader, CountingReader, JSONReader,
+    LRUCache, parse_formdata, parse_content_value, accepts_encoding,
+)
+
+
+REQUEST_SECONDS = metrics.Histogram(
+    'blinkenxmas_http_request_duration_seconds',
+    'Time taken to handle HTTP requests, including sending the response',
+    ('route', 'method'))
+RESPONSE_BYTES = metrics.Histogram(
+    'blinkenxmas_http_response_size_bytes',
+    'Size of HTTP response bodies (where the length was known in advance)',
+    ('route', 'method'), buckets=metrics.SIZE_BUCKETS)
+RESPONSES = metrics.Counter(
+    'blinkenxmas_http_responses_total',
+    'Number of HTTP responses sent',
+    ('route', 'method', 'status'))
+STARTUP_SECONDS = metrics.Gauge(
+    'blinkenxmas_startup_seconds',
+    'Time taken by each phase of start-up',
+    ('phase',))
+
+# Headers which apply to a single connection, and thus are not relayed by
+# HTTPRequestHandler.forward
+HOP_BY_HOP = {
+    'connection', 'keep-alive', 'proxy-connection', 'te', 'trailer',
+    'transfer-encoding', 'upgrade', 'expect',
+}
 
 
 def get_best_family(host, port):
@@ -55,6 +96,156 @@ def get_best_family(host, port):
     raise ValueError('invalid host and port combination')
 
 
+def route_regex(pattern, prefix=''):
+    """
+    Convert the route *pattern* (see :func:`route`) into a regular expression
+    string (without anchors). The names of the groups matching each
+    ``<section>`` are prefixed with *prefix*.
+    """
+    s = re.escape(pattern)
+    return re.sub(
+        r'<([A-Za-z_][A-Za-z0-9_]*)>', rf'(?P<{prefix}\1>[^/]+)', s)
+
+
+def first_segment(path):
+    """
+    Returns the first segment of the absolute *path* (the part between the
+    first and second slashes); this is the key by which :class:`Routes`
+    buckets its routes.
+    """
+    return path[1:].split('/', 1)[0]
+
+
+class Routes(dict):
+    """
+    A :class:`dict` mapping (compiled pattern, command) tuples to route
+    handlers, as populated by :func:`route`, which additionally provides
+    :meth:`dispatch` for efficiently finding the handlers matching a request.
+
+    Routes are bucketed by command and by the literal first segment of their
+    pattern (routes whose first segment is variable are added to every bucket
+    of their command). The routes within each bucket are combined into a
+    single regular expression so that the handler matching a request is found
+    with a dictionary lookup and a single regex match. The index is built
+    lazily on first use after any modification, so routes may be added or
+    removed at any time.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = Lock()
+        self._index = None
+
+    def _changed(self):
+        with self._lock:
+            self._index = None
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed()
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+    def pop(self, *args):
+        result = super().pop(*args)
+        self._changed()
+        return result
+
+    def popitem(self):
+        result = super().popitem()
+        self._changed()
+        return result
+
+    def setdefault(self, key, default=None):
+        result = super().setdefault(key, default)
+        self._changed()
+        return result
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._changed()
+
+    def copy(self):
+        return Routes(self)
+
+    def _build(self):
+        # Both literal and variable map to lists of (position, handler,
+        # pattern) tuples. Routes in variable (with a non-literal first
+        # segment) are merged into all buckets of the same command, in
+        # registration order
+        literal = {}
+        variable = {}
+        for position, ((pattern, command), handler) in enumerate(self.items()):
+            # Strip the anchors added by route; re.escape doesn't escape "/"
+            # so the first segment of the pattern is easily found
+            segment = first_segment(pattern.pattern[1:-1])
+            if '(?P<' in segment:
+                variable.setdefault(command, []).append(
+                    (position, handler, pattern))
+            else:
+                segment = re.sub(r'\\(.)', r'\1', segment)
+                literal.setdefault((command, segment), []).append(
+                    (position, handler, pattern))
+        index = {}
+        for (command, segment), entries in literal.items():
+            entries = sorted(entries + variable.get(command, []))
+            index[command, segment] = self._combine(entries)
+        for command, entries in variable.items():
+            index[command, None] = self._combine(entries)
+        return index
+
+    @staticmethod
+    def _combine(entries):
+        # Rename the groups in each pattern to prevent clashes between
+        # patterns, and wrap each pattern in its own group so the matching
+        # pattern can be found with lastgroup (each wrapper group is the last
+        # to close in its alternative)
+        handlers = []
+        alternatives = []
+        for n, (position, handler, pattern) in enumerate(entries):
+            source = re.sub(r'\(\?P<', f'(?P<r{n}_', pattern.pattern[1:-1])
+            alternatives.append(f'(?P<r{n}>{source})')
+            handlers.append((handler, pattern, [
+                (f'r{n}_{name}', name) for name in pattern.groupindex]))
+        return re.compile(f"^(?:{'|'.join(alternatives)})$"), handlers
+
+    def dispatch(self, command, path):
+        """
+        Yields (handler, kwargs) tuples for all routes matching the *command*
+        and *path*, in the order the routes were registered, where *kwargs* is
+        a mapping of the pattern's section names to their (still quoted)
+        values in *path*.
+        """
+        with self._lock:
+            if self._index is None:
+                self._index = self._build()
+            index = self._index
+        try:
+            combined, handlers = index[command, first_segment(path)]
+        except KeyError:
+            try:
+                combined, handlers = index[command, None]
+            except KeyError:
+                return
+        m = combined.match(path)
+        if m:
+            n = int(m.lastgroup[1:])
+            handler, pattern, groups = handlers[n]
+            yield handler, {name: m.group(group) for group, name in groups}
+            # Rarely, a handler returns None to defer to later routes (or
+            # static files and templates); only then do we fall back to
+            # testing the remaining routes in the bucket individually
+            for handler, pattern, groups in handlers[n + 1:]:
+                m = pattern.match(path)
+                if m:
+                    yield handler, m.groupdict()
+
+
 def route(pattern, command='GET'):
     """
     Decorator that associates a route with a function
@@ -87,10 +278,8 @@ def route(pattern, command='GET'):
             return HTTPResponse(request, body=f'Hello, {person.name}!')
     """
     def decorator(f):
-        s = re.escape(pattern)
-        s = re.sub(r'<([A-Za-z_][A-Za-z0-9_]*)>', r'(?P<\1>[^/]+)', s)
-        pattern_re = re.compile(f'^{s}$')
-        assert pattern_re not in HTTPRequestHandler.routes
+        pattern_re = re.compile(f'^{route_regex(pattern)}$')
+        assert (pattern_re, command) not in HTTPRequestHandler.routes
         HTTPRequestHandler.routes[(pattern_re, command)] = f
         if command == 'GET':
             # Anything registered for GET gets automatically associated with
@@ -100,6 +289,43 @@ def route(pattern, command='GET'):
     return decorator
 
 
+def owner_only(f):
+    """
+    Decorator that marks a route function as depending on state which only
+    the owner process holds in pre-fork mode (see :mod:`blinkenxmas.prefork`):
+    the user's messages, animation jobs, the camera, and calibration. Worker
+    processes forward requests for such routes to the owner (see
+    :meth:`HTTPRequestHandler.forward`). Outside pre-fork mode, this has no
+    effect.
+    """
+    f.owner_only = True
+    return f
+
+
+def streaming(f):
+    """
+    Decorator that marks a route function as streaming its response for an
+    indefinite period (server-sent events, camera previews, large exports).
+    :class:`AsyncHTTPServer` runs requests for such routes in a thread of
+    their own, rather than tying up one of its limited executor threads.
+    Under :class:`HTTPServer` (which already dedicates a thread to each
+    connection), this has no effect.
+    """
+    f.streaming = True
+    return f
+
+
+def large_body(f):
+    """
+    Decorator that marks a route function as accepting request bodies of any
+    size, exempting it from the configured ``max_body`` limit. This is only
+    appropriate for routes which stream the body (e.g. into the store) rather
+    than reading it into memory.
+    """
+    f.large_body = True
+    return f
+
+
 class Function(namedtuple('Function', (
         'name', 'description', 'function', 'params'))):
     """
@@ -112,8 +338,8 @@ class Function(namedtuple('Function', (
     .. attribute:: description
 
         An extended description of the animation detailing all the parameters
-        and the intended result. Typically derived from the function's
-        doc-string.
+        and the intended result. Typically a :class:`Description` derived from
+        the function's doc-string, which renders as HTML.
 
     .. attribute:: function
 
@@ -209,11 +435,15 @@ class ParamLEDPositions:
         LED was not detected during calibration (either because it is
         persistently hidden or defective) then it will not be included in the
         mapping.
+
+    The mapping is a copy of the positions at the time the animation was
+    requested, as animations are generated in a background thread (see
+    :mod:`blinkenxmas.jobs`).
     """
     __slots__ = ()
 
     def value(self, request):
-        return request.store.positions
+        return dict(request.store.positions)
 
 
 class ParamFPS:
@@ -227,12 +457,92 @@ class ParamFPS:
         return request.server.config.fps
 
 
+def render_rst(source):
+    """
+    Returns the HTML fragment rendered from the reStructuredText *source*
+    (typically an animation's doc-string, which is de-dented first).
+    """
+    overrides = {
+        'input_encoding':       'unicode',
+        'doctitle_xform':       False,
+        'initial_header_level': 2,
+        }
+    return docutils.core.publish_parts(
+        source=dedent(source), writer_name='html',
+        settings_overrides=overrides)['fragment']
+
+
+class Description:
+    """
+    The description of an animation, constructed from its reStructuredText
+    *doc*-string. Rendering the doc-string into HTML (with :func:`render_rst`)
+    is relatively slow, so it is deferred until the instance is first
+    converted to a :class:`str`, and the result is memoised.
+
+    If the :attr:`cache_dir` class attribute is set (by :class:`HTTPThread`
+    from the ``description_cache`` configuration setting), the rendered HTML
+    is also stored in that directory, named after a hash of the doc-string,
+    so that restarts need not render it again.
+    """
+    cache_dir = None
+
+    def __init__(self, doc):
+        self.doc = doc or ''
+        self._html = None
+        self._lock = Lock()
+
+    def __bool__(self):
+        return bool(self.doc)
+
+    def __str__(self):
+        with self._lock:
+            if self._html is None:
+                self._html = self._render()
+            return self._html
+
+    __html__ = __str__
+
+    @property
+    def cache_key(self):
+        """
+        The hash of the doc-string (and the version of docutils rendering it)
+        under which the rendered HTML is stored in :attr:`cache_dir`.
+        """
+        return hashlib.sha256(
+            f'{docutils.__version__}\0{self.doc}'.encode('utf-8')).hexdigest()
+
+    def _render(self):
+        if not self.doc:
+            return ''
+        path = None
+        if self.cache_dir:
+            path = Path(self.cache_dir) / f'{self.cache_key}.html'
+            with suppress(OSError):
+                return path.read_text(encoding='utf-8')
+        start = monotonic()
+        html = render_rst(self.doc)
+        logging.getLogger('httpd').info(
+            'Rendered description in %.1fms', (monotonic() - start) * 1000)
+        if path is not None:
+            # Write to a temporary file and rename it into place so that a
+            # concurrent reader never sees a partial file
+            temp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                temp.write_text(html, encoding='utf-8')
+                os.replace(temp, path)
+            except OSError:
+                with suppress(OSError):
+                    temp.unlink()
+        return html
+
+
 def animation(name, **params):
     """
     Decorates a function as an animation generator to be presented in the
     Create interface. The doc-string of the function is used as the description
     and is expected to be in reStructuredText format (which will be rendered
-    into HTML).
+    into HTML when first required; see :class:`Description`).
 
     Each of the parameters to the function must be defined as a keyword
     argument to the decorator which is associated with one of the parameter
@@ -268,23 +578,209 @@ def animation(name, **params):
             raise ValueError(
                 f'invalid parameter name(s) in animation function {f!r}: '
                 f'{", ".join(invalid_params)}')
-        if f.__doc__:
-            overrides = {
-                'input_encoding':       'unicode',
-                'doctitle_xform':       False,
-                'initial_header_level': 2,
-                }
-            html = docutils.core.publish_parts(
-                source=dedent(f.__doc__), writer_name='html',
-                settings_overrides=overrides)['fragment']
-        else:
-            html = ''
-        func = Function(name, html, f, params)
+        func = Function(name, Description(f.__doc__), f, params)
         HTTPRequestHandler.animations[f.__name__] = func
         return f
     return decorator
 
 
+def scan_resources(root, prefix=''):
+    """
+    Yields the path (relative to *root*, a :class:`~pathlib.Path` or
+    :class:`~importlib.resources.abc.Traversable`) of every file beneath
+    *root*, excluding Python byte-code caches.
+    """
+    for entry in root.iterdir():
+        if entry.is_dir():
+            if entry.name != '__pycache__':
+                yield from scan_resources(entry, f'{prefix}{entry.name}/')
+        else:
+            yield f'{prefix}{entry.name}'
+
+
+class StaticAsset(namedtuple('StaticAsset', (
+        'path', 'url', 'data', 'etag', 'gzip_data', 'gzip_etag', 'mime_type',
+        'last_modified'))):
+    """
+    A static file held in memory by :class:`HTTPRequestHandler`, as loaded by
+    :func:`load_static`.
+
+    .. attribute:: path
+
+        The path of the file, relative to the package data.
+
+    .. attribute:: url
+
+        The "fingerprinted" form of :attr:`path`, which includes a hash of the
+        file's content before its extension (e.g. "create.0123456789ab.js").
+        As the content at this path can never change, it may be cached
+        indefinitely.
+
+    .. attribute:: data
+
+        The content of the file as :class:`bytes`.
+
+    .. attribute:: etag
+
+        The strong entity-tag of :attr:`data`.
+
+    .. attribute:: gzip_data
+
+        The gzip-compressed content of the file, or :data:`None` if
+        compression was not worthwhile.
+
+    .. attribute:: gzip_etag
+
+        The strong entity-tag of :attr:`gzip_data`, or :data:`None`.
+
+    .. attribute:: mime_type
+
+        The MIME type of the file.
+
+    .. attribute:: last_modified
+
+        The timezone-aware :class:`~datetime.datetime` of the file's last
+        modification.
+    """
+
+
+class RenderedTemplate(namedtuple('RenderedTemplate', (
+    'body', 'etag', 'last_modified',
+))):
+    """
+    Represents the output of a rendered template, as stored in the output
+    cache of :class:`HTTPRequestHandler`.
+
+    .. attribute:: body
+
+        The rendered template, encoded as UTF-8 :class:`bytes`.
+
+    .. attribute:: etag
+
+        The strong entity-tag of :attr:`body`.
+
+    .. attribute:: last_modified
+
+        The timezone-aware :class:`~datetime.datetime` at which the template
+        was rendered.
+    """
+
+
+# Content types beyond text/* which are worth compressing
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+}
+
+def load_static(root, paths, default_modified):
+    """
+    Loads each of the *paths* (relative to *root*) into a :class:`StaticAsset`
+    returning a :class:`dict` mapping both the paths, and their fingerprinted
+    URLs, to their assets. Compressible content is additionally gzip'd, if
+    that saves a worthwhile amount of space. The *default_modified* timestamp
+    is used when a file's modification time cannot be determined.
+
+    As the entity-tags of all assets are computed here, at startup, no request
+    for a static file ever waits for its content to be hashed.
+    """
+    logger = logging.getLogger('httpd')
+    result = {}
+    start = monotonic()
+    for path in paths:
+        with (root / path).open('rb') as f:
+            data = f.read()
+            try:
+                last_modified = dt.datetime.fromtimestamp(
+                    os.fstat(f.fileno()).st_mtime, tz=dt.timezone.utc)
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                last_modified = default_modified
+        mime_type, encoding = mimetypes.guess_type(path)
+        if mime_type is None:
+            mime_type = 'application/octet-stream'
+        gzip_data = gzip_etag = None
+        if encoding is None and (
+                mime_type.startswith('text/') or
+                mime_type in COMPRESSIBLE_TYPES):
+            # mtime=0 makes the compressed output (and thus its entity-tag)
+            # deterministic
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(compressed) < len(data) * 0.9:
+                gzip_data = compressed
+                gzip_etag = etag_for(compressed)
+        etag = etag_for(data)
+        url = fingerprint(path, hashlib.sha1(data).hexdigest()[:12])
+        result[path] = result[url] = StaticAsset(
+            path, url, data, etag, gzip_data, gzip_etag, mime_type,
+            last_modified)
+    elapsed = monotonic() - start
+    STARTUP_SECONDS.set(elapsed, phase='static')
+    logger.info(
+        'Loaded %d static files in %.1fms', len(paths), elapsed * 1000)
+    return result
+
+
+def load_templates(root, paths, modules=None):
+    """
+    Compiles each of the Chameleon templates in *paths* (relative to *root*)
+    returning a :class:`dict` mapping the paths to their
+    :class:`~chameleon.PageTemplate`. The time taken to compile each
+    template is logged.
+
+    If *modules* is specified, it is the path of a directory (which will be
+    created if necessary) in which the compiled template modules are stored,
+    and from which they are loaded if the template is unchanged. This permits
+    a restart to skip compilation entirely.
+    """
+    logger = logging.getLogger('httpd')
+    loader = {}
+    if modules:
+        os.makedirs(modules, exist_ok=True)
+        loader['loader'] = ModuleLoader(str(modules))
+    result = {}
+    start = monotonic()
+    for path in sorted(paths):
+        compile_start = monotonic()
+        result[path] = PageTemplate(
+            (root / path).read_text(), filename=path, **loader)
+        logger.info(
+            'Compiled %s in %.1fms', path,
+            (monotonic() - compile_start) * 1000)
+    elapsed = monotonic() - start
+    STARTUP_SECONDS.set(elapsed, phase='templates')
+    logger.warning(
+        'Compiled %d templates in %.1fms', len(result), elapsed * 1000)
+    return result
+
+
+def fingerprint(path, digest):
+    """
+    Returns *path* with *digest* inserted before its final extension (or
+    appended, if it has no extension). For example::
+
+        >>> fingerprint('pico/main.py', '0123abcd')
+        'pico/main.0123abcd.py'
+        >>> fingerprint('Makefile', '0123abcd')
+        'Makefile.0123abcd'
+    """
+    head, sep, name = path.rpartition('/')
+    stem, dot, ext = name.rpartition('.')
+    if dot and stem:
+        name = f'{stem}.{digest}.{ext}'
+    else:
+        name = f'{name}.{digest}'
+    return f'{head}{sep}{name}'
+
+
+def etag_for(data):
+    """
+    Returns a strong entity-tag (without quotes) for the bytes-like *data*.
+    """
+    return base64.urlsafe_b64encode(
+        hashlib.sha1(data).digest()).decode('ascii').rstrip('=')
+
+
 def for_commands(*commands):
     """
     Decorator that associates methods in the request handler with HTTP commands
@@ -303,12 +799,30 @@ class HTTPServer(ThreadingHTTPServer):
     """
     The blinkenxmas HTTP server class, which descends from
     :class:`http.server.ThreadingHTTPServer` and is thus multi-threaded. This
-    does precious little other than override :meth:`handle_error`.
+    does precious little other than override :meth:`handle_error`, and
+    :meth:`server_bind` (to permit :attr:`reuse_port`).
+
+    As :class:`HTTPRequestHandler` speaks HTTP/1.1, each thread serves a
+    persistent connection until the client closes it, or it is idle for
+    longer than :attr:`idle_timeout` seconds (0 for no limit).
     """
     allow_reuse_address = True
     daemon_threads = True
+    idle_timeout = 60
+    reuse_port = False
+    owner = None
     logger = logging.getLogger('httpd')
 
+    def server_bind(self):
+        """
+        Overridden to set ``SO_REUSEPORT`` on the socket when
+        :attr:`reuse_port` is set, so that several processes may each listen
+        on the same port (see :mod:`blinkenxmas.prefork`).
+        """
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
     def handle_error(self, request, client_address):
         """
         Overridden to shut down the server in the event of an error when the
@@ -322,6 +836,13 @@ class HTTPServer(ThreadingHTTPServer):
             self.shutdown()
 
 
+class BadRequest(ValueError):
+    """
+    Raised when the body of a request cannot be decoded. If this escapes a
+    route, the client receives a 400 "Bad Request" response.
+    """
+
+
 class HTTPRequestHandler(BaseHTTPRequestHandler):
     """
     The blinkenxmas request handler. The :meth:`get_response` method is the
@@ -336,15 +857,83 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
 
     * Finally, custom functions (decorated by :func:`route`) are called by
       :meth:`try_route`
+
+    As this speaks HTTP/1.1, connections are persistent unless the client
+    requests otherwise, or the response has no explicit length (for example,
+    a route that streams its output), or the request's body was not entirely
+    read, in which case "Connection: close" is added to the response headers.
     """
+    protocol_version = 'HTTP/1.1'
     server_version = f'BlinkenXmas/{version("blinkenxmas")}'
     static_path = resources.files('blinkenxmas')
     static_modified = dt.datetime.now(dt.timezone.utc)
-    template_cache = {
-        'layout.pt': PageTemplate((static_path / 'layout.html.pt').read_text())
-    }
-    routes = {}
+    template_cache = None
+    static_files = frozenset(scan_resources(static_path))
+    static_cache = None
+    # Only package data with these extensions is served as static files; the
+    # rest (the server's own source, templates, configuration) is not
+    static_extensions = frozenset({
+        '.js', '.css', '.svg', '.png', '.ico', '.jpg'})
+    # Templates whose output depends only on the query, the store, and the
+    # (static) configuration. Others (e.g. capture.html.pt) depend on
+    # calibration state and must always be rendered afresh
+    cached_templates = frozenset({
+        'index.html.pt',
+        'create.html.pt',
+        'params.html.pt',
+        'manage.html.pt',
+        'update.html.pt',
+        'config.html.pt',
+        'mask.html.pt',
+    })
+    routes = Routes()
     animations = {}
+    # Only these commands are distinguished in the metrics; anything else a
+    # client sends is counted as "other"
+    metrics_commands = frozenset({'GET', 'HEAD', 'POST', 'PUT', 'DELETE'})
+    _cache_lock = Lock()
+    _query = None
+    _body_read = False
+    _started = None
+    _final = False
+    _framed = True
+    _responded = False
+    _connection_sent = False
+
+    @classmethod
+    def get_static_cache(cls):
+        """
+        Returns the :class:`dict` mapping static file paths to
+        :class:`StaticAsset` instances, loading it into the
+        :attr:`static_cache` class attribute if this has not already been
+        done (:class:`HTTPThread` does so at startup). Only files with one of
+        the :attr:`static_extensions` are loaded.
+        """
+        with cls._cache_lock:
+            if cls.static_cache is None:
+                HTTPRequestHandler.static_cache = load_static(
+                    cls.static_path, {
+                        path for path in cls.static_files
+                        if os.path.splitext(path)[1] in cls.static_extensions
+                    }, cls.static_modified)
+        return cls.static_cache
+
+    @classmethod
+    def get_template_cache(cls, modules=None):
+        """
+        Returns the :class:`dict` mapping template paths to compiled
+        :class:`~chameleon.PageTemplate` instances, compiling all templates
+        into the :attr:`template_cache` class attribute if this has not
+        already been done (:class:`HTTPThread` does so at startup). See
+        :func:`load_templates` for the meaning of *modules*.
+        """
+        with cls._cache_lock:
+            if cls.template_cache is None:
+                HTTPRequestHandler.template_cache = load_templates(
+                    cls.static_path,
+                    {path for path in cls.static_files if path.endswith('.pt')},
+                    modules)
+        return cls.template_cache
 
     def get_template(self, name):
         """
@@ -352,20 +941,27 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         loaded from module resources and cached in the
         :attr:`HTTPRequestHandler.template_cache` class attribute.
         """
-        try:
-            template = self.template_cache[name]
-        except KeyError:
-            template = PageTemplate((self.static_path / name).read_text())
-            type(self).template_cache[name] = template
-        return template
+        return self.get_template_cache()[name]
+
+    def static_url(self, path):
+        """
+        Returns the fingerprinted URL of the static file *path* (see
+        :attr:`StaticAsset.url`). Templates should use this (as
+        ``static_url``) to reference all static files so that clients need
+        not revalidate them on each page load, and will never use stale
+        copies after an upgrade.
+        """
+        asset = self.get_static_cache()[path.lstrip('/')]
+        return '/' + urllib.parse.quote(asset.url)
 
     def get_template_ns(self, **kwargs):
         """
         Returns the namespace used when rendering Chameleon templates.
         """
         ns = {
-            'layout':         self.template_cache['layout.pt']['layout'],
+            'layout':         self.get_template('layout.html.pt')['layout'],
             'url':            urllib.parse.quote,
+            'static_url':     self.static_url,
             'json':           json.dumps,
             'request':        self,
             'messages':       self.server.messages,
@@ -391,16 +987,15 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         and, if it returns a :class:`HTTPResponse`, that is returned. If no
         match is found, returns :data:`None`.
         """
-        for (pattern, command), handler in self.routes.items():
-            m = pattern.match(self.path)
-            if m and command == self.command:
-                resp = handler(self, **{
-                    param: urllib.parse.unquote(value)
-                    for param, value in m.groupdict().items()
-                })
-                if resp is not None:
-                    resp.headers.setdefault('Cache-Control', 'no-cache')
-                    return resp
+        for handler, params in self.routes.dispatch(self.command, self.path):
+            self.metrics_route = handler.__name__
+            resp = handler(self, **{
+                param: urllib.parse.unquote(value)
+                for param, value in params.items()
+            })
+            if resp is not None:
+                resp.headers.setdefault('Cache-Control', 'no-cache')
+                return resp
         return None
 
     @for_commands('GET')
@@ -413,14 +1008,34 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         returned. Otherwise, returns :data:`None`.
         """
         path = self.path.lstrip('/')
+        # Only files found in the package data at startup are served (from
+        # memory); this avoids touching the file-system for missing paths (and
+        # excludes paths like "../foo")
         try:
-            body = (self.static_path / path).open('rb')
-        except FileNotFoundError:
+            asset = self.get_static_cache()[path]
+        except KeyError:
             return None
+        self.metrics_route = 'static'
+        if path == asset.url:
+            # The URL includes a hash of the content, which therefore can
+            # never change; permit clients to cache it "forever"
+            headers = {'Cache-Control': 'max-age=31536000, immutable'}
         else:
-            return HTTPResponse(
-                self, body=body, filename=path,
-                headers={'Cache-Control': 'max-age=86400'})
+            headers = {'Cache-Control': 'max-age=86400'}
+        if asset.gzip_data is None:
+            data, etag, encoding = asset.data, asset.etag, None
+        else:
+            headers['Vary'] = 'Accept-Encoding'
+            if accepts_encoding(
+                    self.headers.get('Accept-Encoding', ''), 'gzip'):
+                data, etag, encoding = (
+                    asset.gzip_data, asset.gzip_etag, 'gzip')
+            else:
+                data, etag, encoding = asset.data, asset.etag, None
+        return HTTPResponse(
+            self, body=MemoryReader(data), filename=path, etag=etag,
+            mime_type=asset.mime_type, encoding=encoding,
+            last_modified=asset.last_modified, headers=headers)
 
     @for_commands('GET', 'POST')
     def try_template(self):
@@ -431,19 +1046,69 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         If a template is found, it is rendered with the result of
         :meth:`get_template_ns` as the namespace, and a :class:`HTTPResponse`
         is constructed from the result. Otherwise, returns :data:`None`.
+
+        If the output cache is enabled (the ``template_cache`` configuration
+        setting is non-zero), and :meth:`get_template_key` returns a key for
+        the request, the rendered output is stored in, and served from, the
+        cache.
         """
         path = self.path.lstrip('/')
         template_key = path + '.pt'
-        try:
-            template = self.get_template(template_key)
-        except FileNotFoundError:
+        if template_key not in self.static_files:
             return None
-        namespace = self.get_template_ns()
-        body = template.render(**namespace)
+        self.metrics_route = template_key
+        # Read before get_template_key checks no messages are pending
+        messages_version = self.server.messages.version
+        cache_key = self.get_template_key(template_key)
+        rendered = None
+        if cache_key is not None:
+            rendered = self.server.template_output.get(cache_key)
+        if rendered is None:
+            template = self.get_template(template_key)
+            namespace = self.get_template_ns()
+            body = template.render(**namespace).encode('utf-8')
+            rendered = RenderedTemplate(
+                body, etag_for(body), namespace['now'])
+            # A message shown (by another thread) since the check may have
+            # been drained into this output, which must not be replayed
+            if (
+                cache_key is not None and
+                self.server.messages.version == messages_version
+            ):
+                self.server.template_output.set(cache_key, rendered)
         return HTTPResponse(
-            self, body=body, last_modified=namespace['now'], etag=False,
+            self, body=MemoryReader(rendered.body),
+            last_modified=rendered.last_modified, etag=rendered.etag,
             filename=path, headers={'Cache-Control': 'no-cache'})
 
+    def get_template_key(self, template_key):
+        """
+        Returns the key under which the output of the template *template_key*
+        may be cached for the current request, or :data:`None` if the output
+        must not be cached.
+
+        Only GET and HEAD requests for templates in :attr:`cached_templates`
+        are cached, and only while no messages are pending (as the layout
+        displays, and drains, any pending messages); :meth:`try_template` also
+        discards the output if a message was shown while rendering it. The key
+        consists of the template name, the query string, and the change
+        counters of the store, so any change to the presets or positions
+        implicitly invalidates prior output.
+        """
+        if (
+            self.server.template_output.maxsize and
+            self.command in ('GET', 'HEAD') and
+            template_key in self.cached_templates and
+            not self.server.messages
+        ):
+            return (
+                template_key,
+                urllib.parse.urlsplit(self.uri).query,
+                self.store.presets_version,
+                self.store.positions_version,
+            )
+        return None
+
     def get_response(self):
         """
         Tries various methods (:meth:`try_route`, :meth:`try_static`,
@@ -461,6 +1126,16 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
             parts = urllib.parse.urlsplit(self.uri)
             self.path = parts.path
             self.fragment = parts.fragment
+            if self.body_too_large():
+                # Reject over-sized bodies before reading any of them; as the
+                # body is left unread, the connection cannot be re-used
+                self.close_connection = True
+                return HTTPResponse(
+                    self, status_code=HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+            if self.server.owner is not None and self.owner_only():
+                # Decided before the body is parsed, so that it can be
+                # forwarded verbatim
+                return self.forward()
             if self.command == 'GET' and parts.query:
                 self.query = urllib.parse.parse_qs(parts.query)
             elif self.command == 'POST':
@@ -476,7 +1151,9 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
                     elif content_type == 'multipart/form-data':
                         self.query = parse_formdata(self)
                     elif content_type == 'application/json':
-                        self.query = self.json()
+                        # Decoded on first access to query, so that routes
+                        # may instead stream the body (see frames)
+                        self._query = None
                     else:
                         raise ValueError(
                             f'unexpected content type: {content_type}')
@@ -484,13 +1161,6 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
                     return HTTPResponse(self, status_code=HTTPStatus.BAD_REQUEST)
             else:
                 self.query = {}
-            if isinstance(self.query, dict):
-                self.query = {
-                    key: value[0]
-                         if isinstance(value, list) and len(value) == 1 else
-                         value
-                    for key, value in self.query.items()
-                }
 
             # Try various methods to render the path, using the first one that
             # successfully returns a response
@@ -500,6 +1170,8 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
                     resp = method()
                     if resp is not None:
                         return resp
+        except BadRequest:
+            return HTTPResponse(self, status_code=HTTPStatus.BAD_REQUEST)
         except Exception as exc:
             if self.server.config.production:
                 self.server.handle_error(self, self.client_address)
@@ -509,6 +1181,144 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
             return HTTPResponse(self, status_code=HTTPStatus.INTERNAL_SERVER_ERROR)
         return HTTPResponse(self, status_code=HTTPStatus.NOT_FOUND)
 
+    def owner_only(self):
+        """
+        Returns :data:`True` if the route matching the request is marked
+        :func:`owner_only`.
+        """
+        return self._route_marked('owner_only')
+
+    def body_too_large(self):
+        """
+        Returns :data:`True` if the request body is larger than the configured
+        ``max_body``, and the route matching the request is not marked
+        :func:`large_body`.
+        """
+        return (
+            self.body_length() > self.server.config.max_body and
+            not self._route_marked('large_body'))
+
+    def _route_marked(self, attr):
+        # Returns the value of the marker *attr* (see owner_only, large_body)
+        # of the route matching the request; the path may still include the
+        # query when called before get_response
+        path = urllib.parse.urlsplit(self.path).path
+        for handler, params in self.routes.dispatch(self.command, path):
+            return getattr(handler, attr, False)
+        return False
+
+    def forward(self):
+        """
+        Forward the request, including its body, to the owner process at the
+        server's :attr:`owner` address (in pre-fork mode; see
+        :mod:`blinkenxmas.prefork`), returning a :class:`HTTPResponse` which
+        relays the owner's response as it is received.
+        """
+        self.metrics_route = 'forward'
+        host, port = self.server.owner
+        conn = http.client.HTTPConnection(
+            host, port, timeout=self.server.idle_timeout or None)
+        try:
+            body_len = self.body_length()
+            conn.request(
+                self.command, self.uri,
+                body=BoundedReader(self.rfile, body_len) if body_len else None,
+                headers={
+                    key: value for key, value in self.headers.items()
+                    if key.lower() not in HOP_BY_HOP
+                })
+            resp = conn.getresponse()
+        except:
+            conn.close()
+            raise
+        headers = {
+            key: value for key, value in resp.getheaders()
+            if key.lower() not in HOP_BY_HOP | {'date', 'server'}
+        }
+        if self.command == 'HEAD' or resp.status in (
+                HTTPStatus.NO_CONTENT, HTTPStatus.NOT_MODIFIED):
+            conn.close()
+            return HTTPResponse(
+                self, status_code=resp.status, accept_ranges=False,
+                etag=False, headers=headers)
+
+        def relay():
+            # Pass on whatever has been received, so that streams (like
+            # get_events) are relayed promptly
+            try:
+                while True:
+                    buf = resp.read1(65536)
+                    if not buf:
+                        break
+                    yield buf
+            finally:
+                conn.close()
+
+        length = headers.pop('Content-Length', None)
+        return HTTPResponse(
+            self, body=relay(), status_code=resp.status, accept_ranges=False,
+            content_length=None if length is None else int(length),
+            etag=False, headers=headers)
+
+    @property
+    def query(self):
+        """
+        A :class:`dict` of the parameters of the request, from the query
+        string of a GET request, or the body of a POST request. Parameters
+        given once are mapped to their value, and those given several times to
+        a :class:`list` of values. A JSON body is only decoded when this is
+        first accessed, raising :exc:`BadRequest` if this fails.
+        """
+        if self._query is None:
+            try:
+                self.query = self.json()
+            except ValueError as exc:
+                raise BadRequest(str(exc)) from exc
+        return self._query
+
+    @query.setter
+    def query(self, value):
+        if isinstance(value, dict):
+            value = {
+                key: value[0]
+                     if isinstance(value, list) and len(value) == 1 else
+                     value
+                for key, value in value.items()
+            }
+        self._query = value
+
+    def body_length(self):
+        """
+        Returns the length of the request body given by the Content-Length
+        header, or 0 if it is missing or invalid.
+        """
+        try:
+            return int(self.headers['Content-Length'])
+        except (KeyError, ValueError, TypeError):
+            return 0
+
+    def handle_expect_100(self):
+        """
+        Overridden to reject over-sized request bodies before the client sends
+        them, when it asks first with "Expect: 100-continue".
+        """
+        if self.body_too_large():
+            self.close_connection = True
+            HTTPResponse(
+                self, status_code=HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+            ).send_headers()
+            return False
+        return super().handle_expect_100()
+
+    def _body(self):
+        # Returns a stream of the request body, which is read on demand and
+        # thus can only be read once
+        body_len = self.body_length()
+        if self._body_read or body_len <= 0:
+            raise ValueError('invalid Content-Length for JSON')
+        self._body_read = True
+        return BoundedReader(self.rfile, body_len)
+
     def json(self):
         """
         Decode the body of the request as a JSON object. Note this handler can
@@ -520,16 +1330,178 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
             trusts that the request body is a valid JSON object. Wrap in
             exception handlers as appropriate!
         """
-        try:
-            body_len = int(self.headers['Content-Length'])
-        except (KeyError, ValueError, TypeError):
-            body_len = 0
-        if body_len > 0:
-            body = self.rfile.read(body_len)
-            self.headers['Content-Length'] = '0'
+        return json.loads(self._body().read())
+
+    def frames(self):
+        """
+        Decode the body of the request as the JSON representation of animation
+        frames, returning a tuple of the frames and a :class:`dict` of any
+        other information. The body may be an array of frames, or an object
+        with a "frames" array, in which case the other members of the object
+        form the information. In place of "frames", the object may have a
+        "job" member, the id of a finished job (see :mod:`blinkenxmas.jobs`)
+        whose result is the frames, so that frames generated by the server need
+        not be sent back to it.
+
+        Unlike :meth:`json`, the body is decoded incrementally and each frame
+        is converted to the compact representation of
+        :func:`~blinkenxmas.store.pack_frame` as it is read, so the JSON
+        representation of the animation is never held in memory. As with
+        :meth:`json`, this can only be called once, and raises
+        :exc:`ValueError` (or :exc:`KeyError` if the "frames" member is
+        missing, or the "job" is unknown, expired, or not done) if the body
+        is invalid.
+        """
+        def read_frames():
+            try:
+                return [store.pack_frame(frame) for frame in reader.items()]
+            except TypeError as exc:
+                raise ValueError(f'invalid frame: {exc}') from exc
+
+        reader = JSONReader(self._body())
+        info = {}
+        if reader.peek() == '{':
+            frames = None
+            for key in reader.members():
+                if key == 'frames':
+                    frames = read_frames()
+                else:
+                    info[key] = reader.value()
+            if frames is None:
+                frames = self._job_frames(info.pop('job', None))
         else:
-            raise ValueError('invalid Content-Length for JSON')
-        return json.loads(body)
+            frames = read_frames()
+        reader.end()
+        return frames, info
+
+    def _job_frames(self, job_id):
+        # Returns the frames generated by the job with id *job_id*
+        if job_id is None:
+            raise KeyError('frames')
+        job = self.server.jobs[str(job_id)]
+        if job.state != jobs.Job.DONE or job.result is None:
+            raise KeyError(job_id)
+        return list(job.result)
+
+    def setup(self):
+        # The idle timeout is the socket's timeout; once a request is being
+        # handled, this also limits how long any single read or write waits
+        self.timeout = self.server.idle_timeout or None
+        super().setup()
+
+    def parse_request(self):
+        # Each request is timed from the point its headers have been read
+        self._started = monotonic()
+        self.metrics_route = 'none'
+        self._metrics_status = None
+        self._metrics_length = None
+        self._final = False
+        self._framed = True
+        self._responded = False
+        self._connection_sent = False
+        self._body_read = False
+        if not super().parse_request():
+            return False
+        # Count what is read of the body, so we know whether the connection
+        # can be re-used (see body_consumed)
+        self.rfile = CountingReader(self.rfile)
+        return True
+
+    def body_consumed(self):
+        """
+        Returns :data:`True` if the handler has read the entire request body
+        (if any). If not, the remainder would be mistaken for the next request
+        on the connection, so the connection must close.
+        """
+        headers = getattr(self, 'headers', None)
+        if headers is None:
+            return False
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            return False
+        try:
+            return self.rfile.consumed == int(headers.get('Content-Length', 0))
+        except (AttributeError, ValueError):
+            return False
+
+    def handle_one_request(self):
+        """
+        Overridden to record the metrics of each request: the duration,
+        response status, and response size, labelled by the
+        :attr:`metrics_route` which handled it (the name of a route's
+        function, the path of a template, "static", or "none").
+        """
+        self._started = None
+        rfile = self.rfile
+        try:
+            super().handle_one_request()
+            if self._started is not None and not (
+                    self._responded and self.body_consumed()):
+                # The route didn't respond (or left part of the body unread)
+                # so the client cannot find the start of the next response
+                self.close_connection = True
+        finally:
+            self.rfile = rfile
+            if self._started is not None and self._metrics_status is not None:
+                labels = {
+                    'route': self.metrics_route,
+                    'method':
+                        self.command if self.command in self.metrics_commands
+                        else 'other',
+                }
+                REQUEST_SECONDS.observe(monotonic() - self._started, **labels)
+                RESPONSES.inc(status=self._metrics_status, **labels)
+                if self._metrics_length is not None:
+                    RESPONSE_BYTES.observe(self._metrics_length, **labels)
+
+    def log_request(self, code='-', size='-'):
+        self._metrics_status = str(int(code))
+        super().log_request(code, size)
+
+    def log_error(self, format, *args):
+        # Idle persistent connections time out routinely, so that's only an
+        # error if it happens during a request
+        if self._started is not None or not format.startswith('Request timed'):
+            super().log_error(format, *args)
+
+    def send_response_only(self, code, message=None):
+        super().send_response_only(code, message)
+        self._final = code >= 200
+        self._responded = self._responded or self._final
+        # Informational, No Content, Not Modified, and HEAD responses never
+        # have a body, so do not need a length
+        self._framed = (
+            not self._final or
+            code in (HTTPStatus.NO_CONTENT, HTTPStatus.NOT_MODIFIED) or
+            self.command == 'HEAD')
+
+    def send_header(self, keyword, value):
+        keyword_lower = keyword.lower()
+        if keyword_lower == 'content-length':
+            self._framed = True
+            if self.command != 'HEAD':
+                with suppress(ValueError):
+                    self._metrics_length = int(value)
+        elif keyword_lower == 'transfer-encoding':
+            self._framed = self._framed or 'chunked' in str(value).lower()
+        elif keyword_lower == 'connection':
+            self._connection_sent = True
+        super().send_header(keyword, value)
+
+    def end_headers(self):
+        if self._final and not self._connection_sent:
+            if self.close_connection or not (
+                    self._framed and self.body_consumed()):
+                # Without a length, the client can only find the end of the
+                # response by the connection closing
+                self.send_header('Connection', 'close')
+            elif self.request_version == 'HTTP/1.0':
+                # HTTP/1.0 clients which asked for a persistent connection
+                # must be told they have one
+                self.send_header('Connection', 'keep-alive')
+        # Only the first header block of a response is final; a route may
+        # write others as part of its body
+        self._final = False
+        super().end_headers()
 
     def do_HEAD(self):
         """
@@ -585,6 +1557,339 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
             resp.send_body()
 
 
+def run_on_loop(loop, coro):
+    """
+    Run the coroutine *coro* on the event *loop* from another thread, blocking
+    until it completes and returning its result. If the loop has closed, or
+    closes before *coro* completes (the server is shutting down),
+    :exc:`BrokenPipeError` is raised, as if the connection had closed.
+    """
+    try:
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+    except RuntimeError:
+        coro.close()
+        raise BrokenPipeError('event loop closed')
+    try:
+        return future.result()
+    except CancelledError:
+        raise BrokenPipeError('event loop closed')
+
+
+class AsyncReader(io.RawIOBase):
+    """
+    A blocking, read-only stream for use by a request handler running in an
+    executor thread. It first returns the bytes of *head* (the request line
+    and headers, already read by the event loop), then reads the remainder
+    of the request from the :class:`asyncio.StreamReader` *reader* on the
+    event *loop*.
+
+    Unlike a buffered stream, this never reads beyond what the handler asks
+    for, so a subsequent request on the same connection is left intact for
+    the event loop to read.
+    """
+    def __init__(self, loop, reader, head):
+        super().__init__()
+        self._loop = loop
+        self._reader = reader
+        self._head = MemoryReader(head)
+        self._consumed = 0
+
+    @property
+    def consumed(self):
+        "The number of bytes read beyond the *head*."
+        return self._consumed
+
+    def readable(self):
+        return True
+
+    def readline(self, size=-1):
+        line = self._head.readline(size)
+        if line.endswith(b'\n') or len(line) == size:
+            return line
+        return line + super().readline(
+            -1 if size is None or size < 0 else size - len(line))
+
+    def readinto(self, buf):
+        with memoryview(buf).cast('B') as view:
+            n = self._head.readinto(view)
+            while n < len(view):
+                data = run_on_loop(
+                    self._loop, self._reader.read(len(view) - n))
+                if not data:
+                    break
+                view[n:n + len(data)] = data
+                n += len(data)
+                self._consumed += len(data)
+        return n
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.readall()
+        buf = bytearray(size)
+        n = self.readinto(buf)
+        del buf[n:]
+        return bytes(buf)
+
+
+class AsyncWriter(io.RawIOBase):
+    """
+    A blocking, write-only stream for use by a request handler running in an
+    executor thread. Writes are passed to the :class:`asyncio.StreamWriter`
+    *writer* on the event *loop*, and block until the writer has drained
+    sufficiently to accept more. Writing to a closed connection raises
+    :exc:`BrokenPipeError`.
+    """
+    def __init__(self, loop, writer):
+        super().__init__()
+        self._loop = loop
+        self._writer = writer
+
+    def writable(self):
+        return True
+
+    async def _write(self, data):
+        if self._writer.is_closing():
+            raise BrokenPipeError('connection closed')
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def write(self, b):
+        # The data must be copied as the transport may hold a reference to it
+        # after we return, by which time the caller may have re-used b
+        data = bytes(b)
+        if data:
+            run_on_loop(self._loop, self._write(data))
+        return len(data)
+
+    async def _writev(self, buffers):
+        if self._writer.is_closing():
+            raise BrokenPipeError('connection closed')
+        self._writer.writelines(buffers)
+        await self._writer.drain()
+
+    def writev(self, buffers):
+        """
+        Write all the bytes-like objects in *buffers* in a single pass through
+        the event loop. As with :meth:`write`, the buffers are copied.
+        """
+        buffers = [bytes(buf) for buf in buffers]
+        run_on_loop(self._loop, self._writev(buffers))
+
+    async def _sendfile(self, file, offset, count):
+        if self._writer.is_closing():
+            raise BrokenPipeError('connection closed')
+        await self._writer.drain()
+        return await self._loop.sendfile(
+            self._writer.transport, file, offset, count)
+
+    def sendfile(self, file, offset=0, count=None):
+        """
+        Send *count* bytes (or all remaining bytes if *count* is
+        :data:`None`) of the regular *file* from *offset*, in the manner of
+        :meth:`socket.socket.sendfile`. The event loop will use
+        :func:`os.sendfile` to do so where the transport permits it.
+        """
+        return run_on_loop(self._loop, self._sendfile(file, offset, count))
+
+
+class AsyncRequestHandler(HTTPRequestHandler):
+    """
+    The variant of :class:`HTTPRequestHandler` used by
+    :class:`AsyncHTTPServer`. Each instance handles a single request (the
+    event loop handles waiting for subsequent requests on a persistent
+    connection), reading from an :class:`AsyncReader` and writing to an
+    :class:`AsyncWriter` which are passed as the *request*.
+    """
+    def setup(self):
+        self.rfile, self.wfile = self.request
+
+    def handle(self):
+        self.handle_one_request()
+
+    def finish(self):
+        pass
+
+
+class AsyncHTTPServer:
+    """
+    An alternative to :class:`HTTPServer` built upon :mod:`asyncio` streams,
+    listening on *server_address* (a tuple of host and port).
+
+    Rather than dedicating a thread to each connection, connections (which
+    are persistent, per HTTP/1.1) are managed by an event loop and only each
+    request is passed to *RequestHandlerClass* (typically
+    :class:`AsyncRequestHandler`) which runs in an executor of at most
+    *max_workers* threads. Hence blocking handlers (database queries,
+    animation generation, etc.) don't hold up the event loop, but idle
+    connections cost no more than a socket. Requests for routes marked
+    :func:`streaming` run in a thread of their own instead, so that a few
+    long-lived streams cannot starve the executor.
+
+    Connections which are idle for longer than :attr:`idle_timeout` seconds
+    (0 for no limit) are closed.
+    """
+    address_family = socket.AF_INET
+    idle_timeout = 60
+    reuse_port = False
+    owner = None
+    logger = logging.getLogger('httpd')
+
+    def __init__(self, server_address, RequestHandlerClass, *, max_workers=4):
+        self.RequestHandlerClass = RequestHandlerClass
+        self.socket = socket.socket(self.address_family, socket.SOCK_STREAM)
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                self.socket.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.socket.bind(server_address)
+            self.socket.listen()
+        except:
+            self.socket.close()
+            raise
+        self.server_address = self.socket.getsockname()
+        self.executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix='httpd')
+        self._lock = Lock()
+        self._loop = None
+        self._stop = None
+        self._stopping = False
+        self._stopped = Event()
+
+    def serve_forever(self):
+        """
+        Run the event loop, serving requests until :meth:`shutdown` is called.
+        """
+        self._stopped.clear()
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self.executor.shutdown(wait=False)
+            self.socket.close()
+            self._stopped.set()
+
+    def shutdown(self):
+        """
+        Stop :meth:`serve_forever` and wait until it has finished. This must
+        be called from a thread other than the one running
+        :meth:`serve_forever`.
+        """
+        self._request_stop()
+        self._stopped.wait()
+
+    def handle_error(self, request, client_address):
+        """
+        Handle an exception raised by a request handler. In production mode
+        this just prints the traceback. Otherwise, the server is shut down
+        (the exception is re-raised in the main thread).
+        """
+        if self.config.production:
+            socketserver.BaseServer.handle_error(self, request, client_address)
+        else:
+            self._request_stop()
+
+    def _request_stop(self):
+        with self._lock:
+            self._stopping = True
+            if self._loop is not None:
+                with suppress(RuntimeError):
+                    self._loop.call_soon_threadsafe(self._stop.set)
+
+    async def _serve(self):
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            self._stop = asyncio.Event()
+            if self._stopping:
+                return
+        connections = set()
+
+        async def connected(reader, writer):
+            task = asyncio.current_task()
+            connections.add(task)
+            try:
+                await self._handle(reader, writer)
+            except asyncio.CancelledError:
+                pass
+            finally:
+                connections.discard(task)
+
+        server = await asyncio.start_server(connected, sock=self.socket)
+        try:
+            await self._stop.wait()
+        finally:
+            server.close()
+            for task in list(connections):
+                task.cancel()
+            await asyncio.gather(*connections, return_exceptions=True)
+            with self._lock:
+                self._loop = None
+
+    async def _handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        client_address = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b'\r\n\r\n'),
+                        self.idle_timeout or None)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        asyncio.TimeoutError, ConnectionError):
+                    break
+                rfile = AsyncReader(loop, reader, head)
+                wfile = AsyncWriter(loop, writer)
+                if self._streaming(head):
+                    run = self._run_thread
+                else:
+                    run = partial(loop.run_in_executor, self.executor)
+                try:
+                    handler = await run(
+                        self.RequestHandlerClass, (rfile, wfile),
+                        client_address, self)
+                except (BrokenPipeError, ConnectionError):
+                    break
+                except Exception:
+                    self.handle_error(None, client_address)
+                    break
+                if handler.close_connection or not handler.body_consumed():
+                    break
+        finally:
+            writer.close()
+
+    def _streaming(self, head):
+        # Peek at the request line to determine whether the request is for a
+        # route marked streaming; anything malformed is left for the handler
+        # to reject
+        try:
+            command, target = head.split(b'\r\n', 1)[0].split()[:2]
+            path = urllib.parse.urlsplit(target.decode('iso-8859-1')).path
+        except ValueError:
+            return False
+        for handler, params in self.RequestHandlerClass.routes.dispatch(
+                command.decode('iso-8859-1'), path):
+            return getattr(handler, 'streaming', False)
+        return False
+
+    @staticmethod
+    def _run_thread(func, *args):
+        # Run func(*args) in a new daemon thread (which won't hold up the
+        # interpreter's exit if the stream outlives the event loop), returning
+        # an awaitable for its result
+        future = Future()
+
+        def run():
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = func(*args)
+                except BaseException as exc:
+                    future.set_exception(exc)
+                else:
+                    future.set_result(result)
+
+        Thread(target=run, name='httpd-stream', daemon=True).start()
+        return asyncio.wrap_future(future)
+
+
 class Messages:
     """
     This is a trivial class which is used to buffer up to *maxlen* messages,
@@ -594,9 +1899,16 @@ class Messages:
     :meth:`drain` to retrieve all messages from the buffer as a list of
     strings. Instances of the class are thread-safe and may be used from
     multiple threads without additional locking.
+
+    Threads which push updates to the user (see
+    :func:`~blinkenxmas.routes.get_events`) may block in :meth:`wait` until a
+    message is shown, or until something else calls :meth:`notify` to signal
+    that there is progress to report.
     """
     def __init__(self, maxlen=20):
         self._lock = Lock()
+        self._changed = Condition(self._lock)
+        self._version = 0
         self._items = deque(maxlen=maxlen)
 
     def show(self, msg):
@@ -607,6 +1919,39 @@ class Messages:
         """
         with self._lock:
             self._items.append(msg)
+            self._version += 1
+            self._changed.notify_all()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    @property
+    def version(self):
+        """
+        A counter incremented by each call to :meth:`show` or :meth:`notify`.
+        """
+        with self._lock:
+            return self._version
+
+    def notify(self):
+        """
+        Wake all threads waiting in :meth:`wait`, without adding a message.
+        """
+        with self._lock:
+            self._version += 1
+            self._changed.notify_all()
+
+    def wait(self, version, timeout=None):
+        """
+        Wait up to *timeout* seconds (or indefinitely if this is
+        :data:`None`) for :attr:`version` to differ from *version*, returning
+        the new :attr:`version` (which will equal *version* if the timeout
+        elapsed).
+        """
+        with self._lock:
+            self._changed.wait_for(lambda: self._version != version, timeout)
+            return self._version
 
     def drain(self):
         """
@@ -619,10 +1964,182 @@ class Messages:
         return result
 
 
+class LazyCalibration:
+    """
+    Owns the camera (one of the sources in :mod:`blinkenxmas.cameras`) and the
+    calibration state (a :class:`~blinkenxmas.calibrate.Calibration`). Neither
+    is constructed, nor are the modules implementing them (and hence PIL,
+    numpy, and the camera's libraries) imported, until first accessed via the
+    :attr:`camera`, :attr:`scanner`, or :attr:`calculator` attributes. Hence a
+    server which is only used to play presets never pays for them.
+
+    Each access resets an idle timer. If *idle_timeout* seconds pass without
+    access, and the camera is not busy (neither previewing to clients, nor
+    scanning an angle), the camera is closed and released. The calibration
+    state is released at the same time, unless it holds positions calculated
+    from scanned angles (which would be lost), in which case only the scanner
+    is released. If *idle_timeout* is 0, nothing is released until
+    :meth:`close` is called.
+
+    :param argparse.Namespace config:
+        The application configuration
+
+    :param Messages messages:
+        A buffer for messages to be relayed to the user
+
+    :param queue.Queue queue:
+        The queue to submit animations to for transmission to the broker
+    """
+    logger = logging.getLogger('httpd')
+
+    def __init__(self, config, messages, queue, *, idle_timeout=0):
+        self.config = config
+        self.messages = messages
+        self.queue = queue
+        self.idle_timeout = idle_timeout
+        self._lock = Lock()
+        self._closed = Event()
+        self._reaper = None
+        self._last_used = monotonic()
+        self._camera = None
+        self._calibration = None
+
+    def _touch(self):
+        # Must be called with _lock held
+        self._last_used = monotonic()
+        if self.idle_timeout and self._reaper is None:
+            self._reaper = Thread(target=self._reap, daemon=True)
+            self._reaper.start()
+
+    def _get_camera(self):
+        with self._lock:
+            if self._camera is None:
+                from . import cameras
+
+                start = monotonic()
+                self._camera = {
+                    'none':      lambda config: None,
+                    'files':     cameras.FilesSource,
+                    'picamera':  cameras.PiCameraSource,
+                    'gstreamer': cameras.GStreamerSource,
+                }[self.config.camera_type.strip().lower()](self.config)
+                self.logger.info(
+                    'Initialized camera in %.1fms',
+                    (monotonic() - start) * 1000)
+            self._touch()
+            return self._camera
+
+    def _get_calibration(self):
+        with self._lock:
+            if self._calibration is None:
+                from . import calibrate
+
+                self._calibration = calibrate.Calibration(
+                    self.config, self.messages)
+            self._touch()
+            return self._calibration
+
+    @property
+    def camera(self):
+        """
+        The camera source, or :data:`None` if the configuration specifies no
+        camera.
+        """
+        return self._get_camera()
+
+    @property
+    def scanner(self):
+        """
+        The current :class:`~blinkenxmas.calibrate.AngleScanner`, or
+        :data:`None` if no angle is being scanned. May be assigned.
+        """
+        return self._get_calibration().scanner
+
+    @scanner.setter
+    def scanner(self, value):
+        self._get_calibration().scanner = value
+
+    @property
+    def calculator(self):
+        """
+        The :class:`~blinkenxmas.calibrate.PositionsCalculator` accumulating
+        the positions scanned from each angle.
+        """
+        return self._get_calibration().calculator
+
+    def new_scanner(self, angle):
+        """
+        Construct a new :class:`~blinkenxmas.calibrate.AngleScanner` for
+        *angle* (which captures the base image of the tree at that angle),
+        make it the current :attr:`scanner`, and return it.
+        """
+        from .calibrate import AngleScanner
+
+        self.scanner = scanner = AngleScanner(
+            angle, self.camera, self.queue, self.config.led_strips,
+            self.messages)
+        return scanner
+
+    def _busy(self):
+        # Must be called with _lock held
+        if self._camera is not None and self._camera.has_clients:
+            return True
+        if self._calibration is not None:
+            scanner = self._calibration.scanner
+            if scanner is not None and scanner.scanning:
+                return True
+        return False
+
+    def _release(self):
+        # Must be called with _lock held
+        if self._camera is not None:
+            self._camera.close()
+            self._camera = None
+        if self._calibration is not None:
+            if self._calibration.calculator.angles:
+                self._calibration.scanner = None
+            else:
+                self._calibration = None
+
+    def _reap(self):
+        while True:
+            with self._lock:
+                remaining = self._last_used + self.idle_timeout - monotonic()
+                if remaining <= 0:
+                    if self._busy():
+                        remaining = self.idle_timeout
+                    else:
+                        self._release()
+                        self._reaper = None
+                        self.logger.info(
+                            'Released camera after %ds idle',
+                            self.idle_timeout)
+                        return
+            if self._closed.wait(remaining):
+                return
+
+    def close(self):
+        """
+        Stop any running scan, and release the camera and the calibration
+        state.
+        """
+        self._closed.set()
+        with self._lock:
+            if self._calibration is not None:
+                scanner = self._calibration.scanner
+                if scanner is not None:
+                    scanner.stop()
+            self._calibration = None
+            if self._camera is not None:
+                self._camera.close()
+                self._camera = None
+
+
 class HTTPThread(Thread):
     """
     The blinkenxmas HTTP thread class wraps an instance of :class:`HTTPServer`
-    in a :class:`~threading.Thread` for background execution. Instances of this
+    (or :class:`AsyncHTTPServer` if the configuration's ``httpd_mode`` is
+    "asyncio") in a :class:`~threading.Thread` for background execution. Instances of this
     class may be used as a context manager that will start the thread upon
     entry, and stop it (re-raising any exception that occurred during
     execution) on exit. This is the recommended method of running this thread.
@@ -635,24 +2152,47 @@ class HTTPThread(Thread):
 
     :param queue.Queue queue:
         The queue to submit animations to for transmission to the broker
+
+    :param tuple owner:
+        The address of the owner process, to which requests for
+        :func:`owner_only` routes are forwarded, in pre-fork mode (see
+        :mod:`blinkenxmas.prefork`); :data:`None` otherwise
+
+    :param bool reuse_port:
+        If :data:`True`, permit other processes to listen on the same port
     """
-    def __init__(self, config, messages, queue):
+    def __init__(self, config, messages, queue, *, owner=None,
+                 reuse_port=False):
         super().__init__(target=self.serve, daemon=True)
         mimetypes.init()
-        HTTPServer.address_family, addr = get_best_family(
-            config.httpd_bind, config.httpd_port)
-        self.httpd = HTTPServer(addr[:2], HTTPRequestHandler)
+        HTTPRequestHandler.get_static_cache()
+        HTTPRequestHandler.get_template_cache(config.template_modules)
+        Description.cache_dir = config.description_cache or None
+        family, addr = get_best_family(config.httpd_bind, config.httpd_port)
+        if config.httpd_mode == 'asyncio':
+            AsyncHTTPServer.address_family = family
+            AsyncHTTPServer.reuse_port = reuse_port
+            self.httpd = AsyncHTTPServer(
+                addr[:2], AsyncRequestHandler,
+                max_workers=config.httpd_workers)
+        else:
+            HTTPServer.address_family = family
+            HTTPServer.reuse_port = reuse_port
+            self.httpd = HTTPServer(addr[:2], HTTPRequestHandler)
+        self.httpd.idle_timeout = config.httpd_timeout
+        self.httpd.owner = owner
         self.httpd.queue = queue
         self.httpd.config = config
         self.httpd.messages = messages
-        self.httpd.camera = {
-            'none':      lambda config: None,
-            'files':     cameras.FilesSource,
-            'picamera':  cameras.PiCameraSource,
-            'gstreamer': cameras.GStreamerSource,
-        }[config.camera_type.strip().lower()](config)
-        self.httpd.calibration = calibrate.Calibration(
-            config, self.httpd.messages)
+        self.httpd.template_output = LRUCache(config.template_cache)
+        # The metrics of other processes, by name; see blinkenxmas.prefork
+        self.httpd.process_metrics = None
+        HTTPResponse.etags = LRUCache(config.etag_cache)
+        HTTPResponse.background_hash = config.etag_background
+        self.httpd.calibration = LazyCalibration(
+            config, messages, queue, idle_timeout=config.camera_idle)
+        self.httpd.jobs = jobs.JobQueue(
+            max_workers=config.jobs, max_queued=config.job_queue)
         self.httpd.exception = None
         self._shutdown_needed = False
 
@@ -667,15 +2207,19 @@ class HTTPThread(Thread):
 
     def stop(self):
         """
-        Stop the HTTP background thread.
+        Stop the HTTP background thread, cancel outstanding jobs, and release
+        the camera.
         """
         if self._shutdown_needed:
             self.httpd.shutdown()
+        self.httpd.jobs.close()
+        self.httpd.calibration.close()
 
     def serve(self):
         """
         The "main" routine of the background thread. Mostly this just calls
-        :meth:`http.server.HTTPserver.serve_forever`.
+        :meth:`http.server.HTTPserver.serve_forever` (or
+        :meth:`AsyncHTTPServer.serve_forever`).
         """
         try:
             host, port = self.httpd.socket.getsockname()[:2]
@@ -0,0 +1,336 @@
+import math
+import logging
+import secrets
+from time import monotonic
+from threading import Lock, Event
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics
+
+
+JOB_SECONDS = metrics.Histogram(
+    'blinkenxmas_job_duration_seconds',
+    'Time taken to run background jobs, by kind (e.g. the animation name)',
+    ('kind',), buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+JOBS_REJECTED = metrics.Counter(
+    'blinkenxmas_jobs_rejected_total',
+    'Number of jobs refused because the job queue was full')
+
+
+class QueueFull(Exception):
+    """
+    Raised by :meth:`JobQueue.submit` when the queue cannot accept another
+    job. The :attr:`retry_after` attribute is the estimated number of seconds
+    (an :class:`int`) after which the client should try again.
+    """
+    def __init__(self, retry_after):
+        super().__init__(f'job queue full; retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class JobCancelled(Exception):
+    """
+    Raised by :meth:`Job.update` within a job's function when the job has been
+    cancelled, to abandon the job's work.
+    """
+
+
+class Job:
+    """
+    A unit of work, created by :meth:`JobQueue.submit`, which calls *func*
+    (with the job as its only argument) in a background thread, and stores its
+    result. The *kind* of the job (for example, the name of the animation it
+    generates) groups jobs whose durations are expected to be similar; the
+    *expected* duration of the job (in seconds, or :data:`None` if unknown) is
+    used to estimate its :attr:`progress` and :attr:`eta`.
+
+    .. attribute:: id
+
+        A random, URL-safe, :class:`str` identifying the job.
+
+    .. attribute:: kind
+
+        The kind of the job, as given at construction.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    logger = logging.getLogger('jobs')
+
+    def __init__(self, kind, func, *, expected=None):
+        self.id = secrets.token_urlsafe(9)
+        self.kind = kind
+        self._func = func
+        self._expected = expected
+        self._lock = Lock()
+        self._cancelled = Event()
+        self._state = Job.QUEUED
+        self._progress = None
+        self._started = None
+        self._finished = None
+        self._result = None
+        self._error = None
+
+    def __repr__(self):
+        return f'<Job id={self.id!r} kind={self.kind!r} state={self.state!r}>'
+
+    @property
+    def state(self):
+        """
+        The state of the job; one of "queued", "running", "done", "failed",
+        or "cancelled".
+        """
+        with self._lock:
+            return self._state
+
+    @property
+    def finished(self):
+        "Returns :data:`True` if the job is done, has failed, or is cancelled."
+        return self.state in (Job.DONE, Job.FAILED, Job.CANCELLED)
+
+    @property
+    def result(self):
+        "The value returned by the job's function, once the job is done."
+        with self._lock:
+            return self._result
+
+    @property
+    def error(self):
+        "A description of the exception raised by a failed job, as a str."
+        with self._lock:
+            return self._error
+
+    @property
+    def progress(self):
+        """
+        The progress of the job, between 0 and 1. This is the value last
+        reported by the job's function (see :meth:`update`) or, if it has
+        reported nothing, an estimate from the time the job has been running
+        and its expected duration. If neither is available, this is
+        :data:`None`.
+        """
+        with self._lock:
+            if self._state == Job.DONE:
+                return 1.0
+            elif self._state != Job.RUNNING:
+                return None if self._state != Job.QUEUED else 0.0
+            elif self._progress is not None:
+                return self._progress
+            elif self._expected:
+                # Never claim completion until the job has actually finished
+                return min(0.99, (monotonic() - self._started) / self._expected)
+            else:
+                return None
+
+    @property
+    def eta(self):
+        """
+        The estimated number of seconds until the job finishes, or
+        :data:`None` if the job is not running, or this cannot be estimated.
+        """
+        with self._lock:
+            if self._state != Job.RUNNING or not self._expected:
+                return None
+            elapsed = monotonic() - self._started
+            if self._progress:
+                remaining = elapsed / self._progress - elapsed
+            else:
+                remaining = self._expected - elapsed
+            return max(0.0, remaining)
+
+    @property
+    def duration(self):
+        """
+        The number of seconds the job ran for, or :data:`None` if it has not
+        finished running.
+        """
+        with self._lock:
+            if self._started is None or self._finished is None:
+                return None
+            return self._finished - self._started
+
+    def update(self, progress=None):
+        """
+        Called by the job's function to report its *progress* (between 0 and
+        1), if known. This also raises :exc:`JobCancelled` if the job has been
+        cancelled, so a function which calls this regularly (even without a
+        *progress*) also stops promptly when cancelled.
+        """
+        if self._cancelled.is_set():
+            raise JobCancelled(self.id)
+        if progress is not None:
+            with self._lock:
+                self._progress = max(0.0, min(1.0, progress))
+
+    def cancel(self):
+        """
+        Cancel the job. A queued job never runs. As a thread cannot be
+        interrupted, a running job continues until its function next calls
+        :meth:`update`, but its result is discarded regardless. Returns
+        :data:`False` if the job had already finished, and :data:`True`
+        otherwise.
+        """
+        with self._lock:
+            if self._state in (Job.DONE, Job.FAILED, Job.CANCELLED):
+                return False
+            self._cancelled.set()
+            if self._state == Job.QUEUED:
+                self._state = Job.CANCELLED
+                self._finished = monotonic()
+            return True
+
+    def as_dict(self):
+        """
+        Returns a :class:`dict` describing the job (suitable for encoding as
+        JSON) containing its "id", "state", "progress", "eta", and "error".
+        """
+        return {
+            'id': self.id,
+            'state': self.state,
+            'progress': self.progress,
+            'eta': self.eta,
+            'error': self.error,
+        }
+
+    def run(self):
+        """
+        Run the job's function, storing its result (or error). This is called
+        by the :class:`JobQueue` in one of its worker threads.
+        """
+        with self._lock:
+            if self._state != Job.QUEUED:
+                return
+            self._state = Job.RUNNING
+            self._started = monotonic()
+        try:
+            result = self._func(self)
+        except JobCancelled:
+            state, result, error = Job.CANCELLED, None, None
+        except Exception as exc:
+            self.logger.exception('Job %s (%s) failed', self.id, self.kind)
+            state, result, error = Job.FAILED, None, str(exc)
+        else:
+            if self._cancelled.is_set():
+                state, result, error = Job.CANCELLED, None, None
+            else:
+                state, error = Job.DONE, None
+        with self._lock:
+            self._state = state
+            self._result = result
+            self._error = error
+            self._finished = monotonic()
+            self._func = None
+
+
+class JobQueue:
+    """
+    Runs :class:`Job` instances in at most *max_workers* background threads,
+    permitting at most *max_queued* further jobs to wait for a thread. Further
+    submissions raise :exc:`QueueFull`, so a small host degrades gracefully
+    under load rather than accumulating work it cannot finish.
+
+    Finished jobs (and their results) are retained for *keep* seconds, after
+    which they are forgotten. The durations of completed jobs are remembered
+    by kind to estimate the progress of subsequent jobs of the same kind.
+    """
+    def __init__(self, *, max_workers=1, max_queued=4, keep=300):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.keep = keep
+        self._lock = Lock()
+        self._jobs = OrderedDict()
+        self._durations = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='job')
+
+    def __len__(self):
+        with self._lock:
+            self._expire()
+            return len(self._jobs)
+
+    def __getitem__(self, job_id):
+        with self._lock:
+            self._expire()
+            return self._jobs[job_id]
+
+    @property
+    def pending(self):
+        "The number of jobs which are queued or running."
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if not job.finished)
+
+    def expected(self, kind):
+        """
+        Returns the expected duration (in seconds) of a job of *kind*, or
+        :data:`None` if no job of that kind has completed yet.
+        """
+        with self._lock:
+            return self._durations.get(kind)
+
+    def submit(self, kind, func):
+        """
+        Create a :class:`Job` of *kind* which will call *func* (passing the
+        job as the only argument), queue it for execution, and return it.
+        Raises :exc:`QueueFull` if the queue has no room for the job.
+        """
+        with self._lock:
+            self._expire()
+            pending = [job for job in self._jobs.values() if not job.finished]
+            if len(pending) >= self.max_workers + self.max_queued:
+                JOBS_REJECTED.inc()
+                raise QueueFull(self._retry_after(pending))
+            job = Job(kind, func, expected=self._durations.get(kind))
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        job.run()
+        duration = job.duration
+        if job.state == Job.DONE and duration is not None:
+            JOB_SECONDS.observe(duration, kind=job.kind)
+            with self._lock:
+                # An exponentially weighted average; recent jobs are the best
+                # guide to the next (the tree's size, etc. may have changed)
+                previous = self._durations.get(job.kind, duration)
+                self._durations[job.kind] = (previous + duration) / 2
+
+    def _retry_after(self, pending):
+        # Must be called with _lock held; the time for a worker to become
+        # free, or (if no job's duration is known) a guess of a few seconds
+        remaining = [
+            job.eta if job.state == Job.RUNNING else
+            self._durations.get(job.kind)
+            for job in pending
+        ]
+        known = [t for t in remaining if t is not None]
+        if not known:
+            return 5
+        return max(1, math.ceil(
+            sum(known) / len(known) * len(pending) / self.max_workers))
+
+    def _expire(self):
+        # Must be called with _lock held
+        now = monotonic()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished and job._finished is not None
+            and now - job._finished > self.keep
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def close(self):
+        """
+        Cancel all queued and running jobs, and shut down the worker threads
+        (without waiting for running jobs to notice their cancellation).
+        """
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            job.cancel()
+        self._executor.shutdown(wait=False)
@@ -16,7 +16,22 @@ function hideMessage(evt) {
     evt.stopPropagation();
 }
 
+let eventSource = null;
+
+function getEvents(query) {
+    // All scripts on a page share one event stream; the first to ask for it
+    // determines the query
+    if (!eventSource) {
+        let url = query ? `/events?${query}` : '/events';
+        eventSource = new EventSource(url);
+        eventSource.onmessage = (evt) => showMessage(JSON.parse(evt.data));
+    }
+    return eventSource;
+}
+
 function showMessages() {
+    if (window.EventSource)
+        return Promise.resolve(getEvents());
     let req = new Request('/messages.json', { cache: 'no-store' });
     return fetch(req)
         .then((resp) => resp.json())
@@ -0,0 +1,307 @@
+import math
+from time import monotonic
+from bisect import bisect_left
+from threading import Lock
+from contextlib import contextmanager
+
+
+# Default histogram buckets for durations (in seconds), and sizes (in bytes)
+TIME_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (
+    256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Registry:
+    """
+    A collection of metrics which can be rendered together, by :meth:`render`,
+    in the Prometheus text exposition format. Metrics add themselves to the
+    registry given at construction (the module's :data:`REGISTRY` by default).
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = {}
+
+    def __getitem__(self, name):
+        return self._metrics[name]
+
+    def __contains__(self, name):
+        return name in self._metrics
+
+    def register(self, metric):
+        """
+        Add *metric* to the registry. Raises :exc:`ValueError` if a metric
+        with the same name is already registered.
+        """
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'duplicate metric {metric.name}')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def collect(self):
+        """
+        Returns a :class:`list` of the current state of all registered metrics,
+        as returned by :meth:`Metric.collect`. Unlike the metrics themselves,
+        the result may be pickled (to send it to another process, for
+        example), and is rendered by :func:`render_collected`.
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        return [metric.collect() for metric in metrics]
+
+    def render(self):
+        """
+        Returns a :class:`str` containing all registered metrics in the
+        Prometheus text exposition format.
+        """
+        return render_collected(self.collect())
+
+
+def format_value(value):
+    """
+    Format the numeric *value* as required by the Prometheus text format.
+    """
+    if isinstance(value, int):
+        return str(value)
+    elif math.isnan(value):
+        return 'NaN'
+    elif math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    else:
+        return repr(float(value))
+
+
+def format_labels(labels):
+    """
+    Format the sequence of (name, value) tuples in *labels* as a Prometheus
+    label set, or a blank string if *labels* is empty.
+    """
+    if not labels:
+        return ''
+    escaped = (
+        (name, value.replace('\\', '\\\\').replace('"', '\\"')
+         .replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(
+        f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def render_collected(collected):
+    """
+    Returns a :class:`str` containing the *collected* metrics (as returned by
+    :meth:`Registry.collect`) in the Prometheus text exposition format.
+    """
+    return ''.join(
+        line + '\n'
+        for name, help, type, samples in collected
+        for line in _render_lines(name, help, type, samples)
+    )
+
+
+def merge_collected(processes, label='process'):
+    """
+    Given *processes*, a mapping of process names to the metrics collected
+    from each (by :meth:`Registry.collect`), returns a single collection of
+    the metrics in which each sample has an additional *label* (named
+    "process" by default) with the name of the process it came from. Series
+    of the same metric from different processes therefore remain distinct,
+    and may be summed by the consumer.
+    """
+    families = {}
+    for process, collected in processes.items():
+        for name, help, type, samples in collected:
+            family = families.setdefault(name, (name, help, type, []))
+            family[3].extend(
+                (suffix, ((label, process),) + tuple(labels), value)
+                for suffix, labels, value in samples)
+    return [families[name] for name in sorted(families)]
+
+
+def _render_lines(name, help, type, samples):
+    yield f'# HELP {name} {help}'
+    yield f'# TYPE {name} {type}'
+    for suffix, labels, value in samples:
+        yield f'{name}{suffix}{format_labels(labels)} {format_value(value)}'
+
+
+class Metric:
+    """
+    The abstract base of the metric classes. The *name* and *help* text are
+    output in the rendered metrics, and *labels* is the sequence of label
+    names with which each observation must be made. Every distinct set of label
+    values forms a separate series of the metric.
+    """
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=(), *, registry=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = Lock()
+        self._series = {}
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _key(self, labels):
+        if labels.keys() != set(self.labels):
+            raise ValueError(
+                f'{self.name} requires labels {", ".join(self.labels)}')
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _samples(self):
+        # Yields (suffix, labels, value) tuples for each sample
+        raise NotImplementedError
+
+    def clear(self):
+        """
+        Remove all series of the metric.
+        """
+        with self._lock:
+            self._series.clear()
+
+    def collect(self):
+        """
+        Returns the current state of the metric as a (name, help, type,
+        samples) tuple, where *samples* is a :class:`list` of (suffix, labels,
+        value) tuples; *suffix* is appended to the metric's name (e.g.
+        "_count"), and *labels* is a tuple of (name, value) tuples.
+        """
+        with self._lock:
+            samples = list(self._samples())
+        return self.name, self.help, self.type, samples
+
+    def render(self):
+        """
+        Yields the lines of the metric in the Prometheus text format.
+        """
+        yield from _render_lines(*self.collect())
+
+
+class Counter(Metric):
+    """
+    A :class:`Metric` which counts events; its value only ever increases.
+    """
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """
+        Increment the series identified by *labels* by *amount*.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels):
+        "Returns the current value of the series identified by *labels*."
+        with self._lock:
+            return self._series.get(self._key(labels), 0)
+
+    def _samples(self):
+        for key, value in self._series.items():
+            yield '', tuple(zip(self.labels, key)), value
+
+
+class Gauge(Metric):
+    """
+    A :class:`Metric` which reports a value that may rise and fall. If
+    :meth:`set_function` is called, the gauge (which may then not have labels)
+    calls the given function for its value each time it is rendered.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), *, registry=None):
+        super().__init__(name, help, labels, registry=registry)
+        self._func = None
+
+    def set(self, value, **labels):
+        "Set the series identified by *labels* to *value*."
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = value
+
+    def set_function(self, func):
+        """
+        Set *func* (which must take no arguments, and return a number) as the
+        source of the gauge's value. Pass :data:`None` to remove it.
+        """
+        assert not self.labels
+        with self._lock:
+            self._func = func
+
+    def value(self, **labels):
+        "Returns the current value of the series identified by *labels*."
+        with self._lock:
+            if self._func is not None:
+                return self._func()
+            return self._series.get(self._key(labels), 0)
+
+    def _samples(self):
+        if self._func is not None:
+            yield '', (), self._func()
+        else:
+            for key, value in self._series.items():
+                yield '', tuple(zip(self.labels, key)), value
+
+
+class Histogram(Metric):
+    """
+    A :class:`Metric` which counts observations (for example, the duration of
+    requests) in the configured *buckets*, as well as their count and sum.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), *, buckets=TIME_BUCKETS,
+                 registry=None):
+        if 'le' in labels:
+            raise ValueError('histograms cannot have an "le" label')
+        super().__init__(name, help, labels, registry=registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """
+        Record *value* in the series identified by *labels*.
+        """
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._series.get(
+                key, ([0] * (len(self.buckets) + 1), 0))
+            # Counts are stored per-bucket (the final one being +Inf), and
+            # only made cumulative when rendered
+            counts[bisect_left(self.buckets, value)] += 1
+            self._series[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        A context manager which records the time taken by the body of the
+        :keyword:`with` statement in the series identified by *labels*.
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start, **labels)
+
+    def count(self, **labels):
+        "Returns the number of observations in the series with *labels*."
+        with self._lock:
+            try:
+                counts, total = self._series[self._key(labels)]
+            except KeyError:
+                return 0
+            return sum(counts)
+
+    def _samples(self):
+        for key, (counts, total) in self._series.items():
+            labels = tuple(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield '_bucket', labels + (
+                    ('le', format_value(float(bound))),), cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, cumulative
+
+
+REGISTRY = Registry()
@@ -9,6 +9,7 @@ from threading import Thread, Event
 import paho.mqtt.client as mqtt
 from colorzero import Color
 
+from . import metrics
 from .pico.animation import (
     chunk_size,
     packet_fmt,
@@ -19,11 +20,23 @@ from .pico.animation import (
 )
 
 
+QUEUE_DEPTH = metrics.Gauge(
+    'blinkenxmas_mqtt_queue_depth',
+    'Number of animations waiting to be sent to the MQTT broker')
+RENDER_SECONDS = metrics.Histogram(
+    'blinkenxmas_mqtt_render_seconds',
+    'Time taken to render animations for transmission')
+PUBLISH_SECONDS = metrics.Histogram(
+    'blinkenxmas_mqtt_publish_seconds',
+    'Time taken to publish rendered animations to the MQTT broker')
+
+
 def render(animation, fps, chunk_size=chunk_size):
     """
     Given an *animation* (which is a list of lists of strings of HTML color
-    specifications), and an *fps* speed, returns a byte-string representation
-    of the animation.
+    specifications, or of frames in the compact representation of
+    :func:`~blinkenxmas.store.pack_frame`), and an *fps* speed, returns a
+    byte-string representation of the animation.
 
     The byte-string returned consists of:
 
@@ -49,9 +62,16 @@ def render(animation, fps, chunk_size=chunk_size):
         b"\\x01\\x02\\x02\\x00\\xF8\\x00\\x01\\x00\\x00\\x02\\x00\\x00\\x00\\x01\\x00\\x1F"
     """
     def convert(frames):
-        # Convert HTML color codes into RGB565 representation
+        # Convert HTML color codes (or the compact representation of
+        # blinkenxmas.store.pack_frame) into RGB565 representation
         for frame in frames:
-            yield [Color(html).rgb565 for html in frame]
+            if isinstance(frame, bytes):
+                yield [
+                    Color.from_rgb_bytes(*rgb).rgb565
+                    for rgb in zip(frame[0::3], frame[1::3], frame[2::3])
+                ]
+            else:
+                yield [Color(html).rgb565 for html in frame]
 
     def diff(frames):
         # Determine which LEDs actually changed from each frame to the next
@@ -117,6 +137,7 @@ class MessageThread(Thread):
         self.fps = config.fps
         self.exception = None
         self._stopping = Event()
+        QUEUE_DEPTH.set_function(queue.qsize)
 
     def __enter__(self):
         self.start()
@@ -151,12 +172,15 @@ class MessageThread(Thread):
                     client.loop(timeout=0.1)
                 else:
                     try:
-                        messages = [
-                            client.publish(self.topic, chunk, qos=1)
-                            for chunk in render(frames, self.fps)
-                        ]
-                        while not all(m.is_published() for m in messages):
-                            client.loop(timeout=1)
+                        with RENDER_SECONDS.time():
+                            chunks = list(render(frames, self.fps))
+                        with PUBLISH_SECONDS.time():
+                            messages = [
+                                client.publish(self.topic, chunk, qos=1)
+                                for chunk in chunks
+                            ]
+                            while not all(m.is_published() for m in messages):
+                                client.loop(timeout=1)
                     finally:
                         self.queue.task_done()
         except Exception as e:
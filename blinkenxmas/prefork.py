@@ -0,0 +1,197 @@
+import socket
+import signal
+import logging
+import multiprocessing
+from copy import copy
+from threading import Thread, Event
+
+from . import mqtt, httpd, store, metrics
+
+
+logger = logging.getLogger('prefork')
+
+# The interval (in seconds) at which workers send their metrics to the owner
+METRICS_INTERVAL = 5
+
+
+class RelayedMessages:
+    """
+    Stands in for :class:`~blinkenxmas.httpd.Messages` in worker processes.
+    Messages shown are put on *queue* (a :class:`multiprocessing.Queue`) for
+    the owner process to show; as routes which read messages are forwarded to
+    the owner (see :func:`~blinkenxmas.httpd.owner_only`), the worker itself
+    never holds any.
+    """
+    def __init__(self, queue):
+        self._queue = queue
+
+    def __len__(self):
+        return 0
+
+    def show(self, msg):
+        "Relay *msg* to the owner process."
+        self._queue.put(msg)
+
+    @property
+    def version(self):
+        "Always 0, as the worker never holds any messages."
+        return 0
+
+    def drain(self):
+        """
+        Returns an empty :class:`list`; the owner process holds all messages,
+        which pages fetch from it (via the forwarded ``/messages`` route).
+        """
+        return []
+
+
+def relay_messages(queue, messages):
+    """
+    Show each message from *queue* (as put there by :class:`RelayedMessages`)
+    in *messages*, until :data:`None` is received. This runs in a background
+    thread of the owner process.
+    """
+    for msg in iter(queue.get, None):
+        messages.show(msg)
+
+
+def send_metrics(queue, name, stop, interval=None):
+    """
+    Put the metrics of this process (see
+    :meth:`~blinkenxmas.metrics.Registry.collect`), labelled with *name*, on
+    *queue* every *interval* seconds (:data:`METRICS_INTERVAL` by default),
+    until *stop* (an :class:`~threading.Event`) is set. This runs in a
+    background thread of each worker process.
+    """
+    if interval is None:
+        interval = METRICS_INTERVAL
+    while True:
+        queue.put((name, metrics.REGISTRY.collect()))
+        if stop.wait(interval):
+            break
+
+
+def receive_metrics(queue, processes):
+    """
+    Store the metrics of each worker from *queue* (as put there by
+    :func:`send_metrics`) in the *processes* mapping, keyed by the worker's
+    name, until :data:`None` is received. This runs in a background thread of
+    the owner process, which merges the workers' metrics with its own when
+    serving :func:`~blinkenxmas.routes.get_metrics`.
+    """
+    for name, collected in iter(queue.get, None):
+        processes[name] = collected
+
+
+def run_worker(config, owner_addr, queue, relay, listener, metrics_queue):
+    """
+    The "main" routine of each worker process. Serves HTTP requests on the
+    configured address (shared with the other workers by ``SO_REUSEPORT``),
+    forwarding those which require the owner's state to *owner_addr*,
+    submitting animations to *queue*, relaying messages via *relay*, and
+    sending its metrics via *metrics_queue*, until terminated by the owner.
+    """
+    # The owner shuts down the workers; don't race it on Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # This fork of the owner's private listening socket is never used
+    listener.close()
+    metrics_task = Thread(
+        target=send_metrics, daemon=True, args=(
+            metrics_queue, multiprocessing.current_process().name, Event()))
+    metrics_task.start()
+    with httpd.HTTPThread(
+        config, RelayedMessages(relay), queue, owner=owner_addr,
+        reuse_port=True
+    ) as httpd_task:
+        while httpd_task.is_alive():
+            httpd_task.join(1)
+
+
+def serve(config):
+    """
+    Serve :program:`bxweb` with :attr:`config.httpd_processes` worker
+    processes, forked from this (the "owner") process.
+
+    The workers each listen on the configured address, with ``SO_REUSEPORT``
+    so that the kernel spreads connections between them, and each opens the
+    database (which is switched to write-ahead logging, so that they don't
+    block each other). As they are forked after the animations and templates
+    are loaded, their memory is largely shared with the owner.
+
+    Only the owner connects to the MQTT broker, and only the owner holds the
+    camera, calibration, animation jobs, and the user's messages. It serves
+    requests for the routes which use these (see
+    :func:`~blinkenxmas.httpd.owner_only`) from a server on the loopback
+    interface, to which the workers forward such requests. Workers submit
+    animations for the broker, and messages for the user, to the owner via
+    :mod:`multiprocessing` queues (the former a ``JoinableQueue``, as the
+    MQTT thread marks each animation done, like a :class:`queue.Queue`).
+
+    Requests for ``/metrics`` are also forwarded to the owner, so that every
+    scrape sees the metrics of all processes. The workers send their metrics
+    to the owner every :data:`METRICS_INTERVAL` seconds (see
+    :func:`send_metrics`), and the owner serves them alongside its own, with
+    each sample labelled by the name of its process ("owner", "bxweb-0",
+    "bxweb-1", etc.).
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError(
+            'multiple processes require SO_REUSEPORT, which this platform '
+            'does not support')
+    mode = store.Storage(config.db).enable_wal()
+    if mode != 'wal':
+        logger.warning('Database journal mode is %s, not wal', mode)
+    context = multiprocessing.get_context('fork')
+    queue = context.JoinableQueue()
+    relay = context.Queue()
+    metrics_queue = context.Queue()
+    messages = httpd.Messages()
+
+    owner_config = copy(config)
+    owner_config.httpd_bind = '127.0.0.1'
+    owner_config.httpd_port = 0
+    owner_config.httpd_mode = 'threading'
+    # No threads may be started before the workers are forked, but the
+    # owner's server must be bound to know its address
+    owner = httpd.HTTPThread(owner_config, messages, queue)
+    owner_addr = owner.httpd.server_address[:2]
+    owner.httpd.process_metrics = {}
+    workers = [
+        context.Process(
+            target=run_worker, name=f'bxweb-{n}', daemon=True,
+            args=(config, owner_addr, queue, relay, owner.httpd.socket,
+                  metrics_queue))
+        for n in range(config.httpd_processes)
+    ]
+    for worker in workers:
+        worker.start()
+    relay_task = Thread(
+        target=relay_messages, args=(relay, messages), daemon=True)
+    relay_task.start()
+    metrics_task = Thread(
+        target=receive_metrics, daemon=True,
+        args=(metrics_queue, owner.httpd.process_metrics))
+    metrics_task.start()
+    try:
+        with mqtt.MessageThread(config, queue) as message_task, \
+                owner as owner_task:
+            while True:
+                owner_task.join(1)
+                if not owner_task.is_alive():
+                    break
+                if not message_task.is_alive():
+                    break
+                dead = [worker for worker in workers if not worker.is_alive()]
+                if dead:
+                    raise RuntimeError(
+                        f'worker {dead[0].name} exited with code '
+                        f'{dead[0].exitcode}')
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        relay.put(None)
+        relay_task.join()
+        metrics_queue.put(None)
+        metrics_task.join()
@@ -1,11 +1,24 @@
 import io
 import json
+import tarfile
+import math as m
 from http import HTTPStatus
+from functools import partial
 from urllib.parse import quote
 
-from .httpd import route, Function, Param, HTTPRequestHandler
-from .http import HTTPResponse, DummyResponse
-from .calibrate import AngleScanner
+from . import metrics
+from .jobs import Job, QueueFull
+from .store import Storage, pack_frame, unpack_frame
+from .httpd import (
+    route, owner_only, streaming, large_body, Function, Param,
+    ParamLEDPositions, HTTPRequestHandler)
+from .http import (
+    HTTPResponse, DummyResponse, BoundedReader, not_modified, write_all,
+    write_vectored, iterencode_array,
+)
+
+# The interval (in seconds) at which idle event streams send a keep-alive
+EVENTS_KEEPALIVE = 15
 
 
 @route('/')
@@ -20,6 +33,7 @@ def home(request):
 
 
 @route('/messages.json', 'GET')
+@owner_only
 def get_messages(request):
     """
     Drains the :class:`~blinkenxmas.httpd.Messages` instance of all messages
@@ -31,19 +45,123 @@ def get_messages(request):
         body=json.dumps(request.server.messages.drain()))
 
 
+@route('/events', 'GET')
+@owner_only
+@streaming
+def get_events(request):
+    """
+    Streams `server-sent events`_ to the client. Each message shown (see
+    :meth:`~blinkenxmas.httpd.Messages.show`) is sent as an unnamed event with
+    the JSON-encoded message as its data, and removed from the buffer.
+
+    If the *angle* query parameter is specified, the current scan of that
+    angle is also reported. Each LED scanned is sent as a "scan" event with
+    an object containing the LED's *led* number, its *position* (or null if
+    it wasn't found), its *score*, and the overall *progress* of the scan.
+    The id of each "scan" event is the number of LEDs reported so far, so a
+    reconnecting client (which sends this as "Last-Event-ID") receives only
+    the LEDs it is missing. When the scan completes, a "scanned" event is sent
+    and the stream ends.
+
+    .. _server-sent events: https://html.spec.whatwg.org/multipage/server-sent-events.html
+    """
+    scanner = None
+    if 'angle' in request.query:
+        try:
+            angle = int(request.query['angle'], base=10) % 360
+            scanner = scanner_for(request, angle)
+        except ValueError:
+            return HTTPResponse(request, status_code=HTTPStatus.NOT_FOUND)
+    try:
+        since = max(0, int(request.headers.get('Last-Event-ID', '0')))
+    except ValueError:
+        since = 0
+
+    request.close_connection = True
+    request.send_response(200)
+    request.send_header('Cache-Control', 'no-cache, private')
+    request.send_header('Content-Type', 'text/event-stream')
+    request.end_headers()
+
+    messages = request.server.messages
+    try:
+        while True:
+            # The version must be read before checking for events, lest we
+            # miss any that occur between the check and the wait
+            version = messages.version
+            events = [
+                f'data: {json.dumps(msg)}\n\n'
+                for msg in messages.drain()
+            ]
+            done = False
+            if scanner is not None:
+                for led, position, score in scanner.updates(since):
+                    since += 1
+                    events.append(
+                        f'event: scan\nid: {since}\ndata: ' +
+                        json.dumps({
+                            'led': led,
+                            'position': position,
+                            'score': score,
+                            'progress': scanner.progress,
+                        }) + '\n\n')
+                done = (
+                    scanner.progress >= 1 or
+                    scanner is not request.server.calibration.scanner)
+                if done:
+                    events.append('event: scanned\ndata: {}\n\n')
+            if events:
+                write_all(request.wfile, ''.join(events).encode('utf-8'))
+            if done:
+                break
+            if messages.wait(version, timeout=EVENTS_KEEPALIVE) == version:
+                # A comment, which keeps proxies from timing out the stream,
+                # and tells us if the client has gone away
+                request.wfile.write(b': keep-alive\n\n')
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    return DummyResponse(request)
+
+
+@route('/metrics', 'GET')
+@owner_only
+def get_metrics(request):
+    """
+    Returns the server's metrics (request latencies and sizes, MQTT queue
+    depth and timings, storage query timings, etc.) in the Prometheus text
+    exposition format. In the multi-process mode (see
+    :mod:`blinkenxmas.prefork`), this includes the metrics of every process,
+    each sample labelled with the name of its "process".
+    """
+    collected = metrics.REGISTRY.collect()
+    if request.server.process_metrics is not None:
+        collected = metrics.merge_collected({
+            'owner': collected, **request.server.process_metrics})
+    return HTTPResponse(
+        request, mime_type='text/plain; version=0.0.4; charset=utf-8',
+        body=metrics.render_collected(collected))
+
+
 @route('/animations.json', 'GET')
 def get_animations(request):
     "Returns the list of defined animations as a JSON map."
-    return HTTPResponse(
-        request, mime_type='application/json',
+    # Animations are only defined at import time, so they cannot change for
+    # the lifetime of the process
+    etag = (
+        f'animations-{len(request.animations)}-'
+        f'{int(HTTPRequestHandler.static_modified.timestamp())}')
+    return not_modified(request, etag) or HTTPResponse(
+        request, mime_type='application/json', etag=etag,
         body=json.dumps({
-            # Can't JSON serialize the actual functions ...
-            fkey: func._replace(function=None, params={
-                pkey: param
-                for pkey, param in func.params.items()
-                # ... or parameters which aren't tuples (e.g. ParamFPS)
-                if isinstance(param, Param)
-            })
+            # Can't JSON serialize the actual functions (and descriptions are
+            # only rendered on demand) ...
+            fkey: func._replace(
+                function=None, description=str(func.description), params={
+                    pkey: param
+                    for pkey, param in func.params.items()
+                    # ... or parameters which aren't tuples (e.g. ParamFPS)
+                    if isinstance(param, Param)
+                })
             for fkey, func in request.animations.items()
         }))
 
@@ -51,20 +169,155 @@ def get_animations(request):
 @route('/presets.json', 'GET')
 def get_presets(request):
     "Returns the list of defined presets as a JSON array."
-    return HTTPResponse(request, mime_type='application/json',
-                        body=json.dumps(list(request.store.presets)))
+    etag = f'presets-{request.store.presets_version}'
+    return not_modified(request, etag) or HTTPResponse(
+        request, mime_type='application/json', etag=etag,
+        body=json.dumps(list(request.store.presets)))
+
+
+@route('/presets/search.json', 'GET')
+def search_presets(request):
+    """
+    Searches the presets, returning a JSON object with the "total" number of
+    matches, the "page" and "per_page" count, and a "presets" array of
+    objects describing each preset on the requested page. The query may
+    contain:
+
+    q
+        Words which must all appear (as words or word prefixes) in the
+        preset's name, tags, or description
+
+    min_duration, max_duration
+        The minimum and maximum duration of the preset in seconds
+
+    min_colors, max_colors
+        The minimum and maximum number of distinct colors in the preset
+
+    positional
+        "1" to find presets derived from LED positions, "0" to exclude them
+
+    page, per_page
+        The 1-based page of results to return, and the number of results
+        per page (default 20, at most 100)
+    """
+    # The entity-tag need not include the query as it applies only to this
+    # particular URL (query included)
+    etag = f'search-{request.store.presets_version}'
+    resp = not_modified(request, etag)
+    if resp is not None:
+        return resp
+    fps = request.server.config.fps
+    try:
+        query = request.query
+        def get(key, conv):
+            value = query.get(key, '')
+            return conv(value) if value != '' else None
+        min_duration = get('min_duration', float)
+        max_duration = get('max_duration', float)
+        positional = get('positional', int)
+        page = get('page', int) or 1
+        per_page = get('per_page', int) or 20
+        if page < 1 or not 1 <= per_page <= 100 or positional not in (
+                None, 0, 1):
+            raise ValueError('invalid paging or positional value')
+        total, presets = request.store.presets.search(
+            query.get('q', ''),
+            min_frames=None if min_duration is None else
+                       m.ceil(min_duration * fps),
+            max_frames=None if max_duration is None else
+                       m.floor(max_duration * fps),
+            min_colors=get('min_colors', int),
+            max_colors=get('max_colors', int),
+            positional=positional,
+            offset=(page - 1) * per_page, limit=per_page)
+    except (TypeError, ValueError, OverflowError) as e:
+        return HTTPResponse(
+            request, body=str(e), status_code=HTTPStatus.BAD_REQUEST)
+    return HTTPResponse(
+        request, mime_type='application/json', etag=etag,
+        body=json.dumps({
+            'total': total,
+            'page': page,
+            'per_page': per_page,
+            'presets': [
+                {
+                    'name': preset.name,
+                    'tags': preset.tags,
+                    'description': preset.description,
+                    'positional': preset.positional,
+                    'frames': preset.frames,
+                    'duration': preset.frames / fps,
+                    'colors': preset.colors,
+                }
+                for preset in presets
+            ],
+        }))
+
+
+@route('/presets.tar.gz', 'GET')
+@streaming
+def export_presets(request):
+    """
+    Streams the entire preset library, and the active LED positions, as a
+    gzip-compressed tar archive (see
+    :meth:`~blinkenxmas.store.Storage.export_archive`). The length of the
+    archive is not known in advance, so the connection is closed to mark the
+    end of the body.
+    """
+    request.close_connection = True
+    request.send_response(HTTPStatus.OK)
+    request.send_header('Content-Type', 'application/gzip')
+    request.send_header(
+        'Content-Disposition', 'attachment; filename="presets.tar.gz"')
+    request.send_header('Cache-Control', 'no-cache')
+    request.end_headers()
+    if request.command != 'HEAD':
+        try:
+            request.store.export_archive(request.wfile)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+    return DummyResponse(request)
+
+
+@route('/presets.tar.gz', 'PUT')
+@large_body
+def import_presets(request):
+    """
+    Imports a preset library archive, as produced by :func:`export_presets`,
+    from the body of the request. Like-named presets are replaced, and the
+    positions in the archive (if any) become a new active snapshot. The
+    archive is streamed from the connection and imported in a single
+    transaction, so a corrupt archive leaves the store unchanged.
+    """
+    try:
+        body_len = int(request.headers['Content-Length'])
+    except (KeyError, ValueError, TypeError):
+        return HTTPResponse(request, status_code=HTTPStatus.LENGTH_REQUIRED)
+    body = BoundedReader(request.rfile, body_len)
+    try:
+        count = request.store.import_archive(body)
+    except (tarfile.TarError, EOFError, ValueError) as e:
+        if body.remaining:
+            request.close_connection = True
+        return HTTPResponse(
+            request, body=str(e), status_code=HTTPStatus.BAD_REQUEST)
+    request.server.messages.show(f'Imported {count} preset(s)')
+    return HTTPResponse(request, status_code=HTTPStatus.NO_CONTENT)
 
 
 @route('/preset/<name>.json', 'GET')
 def get_preset(request, name):
     "Returns the animation frames for the named preset as a JSON array."
     try:
-        data = request.store.presets[name]
+        etag = f'preset-{request.store.presets.version(name)}'
     except KeyError:
         return HTTPResponse(request, status_code=HTTPStatus.NOT_FOUND)
     else:
-        return HTTPResponse(request, mime_type='application/json',
-                            body=json.dumps(data))
+        # Presets can be large, so stream the frames from the store straight
+        # into the (potentially compressed) response
+        return not_modified(request, etag, compress=True) or HTTPResponse(
+            request, mime_type='application/json', etag=etag, compress=True,
+            body=iterencode_array(request.store.presets.frames(name)))
 
 
 @route('/preset/<name>.json', 'DELETE')
@@ -80,12 +333,28 @@ def del_preset(request, name):
 
 
 @route('/preset/<name>.json', 'PUT')
+@owner_only
 def set_preset(request, name):
-    "Replaces the named preset with the JSON data from the body of the request."
+    """
+    Replaces the named preset with the JSON data from the body of the request.
+    This may either be an array of frames, or an object with a "frames" array
+    (or the "job" which generated the frames; see :func:`get_job`) and
+    optionally "tags" (an array of strings), "description" (a string), and
+    "animation" (the name of the animation that generated the frames). If
+    any of these is malformed, the preset is left unchanged.
+    """
     try:
-        data = request.json()
-        # TODO Assert that the structure is correct (voluptuous?)
-    except ValueError:
+        data, info = request.frames()
+        # Check the meta-data before writing anything, lest we store the
+        # frames only to reject the rest of the request
+        tags = info.get('tags', [])
+        if not isinstance(tags, list) or not all(
+                isinstance(tag, str) for tag in tags):
+            raise ValueError('tags must be an array of strings')
+        for key in ('description', 'animation'):
+            if not isinstance(info.get(key, ''), (str, type(None))):
+                raise ValueError(f'{key} must be a string')
+    except (KeyError, ValueError):
         return HTTPResponse(request, status_code=HTTPStatus.BAD_REQUEST)
     if name in request.store.presets:
         code = HTTPStatus.NO_CONTENT
@@ -96,9 +365,34 @@ def set_preset(request, name):
         headers= {'Location': f'/preset/{quote(name)}'}
         request.server.messages.show(f'Created preset {name}')
     request.store.presets[name] = data
+    describe_preset(request.store, name, info.get('animation'), info)
     return HTTPResponse(request, status_code=code, headers=headers)
 
 
+def describe_preset(store, name, anim_name, info):
+    """
+    Sets the meta-data of preset *name* in *store* (a
+    :class:`~blinkenxmas.store.Storage` instance) from the *info* mapping
+    (which may contain "tags" and a "description"). If *anim_name* is the name of the
+    animation that generated the preset, it is added to the tags, and the
+    preset is marked positional if the animation depends on LED positions.
+    """
+    tags = list(info.get('tags', []))
+    positional = None
+    try:
+        anim = HTTPRequestHandler.animations[anim_name]
+    except KeyError:
+        pass
+    else:
+        tags.append(anim_name)
+        positional = any(
+            isinstance(param, ParamLEDPositions)
+            for param in anim.params.values())
+    store.presets.describe(
+        name, tags=tags or None, description=info.get('description'),
+        positional=positional)
+
+
 @route('/remove', 'POST')
 def remove(request):
     "Removes the presets listed in the 'name' of the query."
@@ -121,13 +415,17 @@ def remove(request):
 
 
 @route('/preview', 'POST')
+@owner_only
 def preview(request):
     """
     Previews the animation frames provided by the JSON array in the body of the
-    request on the tree.
+    request on the tree. The body may also be an object with a "frames" array,
+    or the "job" which generated the frames (see :func:`get_job`).
     """
-    data = request.query
-    # TODO Assert that the structure is correct (voluptuous?)
+    try:
+        data, info = request.frames()
+    except (KeyError, ValueError):
+        return HTTPResponse(request, status_code=HTTPStatus.BAD_REQUEST)
     request.server.queue.put(data)
     return HTTPResponse(request, status_code=HTTPStatus.NO_CONTENT)
 
@@ -154,7 +452,14 @@ def preview_preset(request, name):
                 headers={'Location': '/index.html'})
 
 
-def generate_animation(request, anim_name, params):
+def prepare_animation(request, anim_name, params):
+    """
+    Returns a callable which will run the animation *anim_name* with
+    parameters derived from the *params* mapping, and the *request* (for
+    non-form parameters like the LED positions). The parameters are evaluated
+    immediately, so any errors in them are raised here rather than when the
+    result is called (typically in a background job).
+    """
     anim = HTTPRequestHandler.animations[anim_name]
     kwargs = {
         key: anim.params[key].value(value)
@@ -177,56 +482,171 @@ def generate_animation(request, anim_name, params):
         for key, param in anim.params.items()
         if not isinstance(param, Param)
     })
-    return anim.function(**kwargs)
+    return partial(anim.function, **kwargs)
+
+
+def generate_frames(job, func):
+    """
+    Calls *func* (as returned by :func:`prepare_animation`) within the *job*,
+    returning the generated frames as a list of packed frames (see
+    :func:`~blinkenxmas.store.pack_frame`). The job is checked for
+    cancellation between frames.
+    """
+    frames = []
+    for frame in func():
+        job.update()
+        frames.append(pack_frame([led.html for led in frame]))
+    return frames
+
+
+def job_queue_full(request, exc):
+    """
+    Returns a "503 Service Unavailable" response for the
+    :exc:`~blinkenxmas.jobs.QueueFull` exception *exc*, telling the client when
+    to retry.
+    """
+    return HTTPResponse(
+        request, status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+        headers={'Retry-After': str(exc.retry_after)},
+        body='Too many animations are being generated; please try again '
+        'shortly')
 
 
 @route('/create', 'POST')
+@owner_only
 def create_animation(request):
     """
     Given a preset name, an animation function name, and a set of parameters,
-    calls the specified animation function with the specified parameter values,
-    and creates a named preset with the resulting data.
+    queues a job to call the specified animation function with the specified
+    parameter values, and create a named preset with the resulting data. The
+    response redirects to the index immediately; a message is shown when the
+    preset has been created.
     """
     try:
         params = request.query.copy()
         name = params.pop('name')
         anim = params.pop('animation')
-        data = generate_animation(request, anim, params)
-    except (KeyError) as e:
+        func = prepare_animation(request, anim, params)
+    except (KeyError, ValueError, TypeError) as e:
         return HTTPResponse(
             request, body=str(e), status_code=HTTPStatus.BAD_REQUEST)
-    else:
+
+    config = request.server.config
+    messages = request.server.messages
+
+    def create(job):
         # TODO Assert that the structure is correct (voluptuous?)
-        data = [[led.html for led in frame] for frame in data]
-        if name in request.store.presets:
-            request.server.messages.show(f'Updated preset {name}')
+        data = generate_frames(job, func)
+        # The job runs in its own thread, which needs its own connection to
+        # the store
+        storage = Storage(config.db)
+        if name in storage.presets:
+            messages.show(f'Updated preset {name}')
         else:
-            request.server.messages.show(f'Created preset {name}')
-        request.store.presets[name] = data
-        return HTTPResponse(
-            request, status_code=HTTPStatus.SEE_OTHER,
-            headers={'Location': '/index.html'})
+            messages.show(f'Created preset {name}')
+        storage.presets[name] = data
+        describe_preset(storage, name, anim, {})
+
+    try:
+        request.server.jobs.submit(anim, create)
+    except QueueFull as exc:
+        return job_queue_full(request, exc)
+    return HTTPResponse(
+        request, status_code=HTTPStatus.SEE_OTHER,
+        headers={'Location': '/index.html'})
 
 
 @route('/animation/<name>', 'POST')
+@owner_only
 def get_animation(request, name):
     """
-    Calls the named animation function with parameters derived from the JSON
-    object in the request body, returning the generated animation frames as a
-    JSON array in the body of the response.
+    Queues a job to call the named animation function with parameters derived
+    from the JSON object in the request body. The response is "202 Accepted"
+    with the location of the job (see :func:`get_job`) in its "Location"
+    header, and the job's state as a JSON object in its body. If too many jobs
+    are queued, the response is "503 Service Unavailable" with a "Retry-After"
+    header.
     """
     try:
-        data = generate_animation(request, name, request.query)
+        func = prepare_animation(request, name, request.query)
     except (KeyError, ValueError, TypeError) as e:
         return HTTPResponse(
             request, body=str(e), status_code=HTTPStatus.BAD_REQUEST)
-    else:
-        # TODO Assert that the structure is correct (voluptuous?)
-        data = [[led.html for led in frame] for frame in data]
-        return HTTPResponse(request, body=json.dumps(data))
+    try:
+        job = request.server.jobs.submit(
+            name, lambda job: generate_frames(job, func))
+    except QueueFull as exc:
+        return job_queue_full(request, exc)
+    return HTTPResponse(
+        request, status_code=HTTPStatus.ACCEPTED,
+        headers={'Location': f'/job/{job.id}.json'},
+        mime_type='application/json', body=json.dumps(job.as_dict()))
+
+
+@route('/job/<job_id>.json', 'GET')
+@owner_only
+def get_job(request, job_id):
+    """
+    Returns a JSON object describing the state of the specified job. This
+    includes its "state" ("queued", "running", "done", "failed", or
+    "cancelled"), its "progress" (between 0 and 1, if known), its "eta" (the
+    estimated number of seconds until it finishes, if known), and its "error"
+    (if it failed). Once the job is done, "result" holds the URL of its result
+    (see :func:`get_job_result`). For animations, "frames" and "leds" also
+    summarize the result, which need not be downloaded: the job's "id" may be
+    given to :func:`preview` or :func:`set_preset` in place of the frames.
+    """
+    try:
+        job = request.server.jobs[job_id]
+    except KeyError:
+        return HTTPResponse(request, status_code=HTTPStatus.NOT_FOUND)
+    info = job.as_dict()
+    if info['state'] == Job.DONE:
+        info['result'] = f'/job/{job.id}/result.json'
+        if job.kind in HTTPRequestHandler.animations:
+            frames = job.result or []
+            info['frames'] = len(frames)
+            info['leds'] = len(frames[0]) // 3 if frames else 0
+    return HTTPResponse(
+        request, mime_type='application/json', body=json.dumps(info),
+        headers={'Cache-Control': 'no-cache'})
+
+
+@route('/job/<job_id>/result.json', 'GET')
+@owner_only
+def get_job_result(request, job_id):
+    """
+    Returns the animation frames generated by the specified job as a JSON
+    array. If the job is not done, the response is "409 Conflict".
+    """
+    try:
+        job = request.server.jobs[job_id]
+    except KeyError:
+        return HTTPResponse(request, status_code=HTTPStatus.NOT_FOUND)
+    if job.state != Job.DONE:
+        return HTTPResponse(request, status_code=HTTPStatus.CONFLICT)
+    return HTTPResponse(
+        request, mime_type='application/json', compress=True,
+        body=iterencode_array(unpack_frame(frame) for frame in job.result))
+
+
+@route('/job/<job_id>.json', 'DELETE')
+@owner_only
+def cancel_job(request, job_id):
+    """
+    Cancels the specified job. A job that is already running stops when it
+    next checks for cancellation (between frames, in the case of animations).
+    """
+    try:
+        job = request.server.jobs[job_id]
+    except KeyError:
+        return HTTPResponse(request, status_code=HTTPStatus.NOT_FOUND)
+    job.cancel()
+    return HTTPResponse(request, status_code=HTTPStatus.NO_CONTENT)
 
 
 @route('/capture.html', 'GET')
+@owner_only
 def calibration_positions(request):
     """
     Runs at the start of calibration, and immediately after each angle has been
@@ -246,6 +666,8 @@ def calibration_positions(request):
 
 
 @route('/live-preview.mjpg', 'GET')
+@owner_only
+@streaming
 def calibration_preview(request):
     """
     Continually sends JPEG frames from the camera to the client to provide the
@@ -262,22 +684,35 @@ def calibration_preview(request):
         'Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
     request.end_headers()
 
-    request.server.camera.add_client(request)
+    # Each frame is sent as a single vectored write straight to the socket
+    # where possible (the wfile is unbuffered, so this cannot re-order output)
+    target = getattr(request, 'connection', None) or request.wfile
+    camera = request.server.calibration.camera
+    mailbox = camera.add_client(request)
+    frame = None
     try:
         while True:
-            with request.server.camera.frame_ready:
-                request.server.camera.frame_ready.wait()
-                frame = request.server.camera.frame
-            request.wfile.write(b'--FRAME\r\n')
-            request.send_header('Content-Type', 'image/jpeg')
-            request.send_header('Content-Length', len(frame))
-            request.end_headers()
-            request.wfile.write(frame)
-            request.wfile.write(b'\r\n')
+            item = mailbox.get(timeout=5)
+            if item is not None:
+                sequence, frame = item
+            elif mailbox.closed:
+                break
+            elif frame is None:
+                continue
+            # Otherwise, the picture hasn't changed for a while; re-send the
+            # last frame anyway so we notice if the client has gone away
+            write_vectored(target, [
+                b'--FRAME\r\n'
+                b'Content-Type: image/jpeg\r\n'
+                b'Content-Length: %d\r\n'
+                b'\r\n' % len(frame),
+                frame,
+                b'\r\n'
+            ])
     except (BrokenPipeError, ConnectionResetError):
         pass
     finally:
-        request.server.camera.remove_client(request)
+        camera.remove_client(request)
     return DummyResponse(request)
 
 
@@ -294,6 +729,7 @@ def scanner_for(request, angle):
 
 
 @route('/angle<angle>_base.jpg', 'GET')
+@owner_only
 def calibration_base(request, angle):
     """
     Obtains the :class:`~blinkenxmas.calibrate.AngleScanner` instance for the
@@ -313,14 +749,13 @@ def calibration_base(request, angle):
             raise ValueError('Forcing scanner reset')
         scanner = scanner_for(request, angle)
     except ValueError:
-        scanner = request.server.calibration.scanner = AngleScanner(
-            angle, request.server.camera, request.server.queue,
-            request.server.config.led_strips, request.server.messages)
+        scanner = request.server.calibration.new_scanner(angle)
 
     return HTTPResponse(request, body=scanner.base, mime_type='image/jpeg')
 
 
 @route('/angle<angle>_mask.json', 'GET')
+@owner_only
 def calibration_mask(request, angle):
     """
     Returns a JSON array containing the coordinates drawn by the user around
@@ -339,6 +774,7 @@ def calibration_mask(request, angle):
 
 
 @route('/angle<angle>_state.json', 'GET')
+@owner_only
 def calibration_state(request, angle):
     """
     Returns a JSON object containing information about the progress and state
@@ -367,6 +803,7 @@ def calibration_state(request, angle):
 
 
 @route('/calibrate.html', 'GET')
+@owner_only
 def calibration_run(request):
     """
     Falls through to the :file:`calibrate.html.pt` template. Before doing so,
@@ -393,6 +830,7 @@ def calibration_run(request):
 
 
 @route('/cancel.html', 'GET')
+@owner_only
 def calibration_cancel(request):
     """
     Cancels any on-going scan of the tree angle specified in the "angle" value
@@ -413,32 +851,74 @@ def calibration_cancel(request):
 
 
 @route('/estimated.json', 'GET')
+@owner_only
 def calibration_result(request):
     """
     TODO
     """
     calculator = request.server.calibration.calculator
-    return HTTPResponse(request, body=json.dumps({
-        'positions': {
-            led: list(coords)
-            for led, coords in calculator.positions.items()
-        },
-    }), mime_type='application/json')
+    etag = f'estimated-{calculator.version}'
+    return not_modified(request, etag) or HTTPResponse(
+        request, mime_type='application/json', etag=etag,
+        body=json.dumps({
+            'positions': {
+                led: list(coords)
+                for led, coords in calculator.positions.items()
+            },
+        }))
 
 
 @route('/commit.html', 'GET')
+@owner_only
 def calibration_commit(request):
     """
-    TODO
+    Stores the positions calculated by calibration as a new snapshot of LED
+    positions, which becomes the active snapshot. Prior snapshots are retained
+    and may be restored (see :func:`activate_snapshot`).
     """
     calculator = request.server.calibration.calculator
-    with request.store:
-        request.store.positions.clear()
-        for led, position in calculator.positions.items():
-            request.store.positions[led] = position
-        calculator.clear()
+    snapshot = request.store.snapshots.add(calculator.positions)
+    calculator.clear()
+    request.server.messages.show(
+        f'Committed {len(request.store.positions)} LED positions to the '
+        f'database as snapshot {snapshot}')
+    return HTTPResponse(
+        request, status_code=HTTPStatus.SEE_OTHER,
+        headers={'Location': '/index.html'})
+
+
+@route('/snapshots.json', 'GET')
+def get_snapshots(request):
+    """
+    Returns the list of stored snapshots of LED positions as a JSON array of
+    objects, each of which details the snapshot's number, creation timestamp,
+    number of positions, and whether it is the active snapshot.
+    """
+    active = request.store.snapshots.active
+    return HTTPResponse(request, mime_type='application/json', body=json.dumps([
+        {
+            'snapshot': snapshot.snapshot,
+            'created':  snapshot.created.isoformat(),
+            'count':    snapshot.count,
+            'active':   snapshot.snapshot == active,
+        }
+        for snapshot in request.store.snapshots.values()
+    ]))
+
+
+@route('/snapshot/<snapshot>', 'POST')
+def activate_snapshot(request, snapshot):
+    """
+    Makes the specified snapshot of LED positions the active one. This is
+    primarily intended for rolling back a bad calibration.
+    """
+    try:
+        request.store.snapshots.active = int(snapshot)
+    except (KeyError, ValueError):
+        return HTTPResponse(request, status_code=HTTPStatus.NOT_FOUND)
     request.server.messages.show(
-        f'Committed {len(request.store.positions)} LED positions to the database')
+        f'Activated snapshot {snapshot} with {len(request.store.positions)} '
+        f'LED positions')
     return HTTPResponse(
         request, status_code=HTTPStatus.SEE_OTHER,
         headers={'Location': '/index.html'})
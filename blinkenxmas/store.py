@@ -1,9 +1,54 @@
+import io
 import json
+import time
 import math as m
 import sqlite3
+import tarfile
+import hashlib
 import logging
+import datetime as dt
+from urllib.parse import quote, unquote
 from collections import namedtuple
-from collections.abc import MutableMapping
+from collections.abc import Mapping, MutableMapping
+
+from colorzero import Color
+
+from . import metrics
+
+
+# The size of the hashes used to identify frame blocks
+HASH_SIZE = hashlib.sha1().digest_size
+
+QUERY_SECONDS = metrics.Histogram(
+    'blinkenxmas_storage_query_seconds',
+    'Time taken to execute SQL statements, by the type of statement',
+    ('statement',))
+
+
+def pack_frame(frame):
+    """
+    Convert *frame*, a sequence of HTML color specifications (e.g.
+    "#ff0000"), into the compact :class:`bytes` representation used by the
+    store, which consists of three bytes (red, green, and blue) per LED.
+    Frames which are already in this representation are returned unchanged.
+    """
+    if isinstance(frame, bytes):
+        return frame
+    elif all(len(color) == 7 and color[0] == '#' for color in frame):
+        # Fast path for the common case of a frame of "#rrggbb" strings
+        return bytes.fromhex(''.join(color[1:] for color in frame))
+    else:
+        return b''.join(bytes(Color(color).rgb_bytes) for color in frame)
+
+
+def unpack_frame(data):
+    """
+    The inverse of :func:`pack_frame`; converts *data*, a :class:`bytes`
+    string of three bytes per LED, into a :class:`list` of HTML color
+    specifications.
+    """
+    data = data.hex()
+    return ['#' + data[i:i + 6] for i in range(0, len(data), 6)]
 
 
 class Position(namedtuple('Position', ('x', 'y', 'z', 'a', 'r'))):
@@ -30,7 +75,12 @@ class Position(namedtuple('Position', ('x', 'y', 'z', 'a', 'r'))):
 
 class StoragePositions(MutableMapping):
     """
-    TODO
+    A mutable mapping of LED indexes to :class:`Position` instances.
+
+    The mapping always reflects the active snapshot of positions (see
+    :class:`StorageSnapshots`). Any modification made through this mapping
+    applies to the active snapshot, and increments
+    :attr:`Storage.positions_version`.
     """
 
     def __init__(self, connection):
@@ -38,55 +88,132 @@ class StoragePositions(MutableMapping):
 
     def _create_tables(self):
         with self._conn:
+            for table in ('active_snapshot', 'positions', 'snapshots'):
+                self._conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self._create_snapshots()
             self._conn.execute(
-                "DROP TABLE IF EXISTS positions")
+                "INSERT INTO snapshots (snapshot) VALUES (1)")
             self._conn.execute(
-                """
-                CREATE TABLE positions (
-                    led  INTEGER NOT NULL,
-                    y    NUMBER NOT NULL,
-                    a    NUMBER NOT NULL,
-                    r    NUMBER NOT NULL,
-
-                    CONSTRAINT presets_pk PRIMARY KEY (led),
-                    CONSTRAINT coords_ck CHECK (
-                        y BETWEEN 0 AND 1 AND
-                        a BETWEEN 0 AND 360 AND
-                        r BETWEEN 0 AND 1
-                    )
+                "INSERT INTO active_snapshot (snapshot, version) VALUES (1, 0)")
+
+    def _create_snapshots(self):
+        self._conn.execute(
+            """
+            CREATE TABLE snapshots (
+                snapshot INTEGER NOT NULL,
+                created  TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+
+                CONSTRAINT snapshots_pk PRIMARY KEY (snapshot)
+            )
+            """)
+        self._conn.execute(
+            """
+            CREATE TABLE positions (
+                snapshot INTEGER NOT NULL,
+                led      INTEGER NOT NULL,
+                y        NUMBER NOT NULL,
+                a        NUMBER NOT NULL,
+                r        NUMBER NOT NULL,
+
+                CONSTRAINT positions_pk PRIMARY KEY (snapshot, led),
+                CONSTRAINT positions_snapshots_fk FOREIGN KEY (snapshot)
+                    REFERENCES snapshots (snapshot),
+                CONSTRAINT coords_ck CHECK (
+                    y BETWEEN 0 AND 1 AND
+                    a BETWEEN 0 AND 360 AND
+                    r BETWEEN 0 AND 1
                 )
-                """)
+            )
+            """)
+        self._conn.execute(
+            """
+            CREATE TABLE active_snapshot (
+                snapshot INTEGER NOT NULL,
+                version  INTEGER NOT NULL,
+
+                CONSTRAINT active_snapshot_snapshots_fk FOREIGN KEY (snapshot)
+                    REFERENCES snapshots (snapshot),
+                CONSTRAINT active_snapshot_version_ck CHECK (version >= 0)
+            )
+            """)
+
+    def _upgrade_tables(self):
+        # Prior to version 5, there was a single set of positions; this
+        # becomes the first (and active) snapshot
+        self._conn.execute("ALTER TABLE positions RENAME TO old_positions")
+        self._create_snapshots()
+        self._conn.execute("INSERT INTO snapshots (snapshot) VALUES (1)")
+        self._conn.execute(
+            "INSERT INTO active_snapshot (snapshot, version) VALUES (1, 0)")
+        self._conn.execute(
+            """
+            INSERT INTO positions (snapshot, led, y, a, r)
+            SELECT 1, led, y, a, r FROM old_positions
+            """)
+        self._conn.execute("DROP TABLE old_positions")
+
+    def _changed(self):
+        self._conn.execute(
+            "UPDATE active_snapshot SET version = version + 1")
 
     def __bool__(self):
-        sql = "SELECT 1 FROM positions"
+        sql = (
+            """
+            SELECT 1 FROM positions
+            WHERE snapshot = (SELECT snapshot FROM active_snapshot)
+            """)
         for row in self._conn.execute(sql):
             return True
         return False
 
     def __len__(self):
-        sql = "SELECT COUNT(*) FROM positions"
+        sql = (
+            """
+            SELECT COUNT(*) FROM positions
+            WHERE snapshot = (SELECT snapshot FROM active_snapshot)
+            """)
         for row in self._conn.execute(sql):
             return row[0]
         return 0
 
     def __iter__(self):
-        sql = "SELECT led FROM positions ORDER BY led"
+        sql = (
+            """
+            SELECT led FROM positions
+            WHERE snapshot = (SELECT snapshot FROM active_snapshot)
+            ORDER BY led
+            """)
         for row in self._conn.execute(sql):
             yield row['led']
 
     def items(self):
-        sql = "SELECT led, y, a, r FROM positions ORDER BY led"
+        sql = (
+            """
+            SELECT led, y, a, r FROM positions
+            WHERE snapshot = (SELECT snapshot FROM active_snapshot)
+            ORDER BY led
+            """)
         for row in self._conn.execute(sql):
             yield row['led'], Position.from_polar(row['y'], row['a'], row['r'])
 
     def __contains__(self, led):
-        sql = "SELECT 1 FROM positions WHERE led = ?"
+        sql = (
+            """
+            SELECT 1 FROM positions
+            WHERE snapshot = (SELECT snapshot FROM active_snapshot)
+            AND led = ?
+            """)
         for row in self._conn.execute(sql, (led,)):
             return True
         return False
 
     def __getitem__(self, led):
-        sql = "SELECT y, a, r FROM positions WHERE led = ?"
+        sql = (
+            """
+            SELECT y, a, r FROM positions
+            WHERE snapshot = (SELECT snapshot FROM active_snapshot)
+            AND led = ?
+            """)
         for row in self._conn.execute(sql, (led,)):
             return Position.from_polar(row['y'], row['a'], row['r'])
         raise KeyError(led)
@@ -96,26 +223,239 @@ class StoragePositions(MutableMapping):
             position = Position.from_cartesian(*position)
         sql = (
             """
-            INSERT INTO positions (led, y, a, r) VALUES (?, ?, ?, ?)
-            ON CONFLICT (led) DO UPDATE SET y = ?, a = ?, r = ?
+            INSERT INTO positions (snapshot, led, y, a, r)
+            SELECT snapshot, ?, ?, ?, ? FROM active_snapshot
+            -- The WHERE clause is required to resolve a parsing ambiguity
+            -- between the join syntax and the upsert's ON CONFLICT
+            WHERE true
+            ON CONFLICT (snapshot, led) DO UPDATE SET y = ?, a = ?, r = ?
             """)
         with self._conn:
             self._conn.execute(sql, (
                 led, position.y, position.a, position.r,
                 position.y, position.a, position.r))
+            self._changed()
 
     def __delitem__(self, led):
-        sql = "DELETE FROM positions WHERE led = ?"
+        sql = (
+            """
+            DELETE FROM positions
+            WHERE snapshot = (SELECT snapshot FROM active_snapshot)
+            AND led = ?
+            """)
         with self._conn:
             cur = self._conn.cursor()
             cur.execute(sql, (led,))
             if cur.rowcount < 1:
                 raise KeyError(led)
+            self._changed()
+
+    def clear(self):
+        sql = (
+            """
+            DELETE FROM positions
+            WHERE snapshot = (SELECT snapshot FROM active_snapshot)
+            """)
+        with self._conn:
+            self._conn.execute(sql)
+            self._changed()
+
+
+class Snapshot(namedtuple('Snapshot', ('snapshot', 'created', 'count'))):
+    """
+    Describes a snapshot of LED positions in :class:`StorageSnapshots`.
+
+    .. attribute:: snapshot
+
+        The number identifying the snapshot.
+
+    .. attribute:: created
+
+        The timezone-aware :class:`~datetime.datetime` at which the snapshot
+        was created.
+
+    .. attribute:: count
+
+        The number of LED positions within the snapshot.
+    """
+
+
+class StorageSnapshots(Mapping):
+    """
+    A mapping of snapshot numbers to :class:`Snapshot` instances describing
+    all stored snapshots of LED positions.
+
+    Exactly one snapshot is "active" at any given time (see :attr:`active`);
+    this is the snapshot reflected by :class:`StoragePositions`. New
+    snapshots may be created with :meth:`add`, and the active snapshot can be
+    switched (for instance, to roll back a bad calibration) by assigning to
+    :attr:`active`.
+    """
+
+    def __init__(self, connection):
+        self._conn = connection
+
+    def __len__(self):
+        sql = "SELECT COUNT(*) FROM snapshots"
+        for row in self._conn.execute(sql):
+            return row[0]
+        return 0
+
+    def __iter__(self):
+        sql = "SELECT snapshot FROM snapshots ORDER BY snapshot"
+        for row in self._conn.execute(sql):
+            yield row['snapshot']
+
+    def __contains__(self, snapshot):
+        sql = "SELECT 1 FROM snapshots WHERE snapshot = ?"
+        for row in self._conn.execute(sql, (snapshot,)):
+            return True
+        return False
+
+    def __getitem__(self, snapshot):
+        sql = (
+            """
+            SELECT s.snapshot, s.created, COUNT(p.led) AS count
+            FROM
+                snapshots s
+                LEFT JOIN positions p ON p.snapshot = s.snapshot
+            WHERE s.snapshot = ?
+            GROUP BY s.snapshot, s.created
+            """)
+        for row in self._conn.execute(sql, (snapshot,)):
+            return Snapshot(
+                row['snapshot'],
+                dt.datetime.fromisoformat(row['created']).replace(
+                    tzinfo=dt.timezone.utc),
+                row['count'])
+        raise KeyError(snapshot)
+
+    def __delitem__(self, snapshot):
+        if snapshot == self.active:
+            raise ValueError(f'cannot remove active snapshot {snapshot}')
+        with self._conn:
+            self._conn.execute(
+                "DELETE FROM positions WHERE snapshot = ?", (snapshot,))
+            cur = self._conn.cursor()
+            cur.execute(
+                "DELETE FROM snapshots WHERE snapshot = ?", (snapshot,))
+            if cur.rowcount < 1:
+                raise KeyError(snapshot)
+
+    @property
+    def active(self):
+        """
+        The number of the active snapshot. Assigning a different snapshot
+        number to this property switches the active snapshot; this is a
+        constant time operation regardless of the number of positions in the
+        snapshot.
+        """
+        sql = "SELECT snapshot FROM active_snapshot"
+        for row in self._conn.execute(sql):
+            return row['snapshot']
+
+    @active.setter
+    def active(self, value):
+        with self._conn:
+            if value not in self:
+                raise KeyError(value)
+            self._conn.execute(
+                """
+                UPDATE active_snapshot SET
+                    snapshot = ?,
+                    version = version + 1
+                WHERE snapshot <> ?
+                """, (value, value))
+
+    def add(self, positions):
+        """
+        Create a new snapshot from *positions*, a mapping of LED indexes to
+        :class:`Position` instances (or (x, y, z) tuples), and make it the
+        :attr:`active` snapshot. Returns the number of the new snapshot.
+        """
+        with self._conn:
+            return self._add(positions)
+
+    def _add(self, positions):
+        cur = self._conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO snapshots (snapshot)
+            SELECT COALESCE(MAX(snapshot), 0) + 1 FROM snapshots
+            """)
+        snapshot = cur.lastrowid
+        self._conn.executemany(
+            "INSERT INTO positions (snapshot, led, y, a, r) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                (snapshot, led, position.y, position.a, position.r)
+                for led, position in (
+                    (led, position
+                          if isinstance(position, Position) else
+                          Position.from_cartesian(*position))
+                    for led, position in positions.items()
+                )
+            ))
+        self._conn.execute(
+            """
+            UPDATE active_snapshot SET
+                snapshot = ?,
+                version = version + 1
+            """, (snapshot,))
+        return snapshot
+
+
+class PresetInfo(namedtuple('PresetInfo', (
+    'name', 'tags', 'description', 'positional', 'frames', 'colors'))):
+    """
+    Describes a preset in :class:`StoragePresets`, as returned by
+    :meth:`~StoragePresets.info` and :meth:`~StoragePresets.search`.
+
+    .. attribute:: name
+
+        The name of the preset.
+
+    .. attribute:: tags
+
+        A list of strings tagging the preset.
+
+    .. attribute:: description
+
+        A free-form description of the preset.
+
+    .. attribute:: positional
+
+        :data:`True` if the preset's frames were derived from the LED
+        positions.
+
+    .. attribute:: frames
+
+        The number of frames in the preset.
+
+    .. attribute:: colors
+
+        The number of distinct colors (including black) used across all
+        frames of the preset.
+    """
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            row['name'], [tag for tag in row['tags'].split(',') if tag],
+            row['description'], bool(row['positional']), row['frames'],
+            row['colors'])
 
 
 class StoragePresets(MutableMapping):
     """
-    TODO
+    A mutable mapping of preset names to animation frames.
+
+    Frames are stored as content-addressed blocks (see :func:`pack_frame`),
+    each of which is kept once in the "blocks" table no matter how many
+    presets (or how many frames within a preset) refer to it. Each block
+    carries a reference count which is maintained by triggers on the
+    "preset_frames" table; unreferenced blocks are removed at the end of each
+    write or deletion.
     """
 
     def __init__(self, connection):
@@ -123,17 +463,217 @@ class StoragePresets(MutableMapping):
 
     def _create_tables(self):
         with self._conn:
+            self._create_presets()
+            self._create_counters()
+            self._create_blocks()
+            self._create_search()
+
+    def _create_counters(self):
+        self._conn.execute(
+            """
+            CREATE TABLE counters (
+                name    VARCHAR(20) NOT NULL,
+                counter INTEGER DEFAULT 0 NOT NULL,
+
+                CONSTRAINT counters_pk PRIMARY KEY (name),
+                CONSTRAINT counters_counter_ck CHECK (counter >= 0)
+            )
+            """)
+        self._conn.execute("INSERT INTO counters (name) VALUES ('presets')")
+
+    def _create_presets(self):
+        self._conn.execute(
+            """
+            CREATE TABLE presets (
+                name        VARCHAR(200) NOT NULL,
+                tags        TEXT DEFAULT '' NOT NULL,
+                description TEXT DEFAULT '' NOT NULL,
+                positional  INTEGER DEFAULT 0 NOT NULL,
+                frames      INTEGER DEFAULT 0 NOT NULL,
+                colors      INTEGER DEFAULT 0 NOT NULL,
+                version     INTEGER DEFAULT 0 NOT NULL,
+
+                CONSTRAINT presets_pk PRIMARY KEY (name),
+                CONSTRAINT presets_name_ck CHECK (name <> ''),
+                CONSTRAINT presets_positional_ck CHECK (positional IN (0, 1))
+            )
+            """)
+
+    def _create_blocks(self):
+        self._conn.execute(
+            """
+            CREATE TABLE blocks (
+                hash BLOB NOT NULL,
+                refs INTEGER DEFAULT 0 NOT NULL,
+                data BLOB NOT NULL,
+
+                CONSTRAINT blocks_pk PRIMARY KEY (hash),
+                CONSTRAINT blocks_refs_ck CHECK (refs >= 0)
+            )
+            """)
+        self._conn.execute(
+            """
+            CREATE TABLE preset_frames (
+                name  VARCHAR(200) NOT NULL,
+                frame INTEGER NOT NULL,
+                hash  BLOB NOT NULL,
+
+                CONSTRAINT preset_frames_pk PRIMARY KEY (name, frame),
+                CONSTRAINT preset_frames_presets_fk FOREIGN KEY (name)
+                    REFERENCES presets (name),
+                CONSTRAINT preset_frames_blocks_fk FOREIGN KEY (hash)
+                    REFERENCES blocks (hash),
+                CONSTRAINT preset_frames_frame_ck CHECK (frame >= 0)
+            )
+            """)
+        self._conn.execute(
+            """
+            CREATE INDEX preset_frames_hash ON preset_frames (hash)
+            """)
+        self._conn.execute(
+            """
+            CREATE TRIGGER preset_frames_insert
+            AFTER INSERT ON preset_frames
+            FOR EACH ROW
+            BEGIN
+                UPDATE blocks SET refs = refs + 1 WHERE hash = NEW.hash;
+            END
+            """)
+        self._conn.execute(
+            """
+            CREATE TRIGGER preset_frames_delete
+            AFTER DELETE ON preset_frames
+            FOR EACH ROW
+            BEGIN
+                UPDATE blocks SET refs = refs - 1 WHERE hash = OLD.hash;
+            END
+            """)
+        self._conn.execute(
+            """
+            CREATE INDEX blocks_unused ON blocks (hash) WHERE refs = 0
+            """)
+
+    def _create_search(self):
+        for column in ('positional', 'frames', 'colors'):
             self._conn.execute(
-                """
-                CREATE TABLE presets (
-                    name VARCHAR(200) NOT NULL,
-                    data TEXT NOT NULL,
+                f"CREATE INDEX presets_{column} ON presets ({column})")
+        # The full-text index is keyed by name (rather than rowid, which may
+        # change on VACUUM as presets has no INTEGER PRIMARY KEY) and kept in
+        # sync with presets by the triggers below
+        self._conn.execute(
+            """
+            CREATE VIRTUAL TABLE presets_search USING fts5 (
+                name, tags, description
+            )
+            """)
+        self._conn.execute(
+            """
+            CREATE TRIGGER presets_search_insert
+            AFTER INSERT ON presets
+            FOR EACH ROW
+            BEGIN
+                INSERT INTO presets_search (name, tags, description)
+                VALUES (NEW.name, NEW.tags, NEW.description);
+            END
+            """)
+        self._conn.execute(
+            """
+            CREATE TRIGGER presets_search_update
+            AFTER UPDATE OF tags, description ON presets
+            FOR EACH ROW
+            BEGIN
+                UPDATE presets_search SET
+                    tags = NEW.tags,
+                    description = NEW.description
+                WHERE name = OLD.name;
+            END
+            """)
+        self._conn.execute(
+            """
+            CREATE TRIGGER presets_search_delete
+            AFTER DELETE ON presets
+            FOR EACH ROW
+            BEGIN
+                DELETE FROM presets_search WHERE name = OLD.name;
+            END
+            """)
+
+    def _upgrade_tables(self):
+        # Prior to version 4, presets were stored as a single JSON blob per
+        # preset; split them into frame blocks
+        self._conn.execute("ALTER TABLE presets RENAME TO old_presets")
+        self._create_presets()
+        self._create_counters()
+        self._create_blocks()
+        self._create_search()
+        for row in self._conn.execute(
+                "SELECT name, data FROM old_presets").fetchall():
+            self._write(row['name'], json.loads(row['data']))
+        self._conn.execute("DROP TABLE old_presets")
 
-                    CONSTRAINT presets_pk PRIMARY KEY (name),
-                    CONSTRAINT presets_name_ck CHECK (name <> ''),
-                    CONSTRAINT presets_data_ck CHECK (data <> '')
+    def _upgrade_search(self):
+        # Prior to version 6, presets had no meta-data and no search index
+        for column in (
+            "tags TEXT DEFAULT '' NOT NULL",
+            "description TEXT DEFAULT '' NOT NULL",
+            "positional INTEGER DEFAULT 0 NOT NULL "
+            "CONSTRAINT presets_positional_ck CHECK (positional IN (0, 1))",
+            "frames INTEGER DEFAULT 0 NOT NULL",
+            "colors INTEGER DEFAULT 0 NOT NULL",
+        ):
+            self._conn.execute(f"ALTER TABLE presets ADD COLUMN {column}")
+        self._create_search()
+        self._conn.execute(
+            """
+            INSERT INTO presets_search (name, tags, description)
+            SELECT name, tags, description FROM presets
+            """)
+        for row in self._conn.execute("SELECT name FROM presets").fetchall():
+            self._update_stats(row['name'])
+
+    def _upgrade_versions(self):
+        # Prior to version 7, there were no change counters
+        self._conn.execute(
+            "ALTER TABLE presets ADD COLUMN version INTEGER DEFAULT 0 NOT NULL")
+        self._create_counters()
+
+    def _changed(self, preset):
+        # Increment the table's change counter, and stamp the changed preset
+        # (if it still exists) with the new value. As the table's counter
+        # never decreases, a preset's version is never re-used, even if the
+        # preset is deleted and re-created
+        self._conn.execute(
+            "UPDATE counters SET counter = counter + 1 WHERE name = 'presets'")
+        self._conn.execute(
+            """
+            UPDATE presets SET
+                version = (
+                    SELECT counter FROM counters WHERE name = 'presets'
                 )
-                """)
+            WHERE name = ?
+            """, (preset,))
+
+    @property
+    def versions(self):
+        """
+        An :class:`int` which is incremented whenever any preset is created,
+        modified, or deleted. This is cheap to query, and thus suitable for
+        keying caches of anything derived from the presets.
+        """
+        sql = "SELECT counter FROM counters WHERE name = 'presets'"
+        for row in self._conn.execute(sql):
+            return row['counter']
+
+    def version(self, preset):
+        """
+        Return an :class:`int` which changes whenever *preset* is modified,
+        or raise :exc:`KeyError` if *preset* does not exist. Versions are
+        unique across all presets and never re-used.
+        """
+        sql = "SELECT version FROM presets WHERE name = ?"
+        for row in self._conn.execute(sql, (preset,)):
+            return row['version']
+        raise KeyError(preset)
 
     def __bool__(self):
         sql = "SELECT 1 FROM presets"
@@ -159,30 +699,286 @@ class StoragePresets(MutableMapping):
         return False
 
     def __getitem__(self, preset):
-        sql = "SELECT data FROM presets WHERE name = ?"
-        for row in self._conn.execute(sql, (preset,)):
-            return json.loads(row['data'])
-        raise KeyError(preset)
+        return list(self.frames(preset))
 
-    def __setitem__(self, preset, data):
-        # TODO Assert that the structure is correct (voluptuous? Or just
-        # decompose it into tables?)
-        data = json.dumps(data)
+    def frames(self, preset, *, batch_size=100):
+        """
+        Yields the frames of *preset* in order, or raises :exc:`KeyError` if
+        *preset* does not exist. Unlike :meth:`__getitem__`, the frames are
+        read from the store in batches of *batch_size* so that only a batch
+        of frames is ever held in memory, and the database is never held
+        locked for the duration of the iteration.
+
+        If *preset* is replaced part-way through the iteration, the frames
+        yielded may be drawn from both versions; callers which care about
+        this should compare :meth:`version` before and after.
+        """
         sql = (
             """
-            INSERT INTO presets (name, data) VALUES (?, ?)
-            ON CONFLICT (name) DO UPDATE SET data = ?
+            SELECT f.frame, f.hash, b.data
+            FROM
+                presets p
+                LEFT JOIN preset_frames f
+                    ON f.name = p.name AND f.frame >= ?
+                LEFT JOIN blocks b ON b.hash = f.hash
+            WHERE p.name = ?
+            ORDER BY f.frame
+            LIMIT ?
             """)
+        start = 0
+        last_hash = last_frame = None
+        while True:
+            rows = self._conn.execute(
+                sql, (start, preset, batch_size)).fetchall()
+            if not rows:
+                if start == 0:
+                    raise KeyError(preset)
+                return
+            for row in rows:
+                if row['hash'] is None:
+                    return
+                # Consecutive frames are frequently identical (e.g. when an
+                # animation holds a pattern), so avoid unpacking them again
+                if row['hash'] != last_hash:
+                    last_hash = row['hash']
+                    last_frame = unpack_frame(row['data'])
+                yield last_frame.copy()
+                start = row['frame'] + 1
+            if len(rows) < batch_size:
+                return
+
+    def __setitem__(self, preset, data):
+        # TODO Assert that the structure is correct (voluptuous?)
         with self._conn:
-            self._conn.execute(sql, (preset, data, data))
+            self._write(preset, data)
 
     def __delitem__(self, preset):
-        sql = "DELETE FROM presets WHERE name = ?"
         with self._conn:
+            self._conn.execute(
+                "DELETE FROM preset_frames WHERE name = ?", (preset,))
             cur = self._conn.cursor()
-            cur.execute(sql, (preset,))
+            cur.execute("DELETE FROM presets WHERE name = ?", (preset,))
             if cur.rowcount < 1:
                 raise KeyError(preset)
+            self._changed(preset)
+            self._collect()
+
+    def _collect(self):
+        # Remove all blocks that are no longer referenced by any preset. The
+        # partial blocks_unused index ensures this doesn't scan the table
+        self._conn.execute("DELETE FROM blocks WHERE refs = 0")
+
+    def _write(self, preset, data):
+        # Hash each frame, noting the unique blocks; identical frames (within
+        # this preset or any other) are only stored once
+        blocks = {}
+        hashes = []
+        for frame in data:
+            frame = pack_frame(frame)
+            key = hashlib.sha1(frame).digest()
+            blocks.setdefault(key, frame)
+            hashes.append(key)
+        # Blocks which already exist (perhaps from the prior version of this
+        # preset) are left untouched; their reference counts are adjusted by
+        # the triggers on preset_frames, and any left unreferenced are only
+        # removed once the new frames are in place
+        self._write_blocks(blocks.items())
+        self._link(preset, hashes)
+        self._collect()
+
+    def _write_blocks(self, blocks):
+        self._conn.executemany(
+            "INSERT INTO blocks (hash, data) VALUES (?, ?) "
+            "ON CONFLICT (hash) DO NOTHING",
+            blocks)
+
+    def _link(self, preset, hashes):
+        # Associate the sequence of block *hashes* with *preset*, replacing
+        # any existing frames. Blocks this leaves unreferenced are *not*
+        # removed; the caller must call _collect when appropriate
+        self._conn.execute(
+            "INSERT INTO presets (name) VALUES (?) ON CONFLICT (name) DO NOTHING",
+            (preset,))
+        self._conn.execute(
+            "DELETE FROM preset_frames WHERE name = ?", (preset,))
+        self._conn.executemany(
+            "INSERT INTO preset_frames (name, frame, hash) VALUES (?, ?, ?)",
+            ((preset, frame, key) for frame, key in enumerate(hashes)))
+        self._update_stats(preset)
+        self._changed(preset)
+
+    def _update_stats(self, preset):
+        # Re-calculate the number of frames, and the number of distinct
+        # colors used in those frames, for the search filters
+        colors = set()
+        for row in self._conn.execute(
+            """
+            SELECT data FROM blocks
+            WHERE hash IN (SELECT hash FROM preset_frames WHERE name = ?)
+            """, (preset,)
+        ):
+            data = row['data']
+            colors.update(data[i:i + 3] for i in range(0, len(data), 3))
+        self._conn.execute(
+            """
+            UPDATE presets SET
+                frames = (SELECT COUNT(*) FROM preset_frames WHERE name = ?),
+                colors = ?
+            WHERE name = ?
+            """, (preset, len(colors), preset))
+
+    def info(self, preset):
+        """
+        Return a :class:`PresetInfo` describing *preset*, or raise
+        :exc:`KeyError` if it does not exist.
+        """
+        sql = (
+            """
+            SELECT name, tags, description, positional, frames, colors
+            FROM presets WHERE name = ?
+            """)
+        for row in self._conn.execute(sql, (preset,)):
+            return PresetInfo.from_row(row)
+        raise KeyError(preset)
+
+    def describe(self, preset, *, tags=None, description=None,
+                 positional=None):
+        """
+        Update the meta-data of *preset*. The *tags* are a sequence of
+        strings, *description* is a string, and *positional* is a
+        :class:`bool` indicating whether the preset's frames were derived
+        from the LED positions. Parameters which are :data:`None` are left
+        unchanged. Raises :exc:`KeyError` if *preset* does not exist.
+        """
+        with self._conn:
+            self._describe(preset, tags=tags, description=description,
+                           positional=positional)
+
+    def _describe(self, preset, *, tags=None, description=None,
+                  positional=None):
+        changes = {}
+        if tags is not None:
+            # Tags are stored comma-separated, which FTS5's default
+            # tokenizer treats as a word separator
+            changes['tags'] = ','.join(
+                tag for tag in (
+                    tag.replace(',', ' ').strip() for tag in tags
+                ) if tag)
+        if description is not None:
+            changes['description'] = description
+        if positional is not None:
+            changes['positional'] = int(bool(positional))
+        if not changes:
+            if preset not in self:
+                raise KeyError(preset)
+            return
+        columns = ', '.join(f'{column} = ?' for column in changes)
+        cur = self._conn.cursor()
+        cur.execute(
+            f"UPDATE presets SET {columns} WHERE name = ?",
+            (*changes.values(), preset))
+        if cur.rowcount < 1:
+            raise KeyError(preset)
+        self._changed(preset)
+
+    def search(self, text='', *, min_frames=None, max_frames=None,
+               min_colors=None, max_colors=None, positional=None,
+               offset=0, limit=None):
+        """
+        Search the presets, returning a tuple of the total number of matches,
+        and a list of :class:`PresetInfo` for the matches from *offset*, up to
+        *limit* entries (or all remaining entries if *limit* is
+        :data:`None`).
+
+        If *text* is not blank, presets must contain all words within *text*
+        (or words beginning with them) in their name, tags, or description,
+        and are ordered by relevance (matches in the name rank highest).
+        Otherwise, presets are ordered by name. The remaining parameters
+        filter the number of frames or colors (inclusively), or whether the
+        preset is positional; filters which are :data:`None` are ignored.
+        """
+        clauses = []
+        params = []
+        for column, op, value in (
+            ('frames', '>=', min_frames),
+            ('frames', '<=', max_frames),
+            ('colors', '>=', min_colors),
+            ('colors', '<=', max_colors),
+            ('positional', '=', None if positional is None else
+             int(bool(positional))),
+        ):
+            if value is not None:
+                clauses.append(f'p.{column} {op} ?')
+                params.append(value)
+        words = text.split()
+        if words:
+            source = (
+                """
+                presets_search s
+                JOIN presets p ON p.name = s.name
+                """)
+            # Quote each word so that FTS5 query syntax in the input is
+            # treated literally, then match it as a prefix
+            clauses.insert(0, 'presets_search MATCH ?')
+            params.insert(0, ' '.join(
+                '"{}"*'.format(word.replace('"', '""')) for word in words))
+            order = 'bm25(presets_search, 10.0, 5.0, 1.0), p.name'
+        else:
+            source = 'presets p'
+            order = 'p.name'
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        for row in self._conn.execute(
+                f"SELECT COUNT(*) FROM {source} {where}", params):
+            total = row[0]
+        sql = (
+            f"""
+            SELECT p.name, p.tags, p.description, p.positional, p.frames,
+                p.colors
+            FROM {source} {where}
+            ORDER BY {order}
+            LIMIT ? OFFSET ?
+            """)
+        return total, [
+            PresetInfo.from_row(row)
+            for row in self._conn.execute(sql, (
+                *params, -1 if limit is None else limit, offset))
+        ]
+
+    def _hashes(self, preset):
+        sql = "SELECT hash FROM preset_frames WHERE name = ? ORDER BY frame"
+        for row in self._conn.execute(sql, (preset,)):
+            yield row['hash']
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    A :class:`sqlite3.Cursor` which records the time taken to execute each
+    statement in the storage metrics. Note this includes only the time taken
+    to produce the first row of a query's results.
+    """
+    def execute(self, sql, *args):
+        with QUERY_SECONDS.time(statement=sql.split(None, 1)[0].upper()):
+            return super().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        with QUERY_SECONDS.time(statement=sql.split(None, 1)[0].upper()):
+            return super().executemany(sql, *args)
+
+
+class TimedConnection(sqlite3.Connection):
+    """
+    A :class:`sqlite3.Connection` whose cursors (including those implicitly
+    created by :meth:`execute` and :meth:`executemany`) are
+    :class:`TimedCursor` instances.
+    """
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
 
 
 class Storage:
@@ -190,7 +986,7 @@ class Storage:
     TODO
     """
 
-    schema_version = 3
+    schema_version = 7
     logger = logging.getLogger('storage')
 
     def __init__(self, db):
@@ -198,10 +994,11 @@ class Storage:
             raise RuntimeError(
                 'sqlite3 must be compiled with at least basic multi-thread '
                 'capabilities')
-        self._conn = sqlite3.connect(db)
+        self._conn = sqlite3.connect(db, factory=TimedConnection)
         self._conn.row_factory = sqlite3.Row
         self._presets = StoragePresets(self._conn)
         self._positions = StoragePositions(self._conn)
+        self._snapshots = StorageSnapshots(self._conn)
         self._create_tables()
 
     def __enter__(self):
@@ -221,10 +1018,202 @@ class Storage:
     def positions(self):
         return self._positions
 
+    @property
+    def snapshots(self):
+        return self._snapshots
+
+    @property
+    def presets_version(self):
+        """
+        An :class:`int` which is incremented whenever any preset changes (see
+        :attr:`StoragePresets.versions`).
+        """
+        return self._presets.versions
+
+    @property
+    def positions_version(self):
+        """
+        An :class:`int` which is incremented whenever the active positions
+        change, whether by modification of :attr:`positions` or by a change
+        of the active snapshot in :attr:`snapshots`. This is cheap to query,
+        and thus suitable for keying caches of anything derived from the
+        positions.
+        """
+        sql = "SELECT version FROM active_snapshot"
+        for row in self._conn.execute(sql):
+            return row['version']
+
     @classmethod
     def log_message(cls, msg):
         cls.logger.warning(msg)
 
+    def enable_wal(self):
+        """
+        Switch the database to write-ahead logging, in which readers do not
+        block a writer (or vice versa). This is required when several
+        processes share the database (see :mod:`blinkenxmas.prefork`). The
+        setting is persistent. Returns the resulting journal mode, which will
+        not be "wal" if the database (e.g. ":memory:") cannot use it.
+        """
+        for row in self._conn.execute("PRAGMA journal_mode=WAL"):
+            return row[0]
+
+    def export_archive(self, fileobj):
+        """
+        Write the entire library (all presets, and the active snapshot of LED
+        positions) to *fileobj* as a gzip-compressed tar archive. The
+        *fileobj* need only implement ``write``; the archive is streamed and
+        only one frame block (or one preset's list of block hashes) is held in
+        memory at a time. Returns the number of presets written.
+
+        The archive contains:
+
+        * :file:`positions.json` -- a JSON object mapping LED indexes to
+          (y, a, r) lists
+
+        * :file:`blocks/{hash}` -- one member per unique frame block, named by
+          the hex representation of its SHA-1 hash, containing the packed
+          frame (see :func:`pack_frame`)
+
+        * :file:`presets/{name}` -- one member per preset, named by the
+          URL-quoted preset name, containing the concatenated 20-byte hashes
+          of the preset's frames in order; the preset's tags, description,
+          and whether it is positional are stored in "BLINKENXMAS.*" PAX
+          headers of the member
+        """
+        count = 0
+        now = time.time()
+        # Read everything within a single transaction so that presets cannot
+        # refer to blocks written after we've finished exporting them
+        self._conn.execute("BEGIN")
+        try:
+            with tarfile.open(fileobj=fileobj, mode='w|gz',
+                              format=tarfile.PAX_FORMAT) as archive:
+                def add(name, data, headers=None):
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    info.mtime = now
+                    if headers:
+                        info.pax_headers = headers
+                    archive.addfile(info, io.BytesIO(data))
+
+                add('positions.json', json.dumps({
+                    led: [position.y, position.a, position.r]
+                    for led, position in self._positions.items()
+                }).encode('utf-8'))
+                for row in self._conn.execute("SELECT hash, data FROM blocks"):
+                    add(f"blocks/{row['hash'].hex()}", row['data'])
+                for preset in self._presets:
+                    info = self._presets.info(preset)
+                    add(f"presets/{quote(preset, safe='')}",
+                        b''.join(self._presets._hashes(preset)), {
+                            'BLINKENXMAS.tags': ','.join(info.tags),
+                            'BLINKENXMAS.description': info.description,
+                            'BLINKENXMAS.positional': str(int(info.positional)),
+                        })
+                    count += 1
+        finally:
+            self._conn.rollback()
+        return count
+
+    def import_archive(self, fileobj, *, batch_size=1000):
+        """
+        Read a library archive (as produced by :meth:`export_archive`) from
+        *fileobj*, which need only implement ``read``. Presets in the archive
+        replace any like-named presets in the store, and the positions in the
+        archive (if any) are added as a new, active snapshot.
+
+        The import is performed within a single transaction; if the archive is
+        corrupt (:exc:`ValueError` or :exc:`tarfile.TarError` is raised), the
+        store is left unchanged. Frame blocks are inserted in batches of
+        *batch_size*. Returns the number of presets read.
+
+        Archives written by :meth:`export_archive` place all blocks before the
+        presets that refer to them, but blocks may appear in any order. The
+        reference counts of any blocks read after the first preset, and the
+        statistics of any presets read before such blocks, are recalculated
+        once all presets are read.
+        """
+        count = 0
+        blocks = []
+        # The presets linked so far; the hashes of blocks read after any of
+        # them, whose reference counts (maintained by triggers as presets are
+        # linked) are incomplete; and the presets linked before such blocks,
+        # whose frame and color counts are likewise incomplete
+        linked = []
+        late = set()
+        stale = set()
+
+        def write_blocks():
+            self._presets._write_blocks(blocks)
+            if linked and blocks:
+                late.update(key for key, data in blocks)
+                stale.update(linked)
+            blocks.clear()
+
+        with self._conn:
+            with tarfile.open(fileobj=fileobj, mode='r|gz') as archive:
+                for member in archive:
+                    if not member.isfile():
+                        continue
+                    data = archive.extractfile(member).read()
+                    if member.name.startswith('blocks/'):
+                        key = bytes.fromhex(member.name[len('blocks/'):])
+                        if hashlib.sha1(data).digest() != key:
+                            raise ValueError(f'corrupt block {member.name}')
+                        blocks.append((key, data))
+                        if len(blocks) >= batch_size:
+                            write_blocks()
+                    elif member.name.startswith('presets/'):
+                        if len(data) % HASH_SIZE:
+                            raise ValueError(f'corrupt preset {member.name}')
+                        write_blocks()
+                        preset = unquote(member.name[len('presets/'):])
+                        self._presets._link(preset, [
+                            data[i:i + HASH_SIZE]
+                            for i in range(0, len(data), HASH_SIZE)
+                        ])
+                        linked.append(preset)
+                        headers = member.pax_headers
+                        self._presets._describe(
+                            preset,
+                            tags=headers.get('BLINKENXMAS.tags', '').split(','),
+                            description=headers.get(
+                                'BLINKENXMAS.description', ''),
+                            positional=headers.get(
+                                'BLINKENXMAS.positional', '0') == '1')
+                        count += 1
+                    elif member.name == 'positions.json':
+                        positions = {
+                            int(led): Position.from_polar(y, a, r)
+                            for led, (y, a, r) in json.loads(data).items()
+                        }
+                        if positions:
+                            self._snapshots._add(positions)
+            write_blocks()
+            if late:
+                self._conn.executemany(
+                    """
+                    UPDATE blocks SET refs = (
+                        SELECT COUNT(*) FROM preset_frames f
+                        WHERE f.hash = blocks.hash
+                    )
+                    WHERE hash = ?
+                    """, ((key,) for key in late))
+            for preset in stale:
+                self._presets._update_stats(preset)
+            for row in self._conn.execute(
+                """
+                SELECT COUNT(*) FROM preset_frames f
+                WHERE NOT EXISTS (SELECT 1 FROM blocks b WHERE b.hash = f.hash)
+                """
+            ):
+                if row[0]:
+                    raise ValueError(
+                        f'archive is missing {row[0]} frame block(s)')
+            self._presets._collect()
+        return count
+
     def _create_tables(self):
         try:
             with self._conn:
@@ -257,11 +1246,22 @@ class Storage:
             return
         else:
             # Upgrade case
+            version = row['version']
             Storage.log_message(
-                f"Upgrading storage from version {row['version']} to "
+                f"Upgrading storage from version {version} to "
                 f"{Storage.schema_version}")
             with self._conn:
                 self._conn.execute(
                     "UPDATE config SET version = ?",
                     (Storage.schema_version,))
-                self._positions._create_tables()
+                if version < 3:
+                    self._positions._create_tables()
+                elif version < 5:
+                    self._positions._upgrade_tables()
+                if version < 4:
+                    self._presets._upgrade_tables()
+                else:
+                    if version < 6:
+                        self._presets._upgrade_search()
+                    if version < 7:
+                        self._presets._upgrade_versions()
@@ -1,6 +1,8 @@
 import os
 import sys
+import logging
 from queue import Queue
+from time import monotonic
 from pathlib import Path
 
 # NOTE: Remove except when compatibility moves beyond Python 3.10
@@ -12,7 +14,7 @@ except ImportError:
 
 # NOTE: The routes imports are performed solely to "register" their definitions
 # with the httpd module
-from . import mqtt, httpd, routes
+from . import mqtt, httpd, routes, prefork
 from .config import (
     get_config, get_parser,
     resolution, port, rotation, SUPPRESS
@@ -35,6 +37,25 @@ def get_web_parser():
     web_section.add_argument(
         '--httpd-port', key='port', type=port, metavar='PORT',
         help="the port to listen for HTTP requests. Default: %(default)s")
+    web_section.add_argument(
+        '--httpd-mode', key='mode', choices={'threading', 'asyncio'},
+        help="the server implementation to use; \"threading\" uses a thread "
+        "per connection, \"asyncio\" uses an event loop with persistent "
+        "connections and a limited number of threads. Default: %(default)s")
+    web_section.add_argument(
+        '--httpd-workers', key='workers', type=int, metavar='NUM',
+        help="the maximum number of threads used to handle requests in "
+        "asyncio mode. Default: %(default)s")
+    web_section.add_argument(
+        '--httpd-processes', key='processes', type=int, metavar='NUM',
+        help="the number of processes to serve requests with; if greater "
+        "than 1, this many worker processes share the port, while this "
+        "process alone talks to the broker and the camera. "
+        "Default: %(default)s")
+    web_section.add_argument(
+        '--httpd-timeout', key='timeout', type=int, metavar='SECS',
+        help="the number of seconds after which an idle persistent "
+        "connection is closed; 0 for no limit. Default: %(default)s")
     web_section.add_argument(
         '--no-production', dest='production', key='production',
         action='store_false')
@@ -46,6 +67,44 @@ def get_web_parser():
     web_section.add_argument(
         '--db', metavar='FILE', key='database',
         help="the SQLite database to store presets in. Default: %(default)s")
+    web_section.add_argument(
+        '--max-body', metavar='BYTES', key='max_body', type=int,
+        help="the largest request body (e.g. an uploaded preset) that will be "
+        "accepted; larger requests are refused before they are read. Imports "
+        "of the preset library are exempt. Default: %(default)s")
+    web_section.add_argument(
+        '--jobs', metavar='NUM', key='jobs', type=int,
+        help="the number of animations that may be generated concurrently. "
+        "Default: %(default)s")
+    web_section.add_argument(
+        '--job-queue', metavar='NUM', key='job_queue', type=int,
+        help="the number of further animations that may wait to be "
+        "generated; requests beyond this are refused until the queue drains. "
+        "Default: %(default)s")
+    web_section.add_argument(
+        '--template-cache', metavar='NUM', key='template_cache', type=int,
+        help="the number of rendered pages to cache; 0 disables the cache. "
+        "Default: %(default)s")
+    web_section.add_argument(
+        '--template-modules', metavar='DIR', key='template_modules',
+        help="the directory in which to store compiled templates, so that "
+        "restarts need not compile them again; blank to compile on each "
+        "start. Default: %(default)s")
+    web_section.add_argument(
+        '--description-cache', metavar='DIR', key='description_cache',
+        help="the directory in which to store the rendered descriptions of "
+        "animations, so that restarts need not render them again; blank to "
+        "render them when first requested after each start. "
+        "Default: %(default)s")
+    web_section.add_argument(
+        '--etag-cache', metavar='NUM', key='etag_cache', type=int,
+        help="the number of entity-tags computed from response bodies to "
+        "remember; 0 disables the cache. Default: %(default)s")
+    web_section.add_argument(
+        '--etag-background', metavar='BYTES', key='etag_background', type=int,
+        help="files at least this large are hashed (to compute their "
+        "entity-tags) in the background, rather than while the client waits; "
+        "0 hashes all files while the client waits. Default: %(default)s")
     web_section.add_argument(
         '--docs', metavar='URL/PATH', key='docs',
         help="the URL or local file-path to the Blinken' Xmas online "
@@ -75,11 +134,36 @@ def get_web_parser():
     camera_section.add_argument(
         '--camera-rotation', key='rotate', default='0', type=rotation,
         help=SUPPRESS)
+    camera_section.add_argument(
+        '--camera-idle', key='idle', default='600', type=int,
+        help=SUPPRESS)
 
     parser.set_defaults_from(config)
     return parser
 
 
+def load_animations(group='blinkenxmas_animations'):
+    """
+    Import each of the modules registered under the entry point *group*, thus
+    registering the animations they define. The time taken to import each
+    module is logged.
+    """
+    logger = logging.getLogger('httpd')
+    start = monotonic()
+    count = 0
+    for module in entry_points(group=group):
+        load_start = monotonic()
+        module.load()
+        logger.info(
+            'Loaded animations from %s in %.1fms', module.value,
+            (monotonic() - load_start) * 1000)
+        count += 1
+    elapsed = monotonic() - start
+    httpd.STARTUP_SECONDS.set(elapsed, phase='animations')
+    logger.warning(
+        'Loaded %d animation modules in %.1fms', count, elapsed * 1000)
+
+
 def main(args=None):
     "Entry point for :program:`bxweb`"
     try:
@@ -87,19 +171,21 @@ def main(args=None):
         if config.led_count == 0:
             raise RuntimeError(
                 'No LED strips defined; please edit the configuration file')
-        for module in entry_points(group='blinkenxmas_animations'):
-            module.load()
-        queue = Queue()
-        messages = httpd.Messages()
-        with mqtt.MessageThread(config, queue) as message_task, \
-                httpd.HTTPThread(config, messages, queue) as httpd_task:
-            while True:
-                httpd_task.join(1)
-                if not httpd_task.is_alive():
-                    break
-                message_task.join(1)
-                if not message_task.is_alive():
-                    break
+        load_animations()
+        if config.httpd_processes > 1:
+            prefork.serve(config)
+        else:
+            queue = Queue()
+            messages = httpd.Messages()
+            with mqtt.MessageThread(config, queue) as message_task, \
+                    httpd.HTTPThread(config, messages, queue) as httpd_task:
+                while True:
+                    httpd_task.join(1)
+                    if not httpd_task.is_alive():
+                        break
+                    message_task.join(1)
+                    if not message_task.is_alive():
+                        break
     except KeyboardInterrupt:
         print('Interrupted', file=sys.stderr)
         return 2
@@ -23,7 +23,7 @@ from blinkenxmas import routes
 def config(request):
     result = argparse.Namespace()
 
-    result.broker_adddress = 'broker'
+    result.broker_address = 'broker'
     result.broker_port = 1883
     result.topic = 'blinkenxmas'
 
@@ -40,8 +40,20 @@ def web_config(request, config, tmp_path):
 
     result.httpd_bind = '127.0.0.1'
     result.httpd_port = 0
+    result.httpd_mode = 'threading'
+    result.httpd_workers = 4
+    result.httpd_processes = 1
+    result.httpd_timeout = 60
     result.production = False
     result.db = str(tmp_path / 'presets.db')
+    result.max_body = 1048576
+    result.jobs = 1
+    result.job_queue = 4
+    result.template_cache = 0
+    result.template_modules = ''
+    result.description_cache = ''
+    result.etag_cache = 256
+    result.etag_background = 0
     result.docs = 'https://blinkenxmas.readthedocs.io/'
     result.source = 'https://github.com/waveform80/blinkenxmas/'
 
@@ -51,6 +63,7 @@ def web_config(request, config, tmp_path):
     result.camera_capture = (960, 720)
     result.camera_preview = (640, 480)
     result.camera_rotation = 0
+    result.camera_idle = 0
 
     return result
 
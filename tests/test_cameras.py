@@ -0,0 +1,81 @@
+from threading import Thread
+from unittest import mock
+
+import pytest
+
+from blinkenxmas.cameras import *
+
+
+class DummySource(AbstractSource):
+    def __init__(self, config):
+        super().__init__(config)
+        self.previewing = False
+
+    def start_preview(self, angle):
+        self.previewing = True
+
+    def stop_preview(self):
+        self.previewing = False
+
+
+def test_mailbox():
+    mailbox = FrameMailbox()
+    assert mailbox.get(timeout=0) is None
+    mailbox.put(1, b'foo')
+    assert mailbox.get(timeout=0) == (1, b'foo')
+    assert mailbox.get(timeout=0) is None
+    mailbox.put(2, b'bar')
+    mailbox.put(3, b'baz')
+    assert mailbox.get(timeout=0) == (3, b'baz')
+    assert mailbox.dropped == 1
+
+
+def test_mailbox_close():
+    mailbox = FrameMailbox()
+    result = []
+    waiter = Thread(target=lambda: result.append(mailbox.get()))
+    waiter.start()
+    mailbox.close()
+    waiter.join(1)
+    assert not waiter.is_alive()
+    assert result == [None]
+
+
+def test_source_broadcast():
+    source = DummySource(None)
+    client1 = mock.Mock(query={})
+    client2 = mock.Mock(query={})
+    assert not source.has_clients
+    mailbox1 = source.add_client(client1)
+    assert source.previewing
+    assert source.has_clients
+    source._preview_frame(b'foo')
+    assert source.sequence == 1
+    assert mailbox1.get(timeout=0) == (1, b'foo')
+
+    # New clients start with the current frame
+    mailbox2 = source.add_client(client2)
+    assert mailbox2.get(timeout=0) == (1, b'foo')
+
+    # Identical and empty frames aren't sent again
+    source._preview_frame(b'foo')
+    source._preview_frame(b'')
+    assert source.sequence == 1
+    assert mailbox1.get(timeout=0) is None
+
+    # A client that falls behind only receives the latest frame
+    source._preview_frame(b'bar')
+    assert mailbox1.get(timeout=0) == (2, b'bar')
+    source._preview_frame(b'baz')
+    assert mailbox1.get(timeout=0) == (3, b'baz')
+    assert mailbox2.get(timeout=0) == (3, b'baz')
+    assert mailbox2.dropped == 1
+
+    source.remove_client(client1)
+    assert mailbox1.get() is None
+    assert source.previewing
+    source.remove_client(client2)
+    source.remove_client(client2)
+    assert not source.previewing
+    assert not source.has_clients
+    assert source.frame == b''
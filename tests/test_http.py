@@ -1,7 +1,13 @@
 import io
+import os
+import gzip
+import json
 import http
+import socket
 import datetime as dt
 import email.utils as eut
+from threading import Thread
+from unittest import mock
 
 import pytest
 
@@ -177,6 +183,134 @@ def test_transfer_no_readinto():
     assert source._data[100:90001] == target.getvalue()
 
 
+def test_transfer_getbuffer():
+    source = MemoryReader(b"ABCDEFG\x00" * 100000)
+    target = io.BytesIO()
+    transfer(source, target)
+    assert target.getvalue() == b"ABCDEFG\x00" * 100000
+    assert source.tell() == 800000
+    target = io.BytesIO()
+    transfer(source, target, byterange=range(100, 90001))
+    assert target.getvalue() == (b"ABCDEFG\x00" * 100000)[100:90001]
+    assert source.tell() == 90001
+
+
+def test_transfer_sendfile(tmp_path):
+    data = b"ABCDEFG\x00" * 100000
+    (tmp_path / 'source').write_bytes(data)
+    left, right = socket.socketpair()
+    with left, right:
+        received = []
+        def receive():
+            while True:
+                buf = right.recv(65536)
+                if not buf:
+                    break
+                received.append(buf)
+        thread = Thread(target=receive, daemon=True)
+        thread.start()
+        with (tmp_path / 'source').open('rb') as source:
+            transfer(source, left)
+            assert source.tell() == 800000
+            transfer(source, left, byterange=range(100, 90001))
+            assert source.tell() == 90001
+            transfer(source, left, byterange=range(5, 5))
+        left.shutdown(socket.SHUT_WR)
+        thread.join(10)
+    assert b''.join(received) == data + data[100:90001]
+
+
+def test_transfer_sendfile_fallback(tmp_path):
+    # Targets with sendfile are only used with regular files
+    target = mock.Mock(spec=['sendfile', 'write'])
+    target.write.return_value = 3
+    transfer(MemoryReader(b'foo'), target)
+    assert not target.sendfile.called
+    assert target.write.call_count == 1
+
+    (tmp_path / 'source').write_bytes(b'foo')
+    with (tmp_path / 'source').open('rb') as source:
+        transfer(source, target)
+    target.sendfile.assert_called_once_with(source, 0, None)
+
+
+def test_is_regular_file(tmp_path):
+    (tmp_path / 'source').write_bytes(b'foo')
+    with (tmp_path / 'source').open('rb') as source:
+        assert is_regular_file(source)
+        assert is_regular_file(source.raw)
+    assert not is_regular_file(source)
+    assert not is_regular_file(io.BytesIO(b'foo'))
+    r, w = os.pipe()
+    with open(r, 'rb') as source, open(w, 'wb'):
+        assert not is_regular_file(source)
+
+
+def test_write_all():
+    class ShortWriter:
+        def __init__(self):
+            self.data = b''
+        def write(self, buf):
+            buf = bytes(buf[:3])
+            self.data += buf
+            return len(buf)
+
+    target = ShortWriter()
+    write_all(target, b'FOOBARBAZQUUX')
+    assert target.data == b'FOOBARBAZQUUX'
+
+
+def test_memory_reader():
+    reader = MemoryReader(b'FOOBARBAZ')
+    assert reader.readable()
+    assert reader.seekable()
+    assert not reader.writable()
+    assert reader.read(3) == b'FOO'
+    assert reader.tell() == 3
+    assert reader.seek(-3, io.SEEK_END) == 6
+    assert reader.read() == b'BAZ'
+    assert reader.read() == b''
+    assert reader.seek(-3, io.SEEK_CUR) == 6
+    assert reader.seek(1) == 1
+    assert reader.read(2) == b'OO'
+    with reader.getbuffer() as buf:
+        assert buf == b'FOOBARBAZ'
+    with pytest.raises(ValueError):
+        reader.seek(-1)
+    with pytest.raises(ValueError):
+        reader.seek(0, 3)
+
+
+def test_parse_accept():
+    assert parse_accept('') == {}
+    assert parse_accept('gzip') == {'gzip': 1.0}
+    assert parse_accept('GZip;q=0.5, identity, *;q=0') == {
+        'gzip': 0.5, 'identity': 1.0, '*': 0.0}
+    assert parse_accept('gzip;q=foo, br;bad') == {'gzip': 0.0}
+
+
+def test_accepts_encoding():
+    assert accepts_encoding('gzip, deflate', 'gzip')
+    assert not accepts_encoding('', 'gzip')
+    assert not accepts_encoding('deflate', 'gzip')
+    assert not accepts_encoding('gzip;q=0', 'gzip')
+    assert accepts_encoding('*', 'gzip')
+    assert not accepts_encoding('gzip;q=0, *', 'gzip')
+
+
+def test_bounded_reader():
+    source = io.BufferedReader(io.BytesIO(b"ABCDEFG\x00" * 100))
+    reader = BoundedReader(source, 500)
+    assert reader.readable()
+    assert reader.remaining == 500
+    assert reader.read(100) == (b"ABCDEFG\x00" * 13)[:100]
+    assert reader.remaining == 400
+    assert len(reader.read()) == 400
+    assert reader.remaining == 0
+    assert reader.read() == b''
+    assert source.read() == (b"ABCDEFG\x00" * 100)[500:]
+
+
 def test_dummy_response():
     req = DummyRequest()
     resp = DummyResponse(req)
@@ -244,6 +378,49 @@ ETag: W/"dZrvPXf7yOYRTqF+koOt/z2YcZU="\r
 Foo Bar Baz""".encode('utf-8')
 
 
+def test_http_response_etag_cache(tmp_path):
+    paths = []
+    for n in range(3):
+        path = tmp_path / f'body{n}.dat'
+        path.write_text(f'Foo Bar Baz {n}')
+        paths.append(path)
+    with mock.patch.object(HTTPResponse, 'etags', LRUCache(2)):
+        etags = [
+            HTTPResponse(DummyRequest(), body=path).headers['ETag']
+            for path in paths
+        ]
+        assert len(set(etags)) == 3
+        assert len(HTTPResponse.etags) == 2
+        # The cached entity-tag is used in preference to hashing the body
+        with mock.patch('hashlib.sha1') as sha1:
+            assert HTTPResponse(
+                DummyRequest(), body=paths[2]).headers['ETag'] == etags[2]
+            assert not sha1.called
+
+
+def test_http_response_etag_background(tmp_path):
+    body = tmp_path / 'body.dat'
+    body.write_text('Foo Bar Baz')
+    with mock.patch.object(HTTPResponse, 'etags', LRUCache(2)), \
+            mock.patch.object(HTTPResponse, 'background_hash', 5):
+        with body.open('rb') as f:
+            f.seek(4)
+            resp = HTTPResponse(DummyRequest(), body=f)
+            # The response is sent immediately, without an entity-tag
+            assert 'ETag' not in resp.headers
+            assert f.tell() == 4
+        HTTPResponse._hash_executor.submit(lambda: None).result(5)
+        assert not HTTPResponse._hashing
+        with body.open('rb') as f:
+            f.seek(4)
+            resp = HTTPResponse(DummyRequest(), body=f)
+            assert resp.headers['ETag'] == 'W/"3ax+JYWsq8cCB4k5Bd1GThGzDC0="'
+        # Small and in-memory bodies are still hashed immediately
+        resp = HTTPResponse(
+            DummyRequest(), body=io.BytesIO(b'Foo Bar Baz'), filename='foo')
+        assert resp.headers['ETag'] == 'W/"dZrvPXf7yOYRTqF+koOt/z2YcZU="'
+
+
 def test_http_response_stream():
     body = io.BytesIO(b"QUUX")
     req = DummyRequest()
@@ -381,6 +558,64 @@ ETag: QUUX\r
 """.encode('utf-8')
 
 
+def test_http_response_strong_etag():
+    req = DummyRequest()
+    resp = HTTPResponse(req, body=b'Foo Bar Baz', filename='foo.txt',
+                        etag='foo-1')
+    assert resp.headers['ETag'] == '"foo-1"'
+    resp = HTTPResponse(req, body=b'Foo Bar Baz', filename='foo.txt',
+                        etag=False)
+    assert 'ETag' not in resp.headers
+
+
+def test_http_response_etag_precedence(tmp_path):
+    # If-None-Match must be used in preference to If-Modified-Since, even
+    # when the latter would match
+    temp_file = tmp_path / 'foo.txt'
+    temp_file.write_bytes(b'Foo Bar Baz')
+    req = DummyRequest(
+        if_modified_since=dt.datetime.now(tz=dt.timezone.utc),
+        if_none_match='"foo-1"')
+    resp = HTTPResponse(req, body=temp_file, etag='foo-2')
+    resp.check_cached()
+    assert resp.status_code == http.HTTPStatus.OK
+
+
+def test_match_etag():
+    assert match_etag('"foo"', '"foo"')
+    assert match_etag('"foo"', '"bar", "foo"')
+    assert match_etag('"foo"', 'W/"foo"')
+    assert match_etag('W/"foo"', '"foo"')
+    assert match_etag('"foo"', '*')
+    assert not match_etag('"foo"', '"bar"')
+    assert not match_etag('"foo"', '')
+
+
+def test_not_modified():
+    req = DummyRequest(if_none_match='"foo-1"')
+    resp = not_modified(req, 'foo-1')
+    resp.send_headers()
+    resp.send_body()
+    assert req.wfile.getvalue() == b"""\
+HTTP/1.0 304 Not Modified\r
+ETag: "foo-1"\r
+\r
+"""
+    assert not_modified(req, 'foo-2') is None
+    assert not_modified(DummyRequest(), 'foo-1') is None
+    assert not_modified(
+        DummyRequest(command='PUT', if_none_match='"foo-1"'), 'foo-1') is None
+
+    req = DummyRequest(if_none_match='"foo-1-gzip"',
+                       headers={'Accept-Encoding': 'gzip'})
+    assert not_modified(req, 'foo-1') is None
+    resp = not_modified(req, 'foo-1', compress=True)
+    assert resp.headers['ETag'] == '"foo-1-gzip"'
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+    assert not_modified(
+        DummyRequest(if_none_match='"foo-1"'), 'foo-1', compress=True)
+
+
 def test_http_response_ranges_normal():
     body = io.BytesIO(b'FOOBARBAZQUUX')
     req = DummyRequest(ranges=['3-5'])
@@ -443,6 +678,7 @@ def test_http_response_backwards_range():
     assert req.wfile.getvalue() == f"""\
 HTTP/1.0 400 Bad Request\r
 Accept-Ranges: bytes\r
+Content-Length: 0\r
 \r
 """.encode('utf-8')
 
@@ -459,6 +695,7 @@ def test_http_response_bad_range():
 HTTP/1.0 416 Requested Range Not Satisfiable\r
 Accept-Ranges: bytes\r
 Content-Range: bytes 6-20/13\r
+Content-Length: 0\r
 \r
 """.encode('utf-8')
 
@@ -490,6 +727,7 @@ def test_http_response_ranges_multiple():
     resp.send_body()
     assert req.wfile.getvalue() == f"""\
 HTTP/1.0 206 Partial Content\r
+Content-Length: 110\r
 Accept-Ranges: bytes\r
 Content-Type: multipart/byteranges; boundary=BOUNDARY\r
 \r
@@ -515,6 +753,7 @@ def test_http_response_ranges_multiple_with_content_type():
     resp.send_body()
     assert req.wfile.getvalue() == f"""\
 HTTP/1.0 206 Partial Content\r
+Content-Length: 162\r
 Accept-Ranges: bytes\r
 Content-Type: multipart/byteranges; boundary=BOUNDARY\r
 \r
@@ -561,3 +800,338 @@ Content-Length: 13\r
 Accept-Ranges: bytes\r
 \r
 FOOBARBAZQUUX""".encode('utf-8')
+
+
+def test_counting_reader():
+    source = io.BufferedReader(io.BytesIO(b'foo\nbar baz quux'))
+    reader = CountingReader(source)
+    assert reader.readable()
+    assert reader.consumed == 0
+    assert reader.readline() == b'foo\n'
+    assert reader.consumed == 4
+    assert reader.read(4) == b'bar '
+    buf = bytearray(3)
+    assert reader.readinto(buf) == 3
+    assert buf == b'baz'
+    assert reader.consumed == 11
+    assert reader.read() == b' quux'
+    assert reader.consumed == 16
+
+
+def test_lru_cache():
+    with pytest.raises(ValueError):
+        LRUCache(-1)
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert len(cache) == 2
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.get('b', 0) == 0
+    cache.set('a', 4)
+    assert cache.get('a') == 4
+    cache.clear()
+    assert len(cache) == 0
+
+    cache = LRUCache(0)
+    cache.set('a', 1)
+    assert 'a' not in cache
+    assert len(cache) == 0
+
+
+def test_write_vectored():
+    target = io.BytesIO()
+    write_vectored(target, [b'foo', b'', bytearray(b'bar')])
+    assert target.getvalue() == b'foobar'
+
+    target = mock.Mock(spec=['writev'])
+    write_vectored(target, [b'foo', b'bar'])
+    target.writev.assert_called_once_with([b'foo', b'bar'])
+
+    sent = []
+    def sendmsg(buffers):
+        # Simulate a partial send of at most 4 bytes
+        data = b''.join(buffers)[:4]
+        sent.append(data)
+        return len(data)
+    target = mock.Mock(spec=['sendmsg'])
+    target.sendmsg.side_effect = sendmsg
+    write_vectored(target, [b'foo', b'', b'bar', b'quux'])
+    assert b''.join(sent) == b'foobarquux'
+    assert sent == [b'foob', b'arqu', b'ux']
+
+
+def test_iter_reader():
+    closed = []
+    def chunks():
+        try:
+            yield from ['foo', b'', bytearray(b'bar'), 'baz!']
+        finally:
+            closed.append(True)
+    with IterReader(chunks()) as reader:
+        assert reader.readable()
+        assert not reader.seekable()
+        assert reader.read(2) == b'fo'
+        assert reader.read(2) == b'o'
+        assert reader.read() == b'barbaz!'
+        assert reader.read() == b''
+    assert closed
+
+    with IterReader(chunks()) as reader:
+        assert reader.read(1) == b'f'
+    assert closed == [True, True]
+
+    with IterReader(iter([''])) as reader:
+        assert reader.read() == b''
+
+
+def test_chunked_writer():
+    target = io.BytesIO()
+    with ChunkedWriter(target) as writer:
+        assert writer.writable()
+        assert writer.write(b'foo') == 3
+        assert writer.write(b'') == 0
+        assert writer.write(b'bar baz') == 7
+    assert target.getvalue() == b'3\r\nfoo\r\n7\r\nbar baz\r\n0\r\n\r\n'
+    assert not target.closed
+
+
+def test_iterencode_array():
+    assert ''.join(iterencode_array([])) == '[]'
+    assert ''.join(iterencode_array(iter([1, 'a', None]))) == '[1,"a",null]'
+    data = [['#%06x' % i] * 4 for i in range(100)]
+    chunks = list(iterencode_array((frame for frame in data), chunk_size=100))
+    assert len(chunks) > 1
+    assert all(len(chunk) < 200 for chunk in chunks)
+    assert json.loads(''.join(chunks)) == data
+
+
+def test_http_response_iterable_body():
+    request = DummyRequest()
+    resp = HTTPResponse(request, body=iter(['foo', b'bar']))
+    assert 'Content-Length' not in resp.headers
+    resp.check_cached()
+    resp.check_ranges()
+    assert 'Accept-Ranges' not in resp.headers
+    resp.send_headers()
+    resp.send_body()
+    assert request.close_connection
+    assert request.wfile.getvalue() == b"""\
+HTTP/1.0 200 OK\r
+\r
+foobar"""
+
+    request = DummyRequest(protocol_version='HTTP/1.1')
+    request.request_version = 'HTTP/1.1'
+    resp = HTTPResponse(request, body=iter(['foo', b'bar']))
+    resp.check_cached()
+    resp.check_ranges()
+    resp.send_headers()
+    resp.send_body()
+    assert request.wfile.getvalue() == b"""\
+HTTP/1.1 200 OK\r
+Transfer-Encoding: chunked\r
+\r
+3\r
+foo\r
+3\r
+bar\r
+0\r
+\r
+"""
+
+
+def test_http_response_compress():
+    request = DummyRequest(headers={'Accept-Encoding': 'gzip, deflate'})
+    resp = HTTPResponse(request, body='foo' * 1000, etag='foo',
+                        compress=True)
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert resp.headers['ETag'] == '"foo-gzip"'
+    assert 'Content-Length' not in resp.headers
+    resp.check_cached()
+    resp.check_ranges()
+    resp.send_headers()
+    resp.send_body()
+    head, body = request.wfile.getvalue().split(b'\r\n\r\n', 1)
+    assert gzip.decompress(body) == b'foo' * 1000
+
+    request = DummyRequest(headers={'Accept-Encoding': 'identity'})
+    resp = HTTPResponse(request, body='foo' * 1000, etag='foo',
+                        compress=True)
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.headers['ETag'] == '"foo"'
+    assert resp.headers['Content-Length'] == 3000
+
+
+def test_json_reader():
+    doc = {
+        'animation': 'flash',
+        'frames': [['#ff0000', '#0000ff'] * 10, ['#0000ff', '#ff0000'] * 10],
+        'tags': ['red', 'blue', 'café'],
+        'fps': 60,
+    }
+    for chunk_size in (1, 3, 64, 65536):
+        reader = JSONReader(
+            io.BytesIO(json.dumps(doc).encode('utf-8')), chunk_size=chunk_size)
+        result = {}
+        for key in reader.members():
+            if key == 'frames':
+                result[key] = list(reader.items())
+            else:
+                result[key] = reader.value()
+        reader.end()
+        assert result == doc
+
+    reader = JSONReader(io.BytesIO(b' [ ] '))
+    assert reader.peek() == '['
+    assert list(reader.items()) == []
+    assert reader.peek() == ''
+    reader.end()
+
+    reader = JSONReader(io.BytesIO(b'{}'))
+    assert list(reader.members()) == []
+    reader = JSONReader(io.BytesIO(b'12345'), chunk_size=2)
+    assert reader.value() == 12345
+
+
+def test_json_reader_invalid():
+    def items(data):
+        reader = JSONReader(io.BytesIO(data), chunk_size=2)
+        result = list(reader.items())
+        reader.end()
+        return result
+
+    def members(data):
+        reader = JSONReader(io.BytesIO(data), chunk_size=2)
+        result = {key: reader.value() for key in reader.members()}
+        reader.end()
+        return result
+
+    for data in (b'', b'[1, 2', b'[1 2]', b'[1]]', b'{}', b'[1, foo]'):
+        with pytest.raises(ValueError):
+            items(data)
+    for data in (b'{1: 2}', b'{"a" 1}', b'{"a": 1', b'[]'):
+        with pytest.raises(ValueError):
+            members(data)
+
+
+FORMDATA = (
+    b'preamble\r\n'
+    b'--FOO \t\r\n'
+    b'Content-Disposition: form-data; name="foo"\r\n'
+    b'\r\n'
+    b'1\r\n2\r\n'
+    b'--FOO\r\n'
+    b'Content-Disposition:form-data;name="bar"  \r\n'
+    b'Content-Type: text/plain; charset=latin-1\r\n'
+    b'\r\n'
+    b'caf\xe9\r\n'
+    b'--FOO\r\n'
+    b'\r\n'
+    b'no headers\r\n'
+    b'--FOO\r\n'
+    b'Content-Disposition: form-data;\r\n'
+    b' name="folded"\r\n'
+    b'Content-Type: application/octet-stream\r\n'
+    b'\r\n'
+    b'\x00\x01\r\n'
+    b'--FOO\r\n'
+    b'Content-Disposition: attachment; name="baz"\r\n'
+    b'\r\n'
+    b'ignored\r\n'
+    b'--FOO\r\n'
+    b'Content-Disposition: form-data; name="quux"\r\n'
+    b'Content-Type: text/plain; filename="quux.txt"\r\n'
+    b'\r\n'
+    b'file\r\n'
+    b'--FOO--\r\n'
+    b'epilogue'
+)
+
+
+def test_multipart_boundary():
+    assert multipart_boundary('multipart/form-data; boundary=FOO') == b'FOO'
+    assert multipart_boundary('multipart/mixed; boundary="a b"') == b'a b'
+    with pytest.raises(ValueError):
+        multipart_boundary('text/plain; boundary=FOO')
+    with pytest.raises(ValueError):
+        multipart_boundary('multipart/form-data')
+    with pytest.raises(ValueError):
+        multipart_boundary(f'multipart/form-data; boundary={"x" * 71}')
+
+
+def test_parse_part_headers():
+    headers = parse_part_headers(
+        b'content-disposition:  form-data; name="foo" \r\n\r\n')
+    assert dict(headers) == {'Content-Disposition': 'form-data; name="foo"'}
+    # Folded and non-ASCII headers are left to the email parser
+    headers = parse_part_headers(
+        b'Content-Disposition: form-data;\r\n name="foo"\r\n\r\n')
+    assert parse_content_value(headers['Content-Disposition']) == (
+        'form-data', {'name': 'foo'})
+    headers = parse_part_headers(
+        b'Content-Disposition: form-data; name="caf\xc3\xa9"\r\n\r\n')
+    assert 'Content-Disposition' in headers
+
+
+def test_split_multipart_bytes():
+    request = DummyRequest(headers={
+        'Content-Type': 'multipart/form-data; boundary=FOO'}, body=FORMDATA)
+    expected = [
+        (parse_content_value(headers.get('Content-Disposition', '')),
+         content.read())
+        for headers, content in split_multipart(request)
+    ]
+    assert [
+        (parse_content_value(headers.get('Content-Disposition', '')), content)
+        for headers, content in split_multipart_bytes(FORMDATA, b'FOO')
+    ] == expected
+    assert len(expected) == 6
+    # Degenerate cases: no final marker, no boundary at all, bad boundary
+    assert [
+        content for headers, content in
+        split_multipart_bytes(b'--FOO\r\n\r\nfoo\r\n--FO', b'FOO')
+    ] == [b'foo\r\n--FO']
+    assert list(split_multipart_bytes(b'no boundary', b'FOO')) == []
+    with pytest.raises(ValueError):
+        list(split_multipart_bytes(b'--FOOBAR\r\n\r\n', b'FOO'))
+    with pytest.raises(ValueError):
+        list(split_multipart_bytes(b'--FOO\r\nFoo: bar\r\n', b'FOO'))
+
+
+def test_split_multipart_no_boundary():
+    request = DummyRequest(headers={
+        'Content-Type': 'multipart/form-data; boundary=FOO'},
+        body=b'no boundary' * 10000)
+    assert list(split_multipart(request)) == []
+
+
+def test_parse_formdata():
+    def parse(length):
+        request = DummyRequest(headers={
+            'Content-Type': 'multipart/form-data; boundary=FOO',
+            'Content-Length': str(length),
+        }, body=FORMDATA)
+        return {
+            key: value.read() if hasattr(value, 'read') else value
+            for key, value in parse_formdata(request).items()
+        }
+
+    # An unknown Content-Length forces the spooled path
+    expected = {
+        'foo': '1\n2',
+        'bar': 'café',
+        'folded': b'\x00\x01',
+        'quux': 'file',
+    }
+    assert parse(0) == expected
+    assert parse(len(FORMDATA)) == expected
+    with mock.patch('blinkenxmas.http.SMALL_MULTIPART_SIZE', 16):
+        assert parse(len(FORMDATA)) == expected
+    with pytest.raises(ValueError):
+        parse_formdata(DummyRequest(headers={'Content-Type': 'text/plain'}))
@@ -1,5 +1,11 @@
+import io
+import re
+import gzip
 import json
 import socket
+from time import sleep
+import threading
+from threading import Event
 import email.utils as eut
 from http import HTTPStatus
 from http.client import RemoteDisconnected
@@ -8,6 +14,7 @@ from unittest import mock
 import pytest
 
 from blinkenxmas.httpd import *
+from blinkenxmas.http import DummyResponse, iterencode_array
 from colorzero import Color
 from conftest import split, find
 
@@ -59,6 +66,11 @@ def test_static_GET(web_config, server_factory, no_routes, client_factory):
         assert 'max-age' in resp.headers['Cache-Control']
         assert resp.headers['Content-Type'] == 'text/css'
         assert int(resp.headers['Content-Length']) == len(expected)
+        # Static entity-tags are computed at startup; the cache of computed
+        # entity-tags is only for other bodies
+        assert STARTUP_SECONDS.value(phase='static') >= 0
+        assert HTTPResponse.etags.maxsize == web_config.etag_cache
+        assert HTTPResponse.background_hash == web_config.etag_background
 
 
 def test_static_GET_cached(web_config, server_factory, no_routes, client_factory):
@@ -75,6 +87,36 @@ def test_static_GET_cached(web_config, server_factory, no_routes, client_factory
         assert resp.headers['Content-Type'] == 'text/css'
 
 
+def test_static_GET_gzip(web_config, server_factory, no_routes,
+                         client_factory):
+    style_css = resources.files('blinkenxmas') / 'style.css'
+    expected = style_css.read_bytes()
+    with server_factory(web_config) as server:
+        client = client_factory(server)
+        client.request('GET', '/style.css', headers={
+            'Accept-Encoding': 'gzip, deflate'})
+        resp = client.getresponse()
+        assert resp.status == 200
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert resp.headers['Vary'] == 'Accept-Encoding'
+        assert gzip.decompress(resp.read()) == expected
+        gzip_etag = resp.headers['ETag']
+
+        client.request('GET', '/style.css', headers={
+            'Accept-Encoding': 'gzip;q=0, identity'})
+        resp = client.getresponse()
+        assert resp.status == 200
+        assert 'Content-Encoding' not in resp.headers
+        assert resp.read() == expected
+        assert resp.headers['ETag'] != gzip_etag
+
+        client.request('GET', '/style.css', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': gzip_etag})
+        resp = client.getresponse()
+        assert resp.status == 304
+        assert resp.read() == b''
+
+
 def test_static_ignores_POST(web_config, server_factory, no_routes, client_factory):
     style_css = resources.files('blinkenxmas') / 'style.css'
     expected = style_css.read_bytes()
@@ -108,6 +150,28 @@ def test_static_not_found(web_config, server_factory, no_routes, client_factory)
         assert resp.status == 404
 
 
+def test_static_outside_package(web_config, server_factory, no_routes,
+                                client_factory):
+    with server_factory(web_config) as server:
+        client = client_factory(server)
+        client.request('GET', '/../blinkenxmas/style.css')
+        resp = client.getresponse()
+        assert not resp.read()
+        assert resp.status == 404
+
+
+def test_static_not_asset(web_config, server_factory, no_routes,
+                          client_factory):
+    with server_factory(web_config) as server:
+        client = client_factory(server)
+        for path in ('/httpd.py', '/default.conf', '/layout.html.pt'):
+            client.request('GET', path)
+            resp = client.getresponse()
+            assert not resp.read()
+            assert resp.status == 404
+    assert 'httpd.py' not in HTTPRequestHandler.static_cache
+    assert 'style.css' in HTTPRequestHandler.static_cache
+
 def test_template_HEAD(web_config, server_factory, no_routes, client_factory):
     with server_factory(web_config) as server:
         client = client_factory(server)
@@ -133,6 +197,206 @@ def test_template_GET_empty_index(web_config, server_factory, no_routes,
         assert not find(('<p>', 'Select from one of the following presets:', '</p>'), body)
 
 
+def test_template_config(web_config, server_factory, no_routes,
+                         client_factory):
+    for camera_type in ('none', 'files'):
+        web_config.camera_type = camera_type
+        with server_factory(web_config) as server:
+            client = client_factory(server)
+            client.request('GET', '/config.html')
+            resp = client.getresponse()
+            body = resp.read().decode('utf-8')
+            assert resp.status == 200
+            assert ('href="capture.html"' in body) == (camera_type != 'none')
+            # Rendering the link must not initialize the camera
+            assert server.httpd.calibration._camera is None
+
+
+def test_template_etag(web_config, server_factory, no_routes, client_factory):
+    with server_factory(web_config) as server:
+        client = client_factory(server)
+        client.request('GET', '/index.html')
+        resp = client.getresponse()
+        resp.read()
+        assert resp.status == 200
+        etag = resp.headers['ETag']
+        assert etag.startswith('"')
+
+        client.request('GET', '/index.html', headers={'If-None-Match': etag})
+        resp = client.getresponse()
+        assert resp.read() == b''
+        assert resp.status == 304
+        assert len(server.httpd.template_output) == 0
+
+
+def test_template_output_cache(web_config, server_factory, no_routes,
+                               client_factory):
+    web_config.template_cache = 2
+    messages = Messages()
+    with server_factory(web_config, messages=messages) as server:
+        cache = server.httpd.template_output
+        client = client_factory(server)
+        client.request('GET', '/index.html')
+        resp = client.getresponse()
+        body = list(split(resp))
+        assert resp.status == 200
+        assert find(('<p>', 'No presets defined yet!', '</p>'), body)
+        etag = resp.headers['ETag']
+        assert len(cache) == 1
+
+        with mock.patch.object(HTTPRequestHandler, 'get_template') as get:
+            client.request('GET', '/index.html')
+            resp = client.getresponse()
+            resp.read()
+            assert resp.status == 200
+            assert resp.headers['ETag'] == etag
+            assert not get.called
+
+        # Changes to the store invalidate prior output
+        db = store.Storage(web_config.db)
+        db.presets['Foo'] = [[Color('red')]]
+        client.request('GET', '/index.html', headers={'If-None-Match': etag})
+        resp = client.getresponse()
+        body = list(split(resp))
+        assert resp.status == 200
+        assert resp.headers['ETag'] != etag
+        assert not find(('<p>', 'No presets defined yet!', '</p>'), body)
+        assert len(cache) == 2
+
+        # Pending messages bypass the cache (and are drained by the layout)
+        messages.show('Hello')
+        client.request('GET', '/index.html')
+        resp = client.getresponse()
+        assert b'Hello' in resp.read()
+        assert len(messages) == 0
+
+        # Output which drained a message shown during rendering isn't cached
+        cache.clear()
+        get_template_ns = HTTPRequestHandler.get_template_ns
+        def show_during_render(self, **kwargs):
+            messages.show('Racing')
+            return get_template_ns(self, **kwargs)
+        with mock.patch.object(
+                HTTPRequestHandler, 'get_template_ns', show_during_render):
+            client.request('GET', '/index.html')
+            resp = client.getresponse()
+            assert b'Racing' in resp.read()
+        assert len(cache) == 0
+        client.request('GET', '/index.html')
+        resp = client.getresponse()
+        assert b'Racing' not in resp.read()
+        assert len(cache) == 1
+
+        # Calibration templates are never cached, and the LRU bound holds
+        client.request('GET', '/manage.html')
+        client.getresponse().read()
+        client.request('GET', '/capture.html')
+        client.getresponse().read()
+        assert len(cache) == 2
+
+
+def test_template_fingerprinted_static(web_config, server_factory, no_routes,
+                                       client_factory):
+    style_css = resources.files('blinkenxmas') / 'style.css'
+    expected = style_css.read_bytes()
+    with server_factory(web_config) as server:
+        client = client_factory(server)
+        client.request('GET', '/index.html')
+        resp = client.getresponse()
+        body = list(split(resp))
+        assert resp.status == 200
+        links = [
+            tag for tag in body
+            if tag.startswith('<link') and 'stylesheet' in tag]
+        assert len(links) == 1
+        url = re.search(r'href="([^"]*)"', links[0]).group(1)
+        assert re.match(r'^/style\.[0-9a-f]{12}\.css$', url)
+
+        client.request('GET', url)
+        resp = client.getresponse()
+        assert resp.status == 200
+        assert resp.read() == expected
+        assert resp.headers['Cache-Control'] == 'max-age=31536000, immutable'
+
+        client.request('GET', '/style.000000000000.css')
+        resp = client.getresponse()
+        assert resp.read() == b''
+        assert resp.status == 404
+
+
+def test_load_templates(tmp_path):
+    root = resources.files('blinkenxmas')
+    paths = {'index.html.pt', 'layout.html.pt'}
+    modules = tmp_path / 'modules'
+    templates = load_templates(root, paths, modules)
+    assert set(templates) == paths
+    assert list(modules.glob('*.py'))
+
+    # A second load uses the compiled modules without compiling again
+    with mock.patch('chameleon.zpt.template.PageTemplate._compile') as comp:
+        templates = load_templates(root, paths, modules)
+        assert set(templates) == paths
+        assert not comp.called
+
+    # Without a modules directory, everything is compiled afresh
+    with mock.patch('chameleon.zpt.template.PageTemplate._compile') as comp:
+        comp.side_effect = RuntimeError('compiled')
+        with pytest.raises(RuntimeError):
+            load_templates(root, paths)
+
+
+def test_description():
+    doc = '''
+    A *test* animation.
+    '''
+    with mock.patch('blinkenxmas.httpd.render_rst',
+                    wraps=render_rst) as render:
+        desc = Description(doc)
+        assert desc
+        assert not render.called
+        assert str(desc) == '<p>A <em>test</em> animation.</p>\n'
+        assert desc.__html__() == str(desc)
+        assert render.call_count == 1
+
+        empty = Description(None)
+        assert not empty
+        assert str(empty) == ''
+        assert render.call_count == 1
+
+
+def test_description_cache(tmp_path):
+    doc = 'A *cached* animation.'
+    cache = tmp_path / 'descriptions'
+    with mock.patch('blinkenxmas.httpd.Description.cache_dir', str(cache)), \
+            mock.patch('blinkenxmas.httpd.render_rst',
+                       wraps=render_rst) as render:
+        html = str(Description(doc))
+        assert render.call_count == 1
+        assert (cache / f'{Description(doc).cache_key}.html').read_text() == html
+        assert list(cache.iterdir()) == [
+            cache / f'{Description(doc).cache_key}.html']
+
+        # A new instance (e.g. after a restart) reads the cache
+        assert str(Description(doc)) == html
+        assert render.call_count == 1
+
+        # A different doc-string has a different key
+        assert Description(doc + ' ').cache_key != Description(doc).cache_key
+
+    # An unusable cache still renders
+    not_a_dir = tmp_path / 'file'
+    not_a_dir.write_text('')
+    with mock.patch('blinkenxmas.httpd.Description.cache_dir', str(not_a_dir)):
+        assert str(Description('*Uncached*')) == '<p><em>Uncached</em></p>\n'
+
+
+def test_fingerprint():
+    assert fingerprint('pico/main.py', '0123abcd') == 'pico/main.0123abcd.py'
+    assert fingerprint('logo.opt.svg', '0123abcd') == 'logo.opt.0123abcd.svg'
+    assert fingerprint('Makefile', '0123abcd') == 'Makefile.0123abcd'
+    assert fingerprint('.hidden', '0123abcd') == '.hidden.0123abcd'
+
+
 def test_route_HEAD(web_config, server_factory, no_routes, client_factory):
     with server_factory(web_config) as server:
         @route('/')
@@ -375,6 +639,55 @@ def test_route_fallthru(web_config, server_factory, client_factory, no_routes):
         assert resp.status == 404
 
 
+def test_routes_dispatch():
+    routes = Routes()
+    index = lambda request: 'index'
+    person = lambda request, name: 'person'
+    angle = lambda request, angle: 'angle'
+    fallback = lambda request, name, ext: 'fallback'
+    for pattern, command, handler in [
+        ('/index.html', 'GET', index),
+        ('/people/<name>.html', 'GET', person),
+        ('/angle<angle>.jpg', 'GET', angle),
+        ('/people/<name>.<ext>', 'GET', fallback),
+        ('/people/<name>.html', 'DELETE', person),
+    ]:
+        routes[re.compile(f'^{route_regex(pattern)}$'), command] = handler
+
+    def dispatch(command, path):
+        return [
+            (handler(None, **params), params)
+            for handler, params in routes.dispatch(command, path)
+        ]
+
+    assert dispatch('GET', '/index.html') == [('index', {})]
+    assert dispatch('GET', '/index.htm') == []
+    assert dispatch('GET', '/people/fred.html') == [
+        ('person', {'name': 'fred'}),
+        ('fallback', {'name': 'fred', 'ext': 'html'}),
+    ]
+    assert dispatch('GET', '/people/fred.txt') == [
+        ('fallback', {'name': 'fred', 'ext': 'txt'})]
+    assert dispatch('GET', '/people/fred/foo.html') == []
+    assert dispatch('GET', '/angle090.jpg') == [('angle', {'angle': '090'})]
+    assert dispatch('DELETE', '/people/fred.html') == [
+        ('person', {'name': 'fred'})]
+    assert dispatch('DELETE', '/index.html') == []
+    assert dispatch('PUT', '/index.html') == []
+
+    # The index must be rebuilt after any modification
+    routes[re.compile('^/foo$'), 'PUT'] = index
+    assert dispatch('PUT', '/foo') == [('index', {})]
+    copy = routes.copy()
+    assert isinstance(copy, Routes)
+    routes.clear()
+    assert dispatch('GET', '/index.html') == []
+    assert [
+        handler(None, **params)
+        for handler, params in copy.dispatch('GET', '/index.html')
+    ] == ['index']
+
+
 def test_for_commands():
     @for_commands('GET')
     def get_handler():
@@ -405,8 +718,854 @@ def test_param_values():
 def test_special_param_values():
     request = mock.Mock()
     request.server.config.led_count = 50
-    request.store.positions = [(0, 0, 0) for i in range(50)]
+    request.store.positions = {i: (0, 0, 0) for i in range(50)}
     request.server.config.fps = 60
     assert ParamLEDCount().value(request) == 50
     assert ParamFPS().value(request) == 60
-    assert all(pos == (0, 0, 0) for pos in ParamLEDPositions().value(request))
+    positions = ParamLEDPositions().value(request)
+    assert positions == request.store.positions
+    assert positions is not request.store.positions
+
+
+def test_keep_alive(web_config, server_factory, no_routes, client_factory):
+    @route('/echo', 'PUT')
+    def echo(request):
+        return HTTPResponse(request, body=request.rfile.read(
+            int(request.headers['Content-Length'])))
+
+    for mode, server_class in (
+        ('threading', HTTPServer),
+        ('asyncio', AsyncHTTPServer),
+    ):
+        web_config.httpd_mode = mode
+        with server_factory(web_config) as server:
+            assert isinstance(server.httpd, server_class)
+            client = client_factory(server)
+            client.request('GET', '/index.html')
+            resp = client.getresponse()
+            assert resp.status == 200
+            assert resp.version == 11
+            assert resp.read()
+            sock = client.sock
+            assert sock is not None
+
+            client.request('PUT', '/echo', body=b'foo bar')
+            resp = client.getresponse()
+            assert resp.status == 200
+            assert resp.read() == b'foo bar'
+            client.request('HEAD', '/index.html')
+            resp = client.getresponse()
+            assert resp.status == 200
+            assert resp.read() == b''
+
+            # Error responses, and multi-range responses, are framed too
+            client.request('GET', '/no-such-thing')
+            resp = client.getresponse()
+            assert resp.status == 404
+            assert resp.headers['Content-Length'] == '0'
+            assert resp.read() == b''
+            client.request('GET', '/index.html', headers={
+                'Range': 'bytes=0-9,20-29'})
+            resp = client.getresponse()
+            assert resp.status == 206
+            assert 'Content-Length' in resp.headers
+            assert resp.read().endswith(b'--BOUNDARY--\r\n')
+            client.request('GET', '/echo')
+            resp = client.getresponse()
+            assert resp.status == 404
+            resp.read()
+            assert client.sock is sock
+
+
+def test_keep_alive_http10(web_config, server_factory, no_routes):
+    with server_factory(web_config) as server:
+        with socket.create_connection(
+                server.httpd.socket.getsockname()[:2], timeout=10) as sock:
+            sock.sendall(
+                b'GET /no-such-thing HTTP/1.0\r\n'
+                b'Connection: keep-alive\r\n\r\n')
+            resp = sock.recv(4096)
+            assert resp.startswith(b'HTTP/1.1 404 ')
+            assert b'\r\nConnection: keep-alive\r\n' in resp
+            sock.sendall(b'GET /no-such-thing HTTP/1.0\r\n\r\n')
+            resp = sock.recv(4096)
+            assert resp.startswith(b'HTTP/1.1 404 ')
+            assert b'\r\nConnection: close\r\n' in resp
+            assert sock.recv(4096) == b''
+
+
+def test_keep_alive_timeout(web_config, server_factory, no_routes,
+                            client_factory):
+    web_config.httpd_timeout = 1
+    for mode in ('threading', 'asyncio'):
+        web_config.httpd_mode = mode
+        with server_factory(web_config) as server:
+            client = client_factory(server)
+            client.request('GET', '/no-such-thing')
+            resp = client.getresponse()
+            assert resp.status == 404
+            resp.read()
+            # The server closes the idle connection
+            assert client.sock.recv(1) == b''
+
+
+def test_close_unframed(web_config, server_factory, no_routes,
+                        client_factory):
+    @route('/stream')
+    def stream(request):
+        request.send_response(200)
+        request.send_header('Content-Type', 'text/plain')
+        request.end_headers()
+        request.wfile.write(b'foo bar')
+        return DummyResponse(request)
+
+    @route('/silent')
+    def silent(request):
+        return DummyResponse(request)
+
+    @route('/ignore', 'PUT')
+    def ignore(request):
+        return HTTPResponse(request, status_code=HTTPStatus.NO_CONTENT)
+
+    for mode in ('threading', 'asyncio'):
+        web_config.httpd_mode = mode
+        with server_factory(web_config) as server:
+            client = client_factory(server)
+            client.request('GET', '/stream')
+            resp = client.getresponse()
+            assert resp.status == 200
+            assert resp.headers['Connection'] == 'close'
+            assert resp.read() == b'foo bar'
+
+            # An unread body can't be mistaken for a subsequent request
+            client = client_factory(server)
+            client.request(
+                'PUT', '/ignore', body=b'GET /stream HTTP/1.1\r\n\r\n')
+            resp = client.getresponse()
+            assert resp.status == 204
+            assert resp.read() == b''
+            assert resp.headers['Connection'] == 'close'
+
+            # A route which sends nothing at all closes the connection rather
+            # than leaving the client waiting
+            client = client_factory(server)
+            client.request('GET', '/silent')
+            with pytest.raises(RemoteDisconnected):
+                client.getresponse()
+
+
+def test_async_broken_in_development(web_config, server_factory, no_routes,
+                                     client_factory):
+    web_config.production = False
+    web_config.httpd_mode = 'asyncio'
+
+    class BrokenRoute(Exception):
+        pass
+
+    with pytest.raises(BrokenRoute):
+        with server_factory(web_config) as server:
+            @route('/broken.html')
+            def broken_route(request):
+                raise BrokenRoute('This route is broken!')
+
+            client = client_factory(server)
+            client.request('GET', '/broken.html')
+            with pytest.raises(RemoteDisconnected):
+                client.getresponse()
+            server.join(1)
+            assert not server.is_alive()
+
+
+def test_events(web_config, server_factory, default_routes, client_factory):
+    messages = Messages()
+    with server_factory(web_config, messages=messages) as server:
+        client = client_factory(server)
+        client.request('GET', '/events')
+        resp = client.getresponse()
+        assert resp.status == 200
+        assert resp.headers['Content-Type'] == 'text/event-stream'
+        messages.show('Hello')
+        assert resp.readline() == b'data: "Hello"\n'
+        assert resp.readline() == b'\n'
+        assert len(messages) == 0
+        client.close()
+
+        scanner = mock.Mock(angle=90, progress=1.0)
+        scanner.updates.return_value = [(1, (0.5, 0.5), 50), (2, None, 0)]
+        server.httpd.calibration.scanner = scanner
+        client = client_factory(server)
+        client.request('GET', '/events?angle=90', headers={
+            'Last-Event-ID': '3'})
+        resp = client.getresponse()
+        assert resp.status == 200
+        events = resp.read().decode('utf-8').split('\n\n')
+        scanner.updates.assert_called_once_with(3)
+        assert events[0].splitlines()[:2] == ['event: scan', 'id: 4']
+        assert json.loads(events[0].splitlines()[2][len('data: '):]) == {
+            'led': 1, 'position': [0.5, 0.5], 'score': 50, 'progress': 1.0}
+        assert events[1].splitlines()[:2] == ['event: scan', 'id: 5']
+        assert events[2] == 'event: scanned\ndata: {}'
+
+        client = client_factory(server)
+        client.request('GET', '/events?angle=0')
+        resp = client.getresponse()
+        assert resp.status == 404
+
+
+def test_async_chunked(web_config, server_factory, no_routes, client_factory):
+    web_config.httpd_mode = 'asyncio'
+    with server_factory(web_config) as server:
+        @route('/numbers.json')
+        def numbers(request):
+            return HTTPResponse(
+                request, mime_type='application/json', compress=True,
+                body=iterencode_array(range(10000), chunk_size=1000))
+
+        client = client_factory(server)
+        client.request('GET', '/numbers.json')
+        resp = client.getresponse()
+        assert resp.status == 200
+        assert resp.headers['Transfer-Encoding'] == 'chunked'
+        assert resp.headers['Vary'] == 'Accept-Encoding'
+        assert 'Content-Encoding' not in resp.headers
+        assert json.loads(resp.read()) == list(range(10000))
+        sock = client.sock
+
+        client.request('GET', '/numbers.json', headers={
+            'Accept-Encoding': 'gzip'})
+        resp = client.getresponse()
+        assert resp.status == 200
+        assert resp.headers['Transfer-Encoding'] == 'chunked'
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert json.loads(gzip.decompress(resp.read())) == list(range(10000))
+        assert client.sock is sock
+
+
+def test_sendfile(tmp_path, web_config, server_factory, no_routes,
+                  client_factory):
+    data = bytes(range(256)) * 4096
+    (tmp_path / 'image.jpg').write_bytes(data)
+
+    @route('/image.jpg')
+    def image(request):
+        return HTTPResponse(request, body=tmp_path / 'image.jpg')
+
+    for mode in ('threading', 'asyncio'):
+        web_config.httpd_mode = mode
+        with server_factory(web_config) as server:
+            client = client_factory(server)
+            client.request('GET', '/image.jpg')
+            resp = client.getresponse()
+            assert resp.status == 200
+            assert int(resp.headers['Content-Length']) == len(data)
+            assert resp.read() == data
+
+            client = client_factory(server)
+            client.request('GET', '/image.jpg', headers={
+                'Range': 'bytes=1000-99999'})
+            resp = client.getresponse()
+            assert resp.status == 206
+            assert resp.read() == data[1000:100000]
+
+            client = client_factory(server)
+            client.request('GET', '/image.jpg', headers={
+                'Range': 'bytes=0-9,-10'})
+            resp = client.getresponse()
+            assert resp.status == 206
+            body = resp.read()
+            assert data[:10] in body
+            assert data[-10:] in body
+
+
+def test_route_frames(web_config, server_factory, no_routes, client_factory):
+    with server_factory(web_config) as server:
+        data = None
+
+        @route('/frames', 'PUT')
+        def frames(request):
+            nonlocal data
+            try:
+                data = request.frames()
+            except (KeyError, ValueError):
+                return HTTPResponse(request, status_code=HTTPStatus.BAD_REQUEST)
+            return HTTPResponse(request, status_code=HTTPStatus.NO_CONTENT)
+
+        client = client_factory(server)
+        client.request('PUT', '/frames', body=json.dumps(
+            [['#ff0000', '#000000'], ['#000000', 'blue']]))
+        resp = client.getresponse()
+        assert resp.status == 204
+        assert resp.read() == b''
+        assert data == ([b'\xff\x00\x00\x00\x00\x00',
+                         b'\x00\x00\x00\x00\x00\xff'], {})
+
+        client = client_factory(server)
+        client.request('PUT', '/frames', body=json.dumps({
+            'frames': [['#ff0000']], 'tags': ['red'], 'description': 'Red'}))
+        resp = client.getresponse()
+        assert resp.status == 204
+        assert data == ([b'\xff\x00\x00'], {
+            'tags': ['red'], 'description': 'Red'})
+
+        for body in ('{"tags": []}', '[[1, 2]]', '[["#ff0000"]', '[] []'):
+            client = client_factory(server)
+            client.request('PUT', '/frames', body=body)
+            resp = client.getresponse()
+            assert resp.status == 400
+
+
+def test_route_POST_bad_json(web_config, server_factory, no_routes,
+                             client_factory):
+    with server_factory(web_config) as server:
+        @route('/config', command='POST')
+        def configure(request):
+            request.query
+            return HTTPResponse(request, status_code=HTTPStatus.NO_CONTENT)
+
+        client = client_factory(server)
+        client.request('POST', '/config', body='{"foo": ',
+                       headers={'Content-Type': 'application/json'})
+        resp = client.getresponse()
+        assert resp.status == 400
+
+
+def test_max_body(web_config, server_factory, no_routes, client_factory):
+    web_config.max_body = 100
+    with server_factory(web_config) as server:
+        @route('/echo', 'PUT')
+        def echo(request):
+            return HTTPResponse(request, body=request.rfile.read(
+                int(request.headers['Content-Length'])))
+
+        client = client_factory(server)
+        client.request('PUT', '/echo', body=b'x' * 100)
+        resp = client.getresponse()
+        assert resp.status == 200
+        assert resp.read() == b'x' * 100
+
+        client = client_factory(server)
+        client.request('PUT', '/echo', body=b'x' * 101)
+        resp = client.getresponse()
+        assert resp.status == 413
+        assert resp.read() == b''
+
+
+def test_async_max_body_expect(web_config, server_factory, no_routes,
+                               client_factory):
+    web_config.httpd_mode = 'asyncio'
+    web_config.max_body = 100
+    with server_factory(web_config) as server:
+        client = client_factory(server)
+        client.putrequest('PUT', '/echo')
+        client.putheader('Content-Length', '1000000')
+        client.putheader('Expect', '100-continue')
+        client.endheaders()
+        # The body is never sent; the server must refuse it regardless
+        resp = client.getresponse()
+        assert resp.status == 413
+        assert resp.headers['Connection'] == 'close'
+
+
+def test_search_presets_bad_query(web_config, server_factory, default_routes,
+                                  client_factory):
+    store.Storage(web_config.db).presets['red'] = [['#ff0000']] * 60
+    with server_factory(web_config) as server:
+        client = client_factory(server)
+        for query in (
+            'min_duration=inf',
+            'max_duration=-inf',
+            'max_duration=1e308',
+            'min_duration=nan',
+            'min_colors=99999999999999999999',
+            'per_page=101',
+        ):
+            client.request('GET', f'/presets/search.json?{query}')
+            resp = client.getresponse()
+            assert resp.status == 400
+            resp.read()
+
+        client.request('GET', '/presets/search.json?min_duration=1')
+        resp = client.getresponse()
+        assert resp.status == 200
+        assert json.loads(resp.read())['total'] == 1
+
+def test_import_large_body(tmp_path, web_config, server_factory,
+                           default_routes, client_factory):
+    other = store.Storage(str(tmp_path / 'other.db'))
+    other.presets['red'] = [['#ff0000'] * 100] * 10
+    archive = io.BytesIO()
+    other.export_archive(archive)
+    body = archive.getvalue()
+    # Imports are streamed into the store, so the limit doesn't apply
+    web_config.max_body = len(body) - 1
+    with server_factory(web_config) as server:
+        client = client_factory(server)
+        client.request('PUT', '/presets.tar.gz', body=body, headers={
+            'Expect': '100-continue'})
+        resp = client.getresponse()
+        assert resp.status == 204
+        resp.read()
+        storage = store.Storage(web_config.db)
+        assert storage.presets['red'] == [['#ff0000'] * 100] * 10
+
+        client.request('PUT', '/preset/red.json', body=json.dumps(
+            [['#ff0000'] * 100] * 10), headers={'Expect': '100-continue'})
+        resp = client.getresponse()
+        assert resp.status == 413
+
+def test_preset_not_modified_gzip(web_config, server_factory, default_routes,
+                                  client_factory):
+    store.Storage(web_config.db).presets['red'] = [['#ff0000'] * 3]
+    with server_factory(web_config) as server:
+        client = client_factory(server)
+        client.request('GET', '/preset/red.json',
+                       headers={'Accept-Encoding': 'gzip'})
+        resp = client.getresponse()
+        assert resp.status == 200
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        resp.read()
+        etag = resp.headers['ETag']
+        assert etag.endswith('-gzip"')
+
+        # The response must not be generated just to find it's unchanged
+        with mock.patch('blinkenxmas.routes.iterencode_array') as encode:
+            client.request('GET', '/preset/red.json', headers={
+                'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+            resp = client.getresponse()
+            assert resp.read() == b''
+            assert resp.status == 304
+            assert resp.headers['ETag'] == etag
+            assert resp.headers['Vary'] == 'Accept-Encoding'
+            assert not encode.called
+
+
+
+def test_set_preset_bad_info(web_config, server_factory, default_routes,
+                             client_factory):
+    storage = store.Storage(web_config.db)
+    with server_factory(web_config) as server:
+        client = client_factory(server)
+        for info in (
+            {'tags': 'xmas'},
+            {'tags': [1]},
+            {'description': {}},
+            {'animation': ['spin']},
+        ):
+            client.request('PUT', '/preset/red.json', body=json.dumps({
+                'frames': [['#ff0000']], **info}))
+            resp = client.getresponse()
+            assert resp.status == 400
+            resp.read()
+            assert 'red' not in storage.presets
+
+        client.request('PUT', '/preset/red.json', body=json.dumps({
+            'frames': [['#ff0000']], 'tags': ['xmas'], 'description': None}))
+        resp = client.getresponse()
+        assert resp.status == 201
+        resp.read()
+        assert storage.presets.info('red').tags == ['xmas']
+
+def test_metrics(web_config, server_factory, default_routes, client_factory):
+    with server_factory(web_config) as server:
+        count = REQUEST_SECONDS.count(route='get_presets', method='GET')
+        sizes = RESPONSE_BYTES.count(route='get_presets', method='GET')
+        ok = RESPONSES.value(route='get_presets', method='GET', status='200')
+        missing = RESPONSES.value(route='none', method='GET', status='404')
+
+        client = client_factory(server)
+        client.request('GET', '/presets.json')
+        resp = client.getresponse()
+        assert resp.status == 200
+        assert resp.read() == b'[]'
+        client = client_factory(server)
+        client.request('GET', '/no-such-thing')
+        resp = client.getresponse()
+        assert resp.status == 404
+        resp.read()
+
+        client = client_factory(server)
+        client.request('GET', '/metrics')
+        resp = client.getresponse()
+        assert resp.status == 200
+        assert resp.headers['Content-Type'].startswith('text/plain')
+        body = resp.read().decode('utf-8')
+        assert REQUEST_SECONDS.count(
+            route='get_presets', method='GET') == count + 1
+        assert RESPONSE_BYTES.count(
+            route='get_presets', method='GET') == sizes + 1
+        assert RESPONSES.value(
+            route='get_presets', method='GET', status='200') == ok + 1
+        assert RESPONSES.value(
+            route='none', method='GET', status='404') == missing + 1
+        assert (
+            '# TYPE blinkenxmas_http_request_duration_seconds histogram'
+            in body)
+        assert (
+            f'blinkenxmas_http_responses_total{{route="get_presets",'
+            f'method="GET",status="200"}} {ok + 1}') in body
+        assert (
+            'blinkenxmas_storage_query_seconds_count{statement="SELECT"}'
+            in body)
+
+
+def test_lazy_calibration(web_config):
+    web_config.camera_type = 'files'
+    calibration = LazyCalibration(web_config, Messages(), mock.Mock())
+    assert calibration._camera is None
+    assert calibration._calibration is None
+    camera = calibration.camera
+    assert camera.__class__.__name__ == 'FilesSource'
+    assert calibration.camera is camera
+    assert calibration._calibration is None
+    assert calibration.scanner is None
+    assert not calibration.calculator.angles
+    scanner = mock.Mock()
+    calibration.scanner = scanner
+    assert calibration.scanner is scanner
+
+    calibration.close()
+    scanner.stop.assert_called_once_with()
+    assert calibration._camera is None
+    assert calibration._calibration is None
+
+
+def test_lazy_calibration_idle(web_config):
+    web_config.camera_type = 'files'
+    calibration = LazyCalibration(
+        web_config, Messages(), mock.Mock(), idle_timeout=0.05)
+    try:
+        # Nothing is released while a scan is running ...
+        calibration.scanner = scanner = mock.Mock(scanning=True)
+        camera = calibration.camera
+        sleep(0.2)
+        assert calibration._camera is camera
+        assert calibration._calibration.scanner is scanner
+
+        # ... but once it's done, everything is
+        scanner.scanning = False
+        for i in range(20):
+            if calibration._camera is None:
+                break
+            sleep(0.05)
+        assert calibration._camera is None
+        assert calibration._calibration is None
+        assert calibration._reaper is None
+
+        # Access re-creates the camera, and restarts the idle timer; state
+        # with scanned angles is retained, but the scanner is released
+        assert calibration.camera is not camera
+        calibration.scanner = mock.Mock(scanning=False)
+        state = calibration._calibration
+        with mock.patch.object(
+                state.calculator.__class__, 'angles',
+                new_callable=mock.PropertyMock, return_value=[0]):
+            for i in range(20):
+                if calibration._camera is None:
+                    break
+                sleep(0.05)
+            assert calibration._camera is None
+            assert calibration._calibration is state
+            assert state.scanner is None
+    finally:
+        calibration.close()
+
+
+def test_animation_jobs(web_config, server_factory, default_routes,
+                        client_factory):
+    finish = Event()
+    def spin(count, led_count):
+        "A test animation."
+        finish.wait(5)
+        for i in range(int(count)):
+            yield [Color('red')] * led_count
+
+    with mock.patch.dict(HTTPRequestHandler.animations):
+        animation(
+            'Spin', count=Param('Count', 'number', default=1),
+            led_count=ParamLEDCount())(spin)
+        web_config.led_count = 2
+        web_config.job_queue = 0
+        with server_factory(web_config) as server:
+            client = client_factory(server)
+            client.request('POST', '/animation/spin', body='{"count": 2}',
+                           headers={'Content-Type': 'application/json'})
+            resp = client.getresponse()
+            assert resp.status == 202
+            job = json.loads(resp.read())
+            assert job['state'] in ('queued', 'running')
+            location = resp.headers['Location']
+            assert location == f'/job/{job["id"]}.json'
+
+            # The queue is full (one worker, no waiting jobs)
+            client.request('POST', '/animation/spin', body='{"count": 2}',
+                           headers={'Content-Type': 'application/json'})
+            resp = client.getresponse()
+            assert resp.status == 503
+            assert int(resp.headers['Retry-After']) > 0
+            resp.read()
+
+            client.request('GET', f'/job/{job["id"]}/result.json')
+            resp = client.getresponse()
+            assert resp.status == 409
+            resp.read()
+
+            finish.set()
+            for i in range(500):
+                client.request('GET', location)
+                resp = client.getresponse()
+                assert resp.status == 200
+                job = json.loads(resp.read())
+                if job['state'] == 'done':
+                    break
+                sleep(0.01)
+            assert job['result'] == f'/job/{job["id"]}/result.json'
+            client.request('GET', job['result'])
+            resp = client.getresponse()
+            assert resp.status == 200
+            assert json.loads(resp.read()) == [['#ff0000', '#ff0000']] * 2
+            assert job['frames'] == 2
+            assert job['leds'] == 2
+
+            # The job's id stands in for the frames it generated
+            client.request('POST', '/preview',
+                           body=json.dumps({'job': job['id']}),
+                           headers={'Content-Type': 'application/json'})
+            resp = client.getresponse()
+            assert resp.status == 204
+            resp.read()
+            server.httpd.queue.put.assert_called_with(
+                [b'\xff\x00\x00' * 2] * 2)
+            client.request('PUT', '/preset/spin.json',
+                           body=json.dumps({
+                               'job': job['id'], 'animation': 'spin'}),
+                           headers={'Content-Type': 'application/json'})
+            resp = client.getresponse()
+            assert resp.status == 201
+            resp.read()
+            storage = store.Storage(web_config.db)
+            assert storage.presets['spin'] == [['#ff0000', '#ff0000']] * 2
+            assert storage.presets.info('spin').tags == ['spin']
+            client.request('POST', '/preview',
+                           body=json.dumps({'job': 'foo'}),
+                           headers={'Content-Type': 'application/json'})
+            resp = client.getresponse()
+            assert resp.status == 400
+            resp.read()
+
+            client.request('GET', '/job/foo.json')
+            resp = client.getresponse()
+            assert resp.status == 404
+            resp.read()
+
+            client.request('POST', '/animation/nope', body='{}',
+                           headers={'Content-Type': 'application/json'})
+            resp = client.getresponse()
+            assert resp.status == 400
+            resp.read()
+
+
+def test_animation_job_cancel(web_config, server_factory, default_routes,
+                              client_factory):
+    def forever(led_count):
+        "A test animation."
+        while True:
+            yield [Color('red')] * led_count
+
+    with mock.patch.dict(HTTPRequestHandler.animations):
+        animation('Forever', led_count=ParamLEDCount())(forever)
+        web_config.led_count = 2
+        with server_factory(web_config) as server:
+            client = client_factory(server)
+            client.request('POST', '/animation/forever', body='{}',
+                           headers={'Content-Type': 'application/json'})
+            resp = client.getresponse()
+            assert resp.status == 202
+            resp.read()
+            location = resp.headers['Location']
+            client.request('DELETE', location)
+            resp = client.getresponse()
+            assert resp.status == 204
+            resp.read()
+            for i in range(500):
+                client.request('GET', location)
+                resp = client.getresponse()
+                job = json.loads(resp.read())
+                if job['state'] == 'cancelled':
+                    break
+                sleep(0.01)
+            assert job['state'] == 'cancelled'
+            assert 'result' not in job
+
+
+def test_create_animation_job(web_config, server_factory, default_routes,
+                              client_factory):
+    def solid(led_count):
+        "A test animation."
+        return [[Color('blue')] * led_count]
+
+    with mock.patch.dict(HTTPRequestHandler.animations):
+        animation('Solid', led_count=ParamLEDCount())(solid)
+        web_config.led_count = 3
+        with server_factory(web_config) as server:
+            client = client_factory(server)
+            client.request(
+                'POST', '/create', body='name=blue&animation=solid',
+                headers={
+                    'Content-Type': 'application/x-www-form-urlencoded'})
+            resp = client.getresponse()
+            assert resp.status == 303
+            assert resp.headers['Location'] == '/index.html'
+            resp.read()
+            for i in range(500):
+                if server.httpd.jobs.pending == 0:
+                    break
+                sleep(0.01)
+            storage = store.Storage(web_config.db)
+            assert storage.presets['blue'] == [['#0000ff'] * 3]
+            server.httpd.messages.show.assert_called_with(
+                'Created preset blue')
+
+
+def test_create_animation_bad_param(web_config, server_factory,
+                                    default_routes, client_factory):
+    def count(count):
+        "A test animation."
+        return [[Color('blue')] * int(count)]
+
+    with mock.patch.dict(HTTPRequestHandler.animations):
+        animation('Count', count=Param('Count', 'number'))(count)
+        with server_factory(web_config) as server:
+            client = client_factory(server)
+            client.request(
+                'POST', '/create', body='name=blue&animation=count&count=foo',
+                headers={
+                    'Content-Type': 'application/x-www-form-urlencoded'})
+            resp = client.getresponse()
+            resp.read()
+            assert resp.status == 400
+            assert server.httpd.jobs.pending == 0
+
+
+def test_forward(web_config, server_factory, no_routes, client_factory):
+    @route('/local', 'GET')
+    def local(request):
+        return HTTPResponse(request, body=f'local {request.server.owner}')
+
+    @route('/owned', 'PUT')
+    @owner_only
+    def owned(request):
+        data = request.rfile.read(int(request.headers['Content-Length']))
+        return HTTPResponse(
+            request, body=iter([b'owner: ', data]), mime_type='text/plain',
+            headers={'X-Owner': 'yes'})
+
+    @route('/owned', 'GET')
+    @owner_only
+    def owned_get(request):
+        return HTTPResponse(
+            request, body='owner', etag='foo', mime_type='text/plain')
+
+    with server_factory(web_config) as owner:
+        owner_addr = owner.httpd.server_address[:2]
+        for mode in ('threading', 'asyncio'):
+            web_config.httpd_mode = mode
+            with HTTPThread(
+                web_config, mock.Mock(), mock.Mock(), owner=owner_addr
+            ) as worker:
+                client = client_factory(worker)
+                client.request('GET', '/local')
+                resp = client.getresponse()
+                assert resp.status == 200
+                assert resp.read() == f'local {owner_addr}'.encode('ascii')
+
+                client.request('PUT', '/owned', body=b'foo')
+                resp = client.getresponse()
+                assert resp.status == 200
+                assert resp.headers['X-Owner'] == 'yes'
+                assert resp.headers['Content-Type'] == 'text/plain'
+                assert resp.headers['Transfer-Encoding'] == 'chunked'
+                assert resp.read() == b'owner: foo'
+
+                client.request('GET', '/owned')
+                resp = client.getresponse()
+                assert resp.status == 200
+                assert resp.headers['Content-Length'] == '5'
+                assert resp.headers['ETag'] == '"foo"'
+                assert resp.read() == b'owner'
+
+                client.request('GET', '/owned',
+                               headers={'If-None-Match': '"foo"'})
+                resp = client.getresponse()
+                assert resp.status == 304
+                assert resp.read() == b''
+
+                client.request('HEAD', '/owned')
+                resp = client.getresponse()
+                assert resp.status == 200
+                assert resp.headers['Content-Length'] == '5'
+                assert resp.read() == b''
+
+                # The connection survives all of the above
+                client.request('GET', '/local')
+                resp = client.getresponse()
+                assert resp.status == 200
+                resp.read()
+
+
+@pytest.mark.skipif(not hasattr(socket, 'SO_REUSEPORT'),
+                    reason='SO_REUSEPORT not supported')
+def test_reuse_port(web_config, no_routes, client_factory):
+    @route('/pid', 'GET')
+    def pid(request):
+        return HTTPResponse(request, body=str(id(request.server)))
+
+    for mode in ('threading', 'asyncio'):
+        web_config.httpd_mode = mode
+        with HTTPThread(
+            web_config, mock.Mock(), mock.Mock(), reuse_port=True
+        ) as first:
+            web_config.httpd_port = first.httpd.server_address[1]
+            with HTTPThread(
+                web_config, mock.Mock(), mock.Mock(), reuse_port=True
+            ) as second:
+                assert second.httpd.server_address == first.httpd.server_address
+                client = client_factory(second)
+                client.request('GET', '/pid')
+                resp = client.getresponse()
+                assert resp.status == 200
+                assert resp.read() in {
+                    str(id(first.httpd)).encode('ascii'),
+                    str(id(second.httpd)).encode('ascii'),
+                }
+            web_config.httpd_port = 0
+
+
+def test_async_events_dont_block(web_config, server_factory, default_routes,
+                                 client_factory, caplog):
+    web_config.httpd_mode = 'asyncio'
+    web_config.httpd_workers = 2
+    messages = Messages()
+    with mock.patch('blinkenxmas.routes.EVENTS_KEEPALIVE', 0.1), \
+            server_factory(web_config, messages=messages) as server:
+        streams = []
+        for i in range(web_config.httpd_workers):
+            client = client_factory(server)
+            client.request('GET', '/events')
+            resp = client.getresponse()
+            assert resp.status == 200
+            streams.append((client, resp))
+
+        client = client_factory(server, timeout=5)
+        client.request('GET', '/')
+        resp = client.getresponse()
+        assert resp.status == 301
+        resp.read()
+
+    # The streams' keep-alives must now notice their connections have gone,
+    # rather than fail on the closed event loop
+    for thread in threading.enumerate():
+        if thread.name == 'httpd-stream':
+            thread.join(5)
+            assert not thread.is_alive()
+    assert not server.httpd.exception
+    assert 'Event loop is closed' not in caplog.text
@@ -0,0 +1,176 @@
+from time import sleep
+from threading import Event
+from unittest import mock
+
+import pytest
+
+from blinkenxmas.jobs import *
+
+
+@pytest.fixture()
+def jobs(request):
+    queue = JobQueue(max_workers=1, max_queued=1)
+    yield queue
+    queue.close()
+
+
+def wait(job, timeout=5):
+    for i in range(int(timeout / 0.01)):
+        if job.finished:
+            return
+        sleep(0.01)
+    assert False, f'{job!r} did not finish'
+
+
+def test_job_done(jobs):
+    job = jobs.submit('foo', lambda job: 42)
+    assert repr(job).startswith(f'<Job id={job.id!r} kind=')
+    assert jobs[job.id] is job
+    wait(job)
+    assert job.state == 'done'
+    assert job.result == 42
+    assert job.progress == 1.0
+    assert job.eta is None
+    assert job.duration >= 0
+    assert job.as_dict() == {
+        'id': job.id, 'state': 'done', 'progress': 1.0, 'eta': None,
+        'error': None}
+    assert not job.cancel()
+    assert jobs.expected('foo') is not None
+    assert jobs.expected('bar') is None
+    assert len(jobs) == 1
+
+
+def test_job_failed(jobs):
+    def func(job):
+        raise ValueError('bad parameter')
+    job = jobs.submit('foo', func)
+    wait(job)
+    assert job.state == 'failed'
+    assert job.result is None
+    assert job.error == 'bad parameter'
+    assert job.progress is None
+    assert jobs.expected('foo') is None
+
+
+def test_job_progress(jobs):
+    started = Event()
+    finish = Event()
+    def func(job):
+        job.update(0.25)
+        started.set()
+        finish.wait(5)
+        return 'done'
+    job = jobs.submit('foo', func)
+    assert started.wait(5)
+    assert job.state == 'running'
+    assert job.progress == 0.25
+    # No previous job of this kind; no estimate of the time remaining
+    assert job.eta is None
+    finish.set()
+    wait(job)
+
+    started.clear()
+    finish.clear()
+    job = jobs.submit('foo', func)
+    assert started.wait(5)
+    assert job.progress == 0.25
+    assert job.eta is not None and job.eta >= 0
+    finish.set()
+    wait(job)
+
+
+def test_job_estimated_progress(jobs):
+    with mock.patch('blinkenxmas.jobs.monotonic') as monotonic:
+        monotonic.return_value = 100.0
+        job = Job('foo', lambda job: None, expected=10.0)
+        assert job.progress == 0.0
+        assert job.eta is None
+        job._state = Job.RUNNING
+        job._started = 100.0
+        monotonic.return_value = 104.0
+        assert job.progress == pytest.approx(0.4)
+        assert job.eta == pytest.approx(6.0)
+        monotonic.return_value = 120.0
+        assert job.progress == 0.99
+        assert job.eta == 0.0
+
+
+def test_job_cancel(jobs):
+    started = Event()
+    def func(job):
+        started.set()
+        while True:
+            job.update()
+            sleep(0.01)
+    running = jobs.submit('foo', func)
+    queued = jobs.submit('foo', func)
+    assert started.wait(5)
+    assert queued.state == 'queued'
+    assert queued.cancel()
+    assert queued.state == 'cancelled'
+    assert running.cancel()
+    wait(running)
+    assert running.state == 'cancelled'
+    assert running.result is None
+    assert jobs.pending == 0
+
+
+def test_job_cancel_ignored(jobs):
+    started = Event()
+    finish = Event()
+    def func(job):
+        started.set()
+        finish.wait(5)
+        return 42
+    job = jobs.submit('foo', func)
+    assert started.wait(5)
+    assert job.cancel()
+    finish.set()
+    wait(job)
+    # The function never checked for cancellation, but its result is still
+    # discarded
+    assert job.state == 'cancelled'
+    assert job.result is None
+
+
+def test_queue_full(jobs):
+    finish = Event()
+    first = jobs.submit('foo', lambda job: finish.wait(5))
+    second = jobs.submit('foo', lambda job: finish.wait(5))
+    assert jobs.pending == 2
+    with pytest.raises(QueueFull) as exc:
+        jobs.submit('foo', lambda job: None)
+    assert exc.value.retry_after == 5
+    assert JOBS_REJECTED.value() >= 1
+    finish.set()
+    wait(first)
+    wait(second)
+    jobs.submit('foo', lambda job: None)
+
+
+def test_queue_expiry(jobs):
+    jobs.keep = 0
+    job = jobs.submit('foo', lambda job: None)
+    wait(job)
+    sleep(0.01)
+    with pytest.raises(KeyError):
+        jobs[job.id]
+    assert len(jobs) == 0
+
+
+def test_queue_close():
+    started = Event()
+    def func(job):
+        started.set()
+        while True:
+            job.update()
+            sleep(0.01)
+    jobs = JobQueue(max_workers=1, max_queued=1)
+    running = jobs.submit('foo', func)
+    queued = jobs.submit('foo', func)
+    assert started.wait(5)
+    jobs.close()
+    wait(running)
+    assert running.state == 'cancelled'
+    assert queued.state == 'cancelled'
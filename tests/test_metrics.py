@@ -0,0 +1,128 @@
+import math
+import pickle
+
+import pytest
+
+from blinkenxmas.metrics import *
+
+
+@pytest.fixture()
+def registry():
+    return Registry()
+
+
+def test_format_value():
+    assert format_value(1) == '1'
+    assert format_value(0.5) == '0.5'
+    assert format_value(math.inf) == '+Inf'
+    assert format_value(-math.inf) == '-Inf'
+    assert format_value(math.nan) == 'NaN'
+
+
+def test_format_labels():
+    assert format_labels(()) == ''
+    assert format_labels((('route', 'index'), ('method', 'GET'))) == (
+        '{route="index",method="GET"}')
+    assert format_labels((('path', 'a"b\\c\nd'),)) == (
+        '{path="a\\"b\\\\c\\nd"}')
+
+
+def test_registry(registry):
+    counter = Counter('foo_total', 'Foos', registry=registry)
+    assert 'foo_total' in registry
+    assert registry['foo_total'] is counter
+    with pytest.raises(ValueError):
+        Counter('foo_total', 'More foos', registry=registry)
+    Gauge('bar', 'Bars', registry=registry).set(2)
+    counter.inc()
+    assert registry.render() == """\
+# HELP bar Bars
+# TYPE bar gauge
+bar 2
+# HELP foo_total Foos
+# TYPE foo_total counter
+foo_total 1
+"""
+
+
+def test_counter(registry):
+    counter = Counter('req_total', 'Requests', ('status',), registry=registry)
+    counter.inc(status=200)
+    counter.inc(2, status=200)
+    counter.inc(status=404)
+    assert counter.value(status=200) == 3
+    assert counter.value(status=500) == 0
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        counter.inc(status=200, method='GET')
+    assert list(counter.render())[2:] == [
+        'req_total{status="200"} 3',
+        'req_total{status="404"} 1',
+    ]
+    counter.clear()
+    assert list(counter.render())[2:] == []
+
+
+def test_gauge(registry):
+    gauge = Gauge('depth', 'Depth', registry=registry)
+    assert gauge.value() == 0
+    gauge.set(5)
+    assert gauge.value() == 5
+    gauge.set_function(lambda: 7)
+    assert gauge.value() == 7
+    assert list(gauge.render())[2:] == ['depth 7']
+    gauge.set_function(None)
+    assert list(gauge.render())[2:] == ['depth 5']
+
+
+def test_histogram(registry):
+    with pytest.raises(ValueError):
+        Histogram('bad', 'Bad', ('le',), registry=registry)
+    hist = Histogram(
+        'size_bytes', 'Sizes', ('route',), buckets=(100, 10), registry=registry)
+    assert hist.buckets == (10, 100)
+    for value in (1, 10, 50, 1000):
+        hist.observe(value, route='index')
+    assert hist.count(route='index') == 4
+    assert hist.count(route='other') == 0
+    assert list(hist.render()) == [
+        '# HELP size_bytes Sizes',
+        '# TYPE size_bytes histogram',
+        'size_bytes_bucket{route="index",le="10.0"} 2',
+        'size_bytes_bucket{route="index",le="100.0"} 3',
+        'size_bytes_bucket{route="index",le="+Inf"} 4',
+        'size_bytes_sum{route="index"} 1061',
+        'size_bytes_count{route="index"} 4',
+    ]
+
+
+def test_histogram_time(registry):
+    hist = Histogram('duration_seconds', 'Durations', registry=registry)
+    with hist.time():
+        pass
+    with pytest.raises(RuntimeError):
+        with hist.time():
+            raise RuntimeError('failed')
+    assert hist.count() == 2
+
+
+def test_merge_collected(registry):
+    counter = Counter('req_total', 'Requests', ('status',), registry=registry)
+    counter.inc(status=200)
+    Gauge('depth', 'Depth', registry=registry).set(3)
+    owner = registry.collect()
+    assert render_collected(owner) == registry.render()
+    counter.inc(2, status=200)
+    worker = pickle.loads(pickle.dumps(registry.collect()))
+    merged = merge_collected({'owner': owner, 'bxweb-0': worker})
+    assert render_collected(merged) == """\
+# HELP depth Depth
+# TYPE depth gauge
+depth{process="owner"} 3
+depth{process="bxweb-0"} 3
+# HELP req_total Requests
+# TYPE req_total counter
+req_total{process="owner",status="200"} 1
+req_total{process="bxweb-0",status="200"} 3
+"""
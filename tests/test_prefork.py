@@ -0,0 +1,136 @@
+import socket
+from time import sleep
+from queue import Queue
+from threading import Thread, Event
+from unittest import mock
+from http.client import HTTPConnection
+
+import pytest
+
+from blinkenxmas import metrics
+from blinkenxmas.httpd import Messages
+from blinkenxmas.prefork import *
+
+
+@pytest.fixture()
+def prefork_server(web_config, default_routes):
+    # Workers share the port with SO_REUSEPORT, so it must be fixed in advance
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        web_config.httpd_port = sock.getsockname()[1]
+    web_config.httpd_processes = 2
+    with mock.patch('blinkenxmas.mqtt.mqtt.Client') as client, \
+            mock.patch('blinkenxmas.prefork.METRICS_INTERVAL', 0.1):
+        task = Thread(target=serve, args=(web_config,), daemon=True)
+        task.start()
+        server = mock.Mock(
+            task=task, client=client.return_value,
+            address=('127.0.0.1', web_config.httpd_port))
+        for i in range(100):
+            try:
+                socket.create_connection(server.address).close()
+            except ConnectionRefusedError:
+                sleep(0.1)
+            else:
+                break
+        yield server
+        # serve() returns once the MQTT thread stops
+        with mock.patch('blinkenxmas.mqtt.MessageThread.is_alive',
+                        return_value=False):
+            task.join(10)
+        assert not task.is_alive()
+
+
+def test_relayed_messages():
+    queue = Queue()
+    relayed = RelayedMessages(queue)
+    assert len(relayed) == 0
+    relayed.show('foo')
+    relayed.show('bar')
+    assert len(relayed) == 0
+    queue.put(None)
+
+    messages = Messages()
+    task = Thread(target=relay_messages, args=(queue, messages))
+    task.start()
+    task.join(5)
+    assert not task.is_alive()
+    assert messages.drain() == ['foo', 'bar']
+
+
+def test_send_receive_metrics():
+    queue = Queue()
+    stop = Event()
+    stop.set()
+    send_metrics(queue, 'bxweb-0', stop, interval=0)
+    name, collected = queue.get_nowait()
+    assert name == 'bxweb-0'
+    assert [name for name, help, type, samples in collected] == [
+        name for name, help, type, samples in metrics.REGISTRY.collect()]
+    queue.put((name, collected))
+    queue.put(None)
+    processes = {}
+    receive_metrics(queue, processes)
+    assert processes == {'bxweb-0': collected}
+
+
+def test_serve_no_reuse_port(web_config):
+    web_config.httpd_processes = 2
+    with mock.patch('blinkenxmas.prefork.socket') as sock:
+        del sock.SO_REUSEPORT
+        with pytest.raises(RuntimeError):
+            serve(web_config)
+
+
+def test_serve_page(prefork_server):
+    relayed = RelayedMessages(Queue())
+    assert relayed.drain() == []
+    assert relayed.version == 0
+    # Connections are spread between the workers; make a few so that every
+    # worker renders the page (and its messages) at least once
+    for i in range(4):
+        client = HTTPConnection(*prefork_server.address, timeout=10)
+        client.request('GET', '/index.html')
+        resp = client.getresponse()
+        assert resp.status == 200
+        assert b'<html' in resp.read()
+        client.close()
+
+
+def test_serve_preview(prefork_server):
+    client = HTTPConnection(*prefork_server.address, timeout=10)
+    for i in range(3):
+        # Each preview is forwarded to the owner, whose MQTT thread must
+        # survive sending it
+        client.request('POST', '/preview', body='[["#ff0000", "#00ff00"]]',
+                       headers={'Content-Type': 'application/json'})
+        resp = client.getresponse()
+        resp.read()
+        assert resp.status == 204
+    client.close()
+    for i in range(50):
+        if prefork_server.client.publish.call_count >= 3:
+            break
+        sleep(0.1)
+    assert prefork_server.client.publish.call_count >= 3
+    assert prefork_server.task.is_alive()
+
+
+def test_serve_metrics(prefork_server):
+    # Wait for both workers to report; every scrape (whichever worker it
+    # lands on) includes all processes
+    for i in range(50):
+        client = HTTPConnection(*prefork_server.address, timeout=10)
+        client.request('GET', '/metrics')
+        resp = client.getresponse()
+        body = resp.read().decode('utf-8')
+        client.close()
+        assert resp.status == 200
+        if 'process="bxweb-0"' in body and 'process="bxweb-1"' in body:
+            break
+        sleep(0.1)
+    assert 'process="owner"' in body
+    assert 'process="bxweb-0"' in body
+    assert 'process="bxweb-1"' in body
+    # The MQTT metrics only exist in the owner
+    assert 'blinkenxmas_mqtt_queue_depth{process="owner"}' in body
@@ -0,0 +1,407 @@
+import io
+import json
+import sqlite3
+import tarfile
+
+import pytest
+
+from blinkenxmas.store import *
+
+
+@pytest.fixture()
+def db(request, tmp_path):
+    return str(tmp_path / 'presets.db')
+
+
+def count_blocks(db):
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM blocks").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_pack_frame():
+    assert pack_frame([]) == b''
+    assert pack_frame(['#ff0000', '#00ff00']) == b'\xff\x00\x00\x00\xff\x00'
+    assert pack_frame(['#FFF', 'blue']) == b'\xff\xff\xff\x00\x00\xff'
+    assert pack_frame(b'\xff\x00\x00') == b'\xff\x00\x00'
+
+
+def test_unpack_frame():
+    assert unpack_frame(b'') == []
+    assert unpack_frame(b'\xff\x00\x00\x00\xff\x00') == ['#ff0000', '#00ff00']
+
+
+def test_presets_roundtrip(db):
+    store = Storage(db)
+    assert not store.presets
+    store.presets['foo'] = [['#ff0000', '#000000'], ['#000000', '#ff0000']]
+    store.presets['empty'] = []
+    assert store.presets
+    assert len(store.presets) == 2
+    assert list(store.presets) == ['empty', 'foo']
+    assert 'foo' in store.presets
+    assert 'bar' not in store.presets
+    assert store.presets['foo'] == [
+        ['#ff0000', '#000000'], ['#000000', '#ff0000']]
+    assert store.presets['empty'] == []
+    with pytest.raises(KeyError):
+        store.presets['bar']
+
+
+def test_presets_dedup(db):
+    store = Storage(db)
+    red, blue = ['#ff0000'] * 10, ['#0000ff'] * 10
+    store.presets['flash'] = [red, blue] * 50
+    assert count_blocks(db) == 2
+    store.presets['red'] = [red] * 100
+    assert count_blocks(db) == 2
+    store.presets['green'] = [['#00ff00'] * 10]
+    assert count_blocks(db) == 3
+    assert store.presets['flash'] == [red, blue] * 50
+
+
+def test_presets_frames(db):
+    store = Storage(db)
+    red, blue = ['#ff0000'] * 10, ['#0000ff'] * 10
+    store.presets['flash'] = [red, red, blue] * 10
+    store.presets['empty'] = []
+    assert list(store.presets.frames('flash')) == [red, red, blue] * 10
+    for batch_size in (1, 3, 7, 30, 31):
+        assert list(store.presets.frames('flash', batch_size=batch_size)) == [
+            red, red, blue] * 10
+    assert list(store.presets.frames('empty', batch_size=1)) == []
+    with pytest.raises(KeyError):
+        list(store.presets.frames('bar'))
+
+
+def test_presets_refcount(db):
+    store = Storage(db)
+    red, blue = ['#ff0000'] * 10, ['#0000ff'] * 10
+    store.presets['flash'] = [red, blue]
+    store.presets['red'] = [red]
+    del store.presets['flash']
+    assert count_blocks(db) == 1
+    assert store.presets['red'] == [red]
+    # Overwriting a preset with frames it already refers to must not lose
+    # the shared blocks
+    store.presets['red'] = [blue, red]
+    assert count_blocks(db) == 2
+    assert store.presets['red'] == [blue, red]
+    del store.presets['red']
+    assert count_blocks(db) == 0
+    with pytest.raises(KeyError):
+        del store.presets['red']
+
+
+def test_upgrade(db):
+    conn = sqlite3.connect(db)
+    with conn:
+        conn.execute(
+            "CREATE TABLE config (version INT NOT NULL PRIMARY KEY)")
+        conn.execute("INSERT INTO config (version) VALUES (3)")
+        conn.execute(
+            "CREATE TABLE presets (name VARCHAR(200) NOT NULL PRIMARY KEY, "
+            "data TEXT NOT NULL)")
+        conn.execute(
+            "CREATE TABLE positions (led INTEGER NOT NULL PRIMARY KEY, "
+            "y NUMBER NOT NULL, a NUMBER NOT NULL, r NUMBER NOT NULL)")
+        conn.execute(
+            "INSERT INTO presets (name, data) VALUES (?, ?)",
+            ('foo', json.dumps([['#ff0000'], ['#ff0000']])))
+        conn.execute(
+            "INSERT INTO positions (led, y, a, r) VALUES (0, 0.5, 90, 0.5)")
+    conn.close()
+    store = Storage(db)
+    assert list(store.presets) == ['foo']
+    assert store.presets['foo'] == [['#ff0000'], ['#ff0000']]
+    assert count_blocks(db) == 1
+    assert list(store.snapshots) == [1]
+    assert store.positions[0] == Position.from_polar(0.5, 90, 0.5)
+
+
+def test_positions_roundtrip(db):
+    store = Storage(db)
+    assert not store.positions
+    assert store.positions_version == 0
+    store.positions[0] = Position.from_polar(0.5, 90, 0.5)
+    store.positions[1] = Position.from_polar(0.25, 180, 1)
+    assert store.positions_version == 2
+    assert store.positions
+    assert len(store.positions) == 2
+    assert list(store.positions) == [0, 1]
+    assert 1 in store.positions
+    assert 2 not in store.positions
+    assert store.positions[0] == Position.from_polar(0.5, 90, 0.5)
+    with pytest.raises(KeyError):
+        store.positions[2]
+    del store.positions[0]
+    assert list(store.positions) == [1]
+    assert store.positions_version == 3
+    with pytest.raises(KeyError):
+        del store.positions[0]
+    store.positions.clear()
+    assert not store.positions
+    assert store.positions_version == 4
+
+
+def test_snapshots(db):
+    store = Storage(db)
+    assert list(store.snapshots) == [1]
+    assert store.snapshots.active == 1
+    store.positions[0] = Position.from_polar(0.5, 90, 0.5)
+    version = store.positions_version
+    snapshot = store.snapshots.add({
+        0: Position.from_polar(0.1, 0, 0.1),
+        1: Position.from_polar(0.2, 0, 0.1),
+    })
+    assert snapshot == 2
+    assert store.snapshots.active == 2
+    assert store.positions_version > version
+    assert len(store.positions) == 2
+    assert store.snapshots[1].count == 1
+    assert store.snapshots[2].count == 2
+    assert store.snapshots[2].created.tzinfo is not None
+
+    # Roll back to the prior snapshot
+    version = store.positions_version
+    store.snapshots.active = 1
+    assert store.positions_version > version
+    assert list(store.positions) == [0]
+    assert store.positions[0] == Position.from_polar(0.5, 90, 0.5)
+    with pytest.raises(KeyError):
+        store.snapshots.active = 3
+    with pytest.raises(ValueError):
+        del store.snapshots[1]
+    del store.snapshots[2]
+    assert list(store.snapshots) == [1]
+    with pytest.raises(KeyError):
+        store.snapshots[2]
+    with pytest.raises(KeyError):
+        del store.snapshots[2]
+
+
+def test_export_import(db, tmp_path):
+    red, blue = ['#ff0000'] * 10, ['#0000ff'] * 10
+    store = Storage(db)
+    store.presets['flash'] = [red, blue] * 5
+    store.presets['a/b c'] = [blue]
+    store.presets['empty'] = []
+    store.presets.describe('flash', tags=['alert'], description='Flash',
+                           positional=True)
+    store.positions[0] = Position.from_polar(0.5, 90, 0.5)
+    archive = io.BytesIO()
+    assert store.export_archive(archive) == 3
+
+    other = Storage(str(tmp_path / 'other.db'))
+    other.presets['flash'] = [blue]
+    other.presets['keep'] = [['#00ff00'] * 10]
+    archive.seek(0)
+    assert other.import_archive(archive, batch_size=1) == 3
+    assert list(other.presets) == ['a/b c', 'empty', 'flash', 'keep']
+    assert other.presets['flash'] == [red, blue] * 5
+    assert other.presets.info('flash') == PresetInfo(
+        'flash', ['alert'], 'Flash', True, 10, 2)
+    assert other.presets.info('empty') == PresetInfo(
+        'empty', [], '', False, 0, 0)
+    assert other.presets.search('alert')[0] == 1
+    assert other.presets['a/b c'] == [blue]
+    assert other.presets['empty'] == []
+    assert count_blocks(str(tmp_path / 'other.db')) == 3
+    assert other.snapshots.active == 2
+    assert other.positions[0] == Position.from_polar(0.5, 90, 0.5)
+
+
+def test_import_blocks_after_presets(db, tmp_path):
+    red, blue = ['#ff0000'] * 10, ['#0000ff'] * 10
+    store = Storage(db)
+    store.presets['flash'] = [red, blue] * 5
+    store.presets['a/b c'] = [blue]
+    exported = io.BytesIO()
+    assert store.export_archive(exported) == 2
+    exported.seek(0)
+    with tarfile.open(fileobj=exported, mode='r:gz') as tar:
+        members = {
+            member.name: (member, tar.extractfile(member).read())
+            for member in tar
+        }
+    # Place the blocks between (and after) the presets that refer to them
+    order = sorted(members, key=lambda name: (
+        0 if name == 'presets/flash' else
+        1 if name.startswith('blocks/') else 2))
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w:gz',
+                      format=tarfile.PAX_FORMAT) as tar:
+        for name in order:
+            member, data = members[name]
+            tar.addfile(member, io.BytesIO(data))
+
+    other = Storage(str(tmp_path / 'other.db'))
+    archive.seek(0)
+    assert other.import_archive(archive) == 2
+    assert other.presets['flash'] == [red, blue] * 5
+    assert other.presets['a/b c'] == [blue]
+    assert count_blocks(str(tmp_path / 'other.db')) == 2
+    total, presets = other.presets.search('')
+    assert {(p.name, p.frames, p.colors) for p in presets} == {
+        ('flash', 10, 2), ('a/b c', 1, 1)}
+    assert other.presets.search('', min_colors=2)[0] == 1
+    del other.presets['flash']
+    assert other.presets['a/b c'] == [blue]
+    assert count_blocks(str(tmp_path / 'other.db')) == 1
+    del other.presets['a/b c']
+    assert count_blocks(str(tmp_path / 'other.db')) == 0
+
+
+def test_import_corrupt(db, tmp_path):
+    store = Storage(db)
+    store.presets['foo'] = [['#ff0000'] * 10]
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+        info = tarfile.TarInfo('presets/bar')
+        info.size = HASH_SIZE
+        tar.addfile(info, io.BytesIO(b'\x00' * HASH_SIZE))
+    archive.seek(0)
+    with pytest.raises(ValueError):
+        store.import_archive(archive)
+    assert list(store.presets) == ['foo']
+    with pytest.raises(tarfile.TarError):
+        store.import_archive(io.BytesIO(b'foo'))
+
+
+def test_presets_info(db):
+    store = Storage(db)
+    red, blue = ['#ff0000'] * 10, ['#0000ff'] * 10
+    store.presets['flash'] = [red, blue] * 5
+    assert store.presets.info('flash') == PresetInfo(
+        'flash', [], '', False, 10, 2)
+    store.presets.describe(
+        'flash', tags=['alert', ' loud, bright ', ''],
+        description='Flashes red and blue', positional=False)
+    assert store.presets.info('flash') == PresetInfo(
+        'flash', ['alert', 'loud  bright'], 'Flashes red and blue', False,
+        10, 2)
+    store.presets.describe('flash', positional=True)
+    assert store.presets.info('flash').positional
+    assert store.presets.info('flash').tags == ['alert', 'loud  bright']
+    store.presets['flash'] = [red]
+    assert store.presets.info('flash').frames == 1
+    assert store.presets.info('flash').colors == 1
+    with pytest.raises(KeyError):
+        store.presets.info('foo')
+    with pytest.raises(KeyError):
+        store.presets.describe('foo', description='foo')
+    with pytest.raises(KeyError):
+        store.presets.describe('foo')
+
+
+def test_presets_search(db):
+    store = Storage(db)
+    red, blue, green = ['#ff0000'] * 10, ['#0000ff'] * 10, ['#00ff00'] * 10
+    store.presets['Police'] = [red, blue] * 5
+    store.presets.describe('Police', tags=['flash'],
+                           description='Alternating red and blue')
+    store.presets['Red sweep'] = [red, ['#ff0000'] * 5 + ['#000000'] * 5]
+    store.presets.describe('Red sweep', positional=True,
+                           description='A red plane sweeping the tree')
+    store.presets['Green'] = [green]
+    store.presets['Blue'] = [blue]
+
+    assert store.presets.search() == (4, [
+        store.presets.info(name)
+        for name in ('Blue', 'Green', 'Police', 'Red sweep')])
+    total, found = store.presets.search(offset=1, limit=2)
+    assert total == 4
+    assert [p.name for p in found] == ['Green', 'Police']
+    total, found = store.presets.search('red')
+    assert total == 2
+    # Name matches rank higher than description matches
+    assert [p.name for p in found] == ['Red sweep', 'Police']
+    assert [p.name for p in store.presets.search('fla')[1]] == ['Police']
+    assert [p.name for p in store.presets.search('red swe')[1]] == [
+        'Red sweep']
+    assert store.presets.search('"NEAR(') == (0, [])
+    assert [p.name for p in store.presets.search(positional=True)[1]] == [
+        'Red sweep']
+    assert [
+        p.name for p in store.presets.search(min_frames=2, max_colors=2)[1]
+    ] == ['Police', 'Red sweep']
+    assert [
+        p.name for p in store.presets.search('red', max_frames=2)[1]
+    ] == ['Red sweep']
+    assert store.presets.search(min_colors=3) == (0, [])
+    del store.presets['Police']
+    assert store.presets.search('flash') == (0, [])
+
+
+def test_upgrade_search(db):
+    store = Storage(db)
+    store.presets['flash'] = [['#ff0000'], ['#0000ff']]
+    store._conn.close()
+    # Regress to the version 5 schema, which lacked preset meta-data
+    conn = sqlite3.connect(db)
+    conn.execute("PRAGMA legacy_alter_table = ON")
+    with conn:
+        conn.execute("UPDATE config SET version = 5")
+        conn.execute("DROP TABLE presets_search")
+        conn.execute("DROP TABLE counters")
+        for action in ('insert', 'update', 'delete'):
+            conn.execute(f"DROP TRIGGER presets_search_{action}")
+        for column in ('positional', 'frames', 'colors'):
+            conn.execute(f"DROP INDEX presets_{column}")
+        conn.execute("ALTER TABLE presets RENAME TO old_presets")
+        conn.execute(
+            "CREATE TABLE presets (name VARCHAR(200) NOT NULL PRIMARY KEY)")
+        conn.execute("INSERT INTO presets SELECT name FROM old_presets")
+        conn.execute("DROP TABLE old_presets")
+    conn.close()
+    store = Storage(db)
+    assert store.presets['flash'] == [['#ff0000'], ['#0000ff']]
+    assert store.presets.info('flash') == PresetInfo(
+        'flash', [], '', False, 2, 2)
+    assert store.presets.search('flash')[0] == 1
+    assert store.presets.version('flash') == 0
+    store.presets.describe('flash', description='Flashy')
+    assert store.presets.version('flash') == store.presets_version == 1
+
+
+def test_presets_versions(db):
+    store = Storage(db)
+    assert store.presets_version == 0
+    store.presets['foo'] = [['#ff0000']]
+    store.presets['bar'] = [['#ff0000']]
+    assert store.presets_version == 2
+    assert store.presets.version('foo') == 1
+    assert store.presets.version('bar') == 2
+    store.presets.describe('foo', tags=['baz'])
+    assert store.presets.version('foo') == 3
+    assert store.presets.version('bar') == 2
+    store.presets.describe('foo')
+    assert store.presets_version == 3
+    del store.presets['foo']
+    assert store.presets_version == 4
+    with pytest.raises(KeyError):
+        store.presets.version('foo')
+    # Re-creating a preset never re-uses a prior version
+    store.presets['foo'] = [['#ff0000']]
+    assert store.presets.version('foo') == 5
+
+
+def test_storage_query_metrics(db):
+    selects = QUERY_SECONDS.count(statement='SELECT')
+    inserts = QUERY_SECONDS.count(statement='INSERT')
+    store = Storage(db)
+    store.presets['foo'] = [['#ff0000']]
+    assert store.presets['foo'] == [['#ff0000']]
+    assert QUERY_SECONDS.count(statement='SELECT') > selects
+    assert QUERY_SECONDS.count(statement='INSERT') > inserts
+
+
+def test_enable_wal(tmp_path):
+    db = Storage(str(tmp_path / 'presets.db'))
+    assert db.enable_wal() == 'wal'
+    # The setting persists in the database
+    conn = sqlite3.connect(str(tmp_path / 'presets.db'))
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    assert Storage(':memory:').enable_wal() == 'memory'
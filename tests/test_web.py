@@ -25,6 +25,28 @@ def test_messages():
     assert messages.drain() == [str(i) for i in range(5, 10)]
 
 
+def test_messages_wait():
+    messages = Messages()
+    version = messages.version
+    assert messages.wait(version, timeout=0) == version
+    messages.notify()
+    assert messages.wait(version, timeout=0) == version + 1
+    assert messages.drain() == []
+    messages.show('foo')
+    assert messages.wait(version + 1, timeout=0) == version + 2
+    assert len(messages) == 1
+
+
+def test_load_animations():
+    module = mock.Mock(value='foo.animations')
+    with mock.patch('blinkenxmas.web.entry_points') as entry_points:
+        entry_points.return_value = [module]
+        load_animations()
+        entry_points.assert_called_once_with(group='blinkenxmas_animations')
+        module.load.assert_called_once_with()
+    assert httpd.STARTUP_SECONDS.value(phase='animations') >= 0
+
+
 def test_main_help(capsys):
     with pytest.raises(SystemExit) as exc_info:
         main(['-h'])
@@ -48,3 +70,13 @@ def test_main_bad_config(dummy_args):
         assert main(dummy_args + ['--lead-duration', '10s',
                                   '--min-duration', '10s',
                                   '--max-duration', '10s']) == 1
+
+
+def test_main_prefork(dummy_args):
+    with mock.patch('blinkenxmas.web.prefork.serve') as serve, \
+            mock.patch('blinkenxmas.web.load_animations'), \
+            mock.patch('blinkenxmas.httpd.HTTPThread') as HTTPThread:
+        assert main(dummy_args + ['--httpd-processes', '4']) == 0
+        assert serve.call_count == 1
+        assert serve.call_args[0][0].httpd_processes == 4
+        assert not HTTPThread.called